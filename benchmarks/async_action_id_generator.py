@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""Compare the cost of generating ```AsyncAction``` ids with
+```tor_async_util.AsyncActionIdGenerator``` and ```uuid.uuid4()```.
+
+    >python benchmarks/async_action_id_generator.py
+"""
+
+import timeit
+
+import tor_async_util
+
+
+def main(number=100000):
+    generators = [
+        ('uuid4', tor_async_util.uuid4_async_action_id_generator),
+        ('AsyncActionIdGenerator', tor_async_util.AsyncActionIdGenerator()),
+    ]
+    for (name, generator) in generators:
+        seconds = timeit.timeit(generator, number=number)
+        print '%-25s %8.3f us per id' % (name, seconds * 1000000.0 / number)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,45 @@
+import array
 import base64
+import binascii
+import bisect
+import collections
 import ConfigParser
+import copy
 import datetime
+import functools
+import gc
+import hashlib
 import httplib
+import itertools
 import json
 import logging
+import math
 import os
 import re
 import random
 import signal
 import sys
+import time
 import uuid
+import zlib
 
+import concurrent.futures
 from tornado.ioloop import IOLoop
 import jsonschema
 from keyczar import keyczar
 import pycurl
+import tornado.concurrent
+import tornado.curl_httpclient
+import tornado.escape
+import tornado.httpclient
+import tornado.httpserver
+import tornado.httputil
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
+import jsonschema_compiler
 import jsonschemas
 
 __version__ = '1.16.0'
@@ -118,6 +141,170 @@ def install_sigint_handler():
     signal.signal(signal.SIGINT, _sigint_handler)
 
 
+def serve(app,
+          port,
+          address='',
+          num_processes=0,
+          reuse_port=False,
+          backlog=128,
+          schemas=(),
+          warmup=None,
+          on_start=None,
+          max_restarts=100,
+          **http_server_kwargs):
+    """serve() is the multi-process equivalent of ```app.listen(port)```
+    followed by ```IOLoop.current().start()```. Using one process per
+    core is how a service scales on a multi-core host:
+
+        * ```schemas``` are registered with ```jsonschema_validators``` and
+          ```warmup``` (if supplied) is called before forking so validators
+          (and anything else ```warmup``` creates - think config and
+          compiled regular expressions) are created once and shared
+          copy-on-write by all workers
+        * ```num_processes``` workers are forked using
+          ```tornado.process.fork_processes()``` - 0 means one worker
+          per core and 1 means don't fork - workers which exit
+          abnormally are restarted up to ```max_restarts``` times
+        * by default the listening sockets are bound (with a listen
+          backlog of ```backlog```) before forking and shared by all
+          workers - if ```reuse_port``` is True each worker binds its own
+          socket with SO_REUSEPORT so the kernel spreads connections
+          evenly across workers
+        * each worker creates a ```tornado.httpserver.HTTPServer``` (using
+          ```http_server_kwargs```), calls ```on_start``` (if supplied) with
+          its task id and the http server and then starts its own IOLoop
+
+    In workers serve() returns the task id once the IOLoop is stopped.
+    When forking, serve() never returns in the parent - the parent exits
+    (```sys.exit(0)```) once all workers have exited normally and
+    ```RuntimeError``` is raised if workers have to be restarted more than
+    ```max_restarts``` times.
+
+    Nothing which creates an IOLoop or threads should be done before
+    calling serve() - create http clients, ```ConfigReloader```s, etc
+    in ```on_start```.
+
+        #!/usr/bin/env python
+
+        import tor_async_util
+
+        if __name__ == "__main__":
+            tor_async_util.install_sigint_handler()
+
+            app = tornado.web.Application(handlers=[...])
+            tor_async_util.serve(app, 8445, reuse_port=True, schemas=[...])
+    """
+    global _keyczar_executor
+
+    for schema in schemas:
+        jsonschema_validators.get(schema)
+
+    if warmup is not None:
+        warmup()
+
+    is_forking = num_processes != 1
+
+    sockets = None
+    if not (reuse_port and is_forking):
+        sockets = tornado.netutil.bind_sockets(port, address, backlog=backlog, reuse_port=reuse_port)
+
+    task_id = 0
+    if is_forking:
+        # collecting before forking means workers don't touch (and so
+        # copy) the pages holding garbage created during warmup
+        gc.collect()
+
+        task_id = tornado.process.fork_processes(num_processes, max_restarts)
+
+        # threads don't survive fork() so workers create their own executor
+        _keyczar_executor = None
+
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(port, address, backlog=backlog, reuse_port=True)
+
+    http_server = tornado.httpserver.HTTPServer(app, **http_server_kwargs)
+    http_server.add_sockets(sockets)
+
+    if on_start is not None:
+        on_start(task_id, http_server)
+
+    IOLoop.current().start()
+
+    http_server.stop()
+
+    return task_id
+
+
+"""```_status_code_reasons``` maps HTTP status codes to reason phrases.
+Python 2.7.3 doesn't support webdav status codes such as 422
+(see http://bugs.python.org/issue15025) so ```httplib.responses```
+is augmented with those status codes.
+"""
+_status_code_reasons = dict(httplib.responses)
+_status_code_reasons.update({
+    102: 'Processing',
+    207: 'Multi-Status',
+    226: 'IM Used',
+    422: 'Unprocessable Entity',
+    423: 'Locked',
+    424: 'Failed Dependency',
+    426: 'Upgrade Required',
+    507: 'Insufficient Storage',
+    510: 'Not Extended',
+})
+
+
+class _CannedResponse(object):
+    """Not found, bad request and error responses all have the same
+    shape - an empty JSON document, a JSON content type and a status code.
+    A ```_CannedResponse``` prebuilds the reason phrase, headers and body
+    for one of these responses so writing the response does no encoding
+    or lookups. Use ```_canned_response()``` to get an instance.
+    """
+
+    headers = (
+        ('Content-Type', 'application/json; charset=UTF-8'),
+    )
+
+    body = json.dumps({})
+
+    def __init__(self, status_code):
+        object.__init__(self)
+
+        self.status_code = status_code
+        self.reason = _status_code_reasons[status_code]
+
+    def write(self, request_handler, include_body=True):
+        if include_body:
+            for (name, value) in self.headers:
+                request_handler._headers[name] = value
+            request_handler.write(self.body)
+        tornado.web.RequestHandler.set_status(request_handler, self.status_code, self.reason)
+
+
+"""```_canned_responses``` caches ```_CannedResponse``` instances
+by status code.
+"""
+_canned_responses = {}
+
+
+def _canned_response(status_code):
+    """Returns the ```_CannedResponse``` for ```status_code```
+    raising a ```ValueError``` if ```status_code``` is unknown.
+    """
+    canned_response = _canned_responses.get(status_code)
+    if canned_response is None:
+        if status_code not in _status_code_reasons:
+            raise ValueError("unknown status code %d", status_code)
+        canned_response = _CannedResponse(status_code)
+        _canned_responses[status_code] = canned_response
+    return canned_response
+
+
+for _status_code in (httplib.BAD_REQUEST, httplib.NOT_FOUND, httplib.INTERNAL_SERVER_ERROR):
+    _canned_response(_status_code)
+
+
 class DefaultRequestHandler(tornado.web.RequestHandler):
     """This is the request handler that gets called when no other
     request handler's url spec is matched for HEAD, GET, POST,
@@ -180,13 +367,555 @@ class DefaultRequestHandler(tornado.web.RequestHandler):
         pass
 
     def prepare(self):
-        if self.request.method == "HEAD":
-            self.set_status(httplib.NOT_FOUND)
-            return
+        _canned_response(httplib.NOT_FOUND).write(self, self.request.method != "HEAD")
+
+
+class JSONSchemaValidatorRegistry(object):
+    """```jsonschema.validate()``` checks ```schema``` and then creates
+    a new validator (and ref resolver) each time it's called. For
+    the typical service the same small set of schemas is used on
+    every request so this is wasted effort. ```JSONSchemaValidatorRegistry```
+    checks and compiles each schema once and then hands out the same
+    validator on every subsequent call.
+
+    Validators are keyed by the schema's identity (```id()```)
+    rather than its value since hashing a schema on every call would
+    cost more than it saves. The registry holds a reference to each
+    schema so a schema's id can't be recycled while its validator is
+    in the registry. To guard against unbounded growth when schemas
+    are created per request, the registry is cleared (except for the
+    preloaded schemas) once it holds more than ```max_size``` validators.
+
+    If ```compile_schemas``` is True, draft-04 schemas are turned into
+    specialized Python validation functions by
+    ```jsonschema_compiler.compile_schema()``` rather than being
+    interpreted by ```jsonschema```. Services typically opt in at startup:
+
+        tor_async_util.jsonschema_validators.compile_schemas = True
+    """
 
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write({})
-        self.set_status(httplib.NOT_FOUND)
+    def __init__(self, preloaded_schemas=None, max_size=1024, compile_schemas=False):
+        object.__init__(self)
+
+        self.max_size = max_size
+
+        self._compile_schemas = compile_schemas
+        self._preloaded_schemas = list(preloaded_schemas or [])
+        self._validators = {}
+
+        self._preload()
+
+    def _preload(self):
+        for schema in self._preloaded_schemas:
+            self.get(schema)
+
+    @property
+    def compile_schemas(self):
+        return self._compile_schemas
+
+    @compile_schemas.setter
+    def compile_schemas(self, compile_schemas):
+        """Changing ```compile_schemas``` discards all validators
+        since they were created using the previous setting.
+        """
+        self._compile_schemas = compile_schemas
+        self._validators = {}
+        self._preload()
+
+    def __len__(self):
+        return len(self._validators)
+
+    def get(self, schema):
+        """Return a validator for ```schema``` creating and registering
+        the validator if this is the first time ```schema``` has been seen.
+        ```jsonschema.SchemaError``` is raised if ```schema``` is invalid.
+        """
+        entry = self._validators.get(id(schema))
+        if entry is not None and entry[0] is schema:
+            return entry[1]
+
+        validator_class = jsonschema.validators.validator_for(schema, jsonschema.Draft4Validator)
+        if self._compile_schemas and validator_class is jsonschema.Draft4Validator:
+            validator = jsonschema_compiler.compile_schema(schema)
+        else:
+            validator_class.check_schema(schema)
+            resolver = jsonschema.RefResolver.from_schema(schema)
+            validator = validator_class(schema, resolver=resolver)
+
+        if self.max_size <= len(self._validators):
+            self.clear()
+
+        self._validators[id(schema)] = (schema, validator)
+
+        return validator
+
+    def validate(self, instance, schema):
+        """A drop in replacement for ```jsonschema.validate()```."""
+        self.get(schema).validate(instance)
+
+    def clear(self):
+        """Discard all validators other than those for preloaded schemas."""
+        preloaded_schema_ids = set(id(schema) for schema in self._preloaded_schemas)
+        for schema_id in self._validators.keys():
+            if schema_id not in preloaded_schema_ids:
+                del self._validators[schema_id]
+
+
+"""```jsonschema_validators``` is the validator registry used by
+```RequestHandler.get_json_request_body()``` and
+```RequestHandler.write_and_verify()```. It's preloaded with validators
+for the schemas used by ```generate_version_response()```,
+```generate_noop_response()``` and ```generate_health_check_response()```.
+"""
+jsonschema_validators = JSONSchemaValidatorRegistry([
+    jsonschemas.get_version_response,
+    jsonschemas.get_noop_response,
+    jsonschemas.get_health_response,
+])
+
+
+class ResponseValidationPolicy(object):
+    """```RequestHandler.write_and_verify()``` uses a
+    ```ResponseValidationPolicy``` to decide if a response body
+    should be validated against its schema. The policy's mode is one of:
+
+        * ```ALWAYS``` - validate every response body (the default)
+        * ```SAMPLE``` - validate 1 in every ```sample_rate``` response bodies
+        * ```OFF``` - never validate response bodies
+
+    In ```SAMPLE``` mode ```schema_sample_rates``` can override ```sample_rate```
+    for individual schemas. ```schema_sample_rates``` is keyed by either a
+    schema or a schema's title. A rate of 1 means validate every response
+    body and a rate of 0 means never validate.
+
+    Validation failures are always logged by ```write_and_verify()```
+    and counted in ```num_failures```.
+
+    The policy is typically configured at startup:
+
+        tor_async_util.response_validation_policy = tor_async_util.ResponseValidationPolicy(
+            tor_async_util.ResponseValidationPolicy.SAMPLE,
+            sample_rate=100,
+            schema_sample_rates={
+                'get health response': 1,
+            })
+
+    or see ```Config.get_response_validation_policy()```.
+    """
+
+    ALWAYS = 'always'
+    SAMPLE = 'sample'
+    OFF = 'off'
+
+    def __init__(self, mode=ALWAYS, sample_rate=1, schema_sample_rates=None):
+        object.__init__(self)
+
+        assert mode in (type(self).ALWAYS, type(self).SAMPLE, type(self).OFF)
+
+        self.mode = mode
+        self.sample_rate = sample_rate
+
+        self._schema_sample_rates = {}
+        for (schema, rate) in (schema_sample_rates or {}).items():
+            self.set_schema_sample_rate(schema, rate)
+
+        self._counters = {}
+
+        self.num_validated = 0
+        self.num_skipped = 0
+        self.num_failures = 0
+
+    def set_schema_sample_rate(self, schema, rate):
+        """```schema``` is either a schema or a schema's title."""
+        key = schema if isinstance(schema, basestring) else id(schema)
+        self._schema_sample_rates[key] = (schema, rate)
+
+    def _sample_rate(self, schema):
+        entry = self._schema_sample_rates.get(id(schema))
+        if entry is not None and entry[0] is schema:
+            return entry[1]
+
+        title = schema.get('title') if isinstance(schema, dict) else None
+        entry = self._schema_sample_rates.get(title)
+        if entry is not None:
+            return entry[1]
+
+        return self.sample_rate
+
+    def should_validate(self, schema):
+        """Returns True if a response body should be validated against
+        ```schema``` otherwise returns False. Sampling is deterministic
+        (every Nth response body per schema is validated) rather than
+        random so that low volume schemas are still validated.
+        """
+        if self.mode == type(self).ALWAYS:
+            rv = True
+        elif self.mode == type(self).OFF:
+            rv = False
+        else:
+            rate = self._sample_rate(schema)
+            if rate <= 0:
+                rv = False
+            elif rate == 1:
+                rv = True
+            else:
+                count = self._counters.get(id(schema), 0)
+                if 1024 <= len(self._counters):
+                    self._counters.clear()
+                self._counters[id(schema)] = (count + 1) % rate
+                rv = count == 0
+
+        if rv:
+            self.num_validated += 1
+        else:
+            self.num_skipped += 1
+
+        return rv
+
+
+"""```response_validation_policy``` is the ```ResponseValidationPolicy```
+used by ```RequestHandler.write_and_verify()```.
+"""
+response_validation_policy = ResponseValidationPolicy()
+
+
+class RequestResponseLoggingPolicy(object):
+    """```RequestHandler.prepare()``` and ```RequestHandler.flush()```
+    log requests and responses at DEBUG level. Formatting headers and
+    copying bodies is expensive so none of this work is done unless
+    DEBUG logging is enabled and then only for a sample of requests.
+    ```RequestResponseLoggingPolicy``` determines which requests are logged
+    and what's included in the log messages:
+
+        * ```sample_rate``` - log 1 in every ```sample_rate``` requests
+        * ```route_sample_rates``` - overrides ```sample_rate``` for individual
+          routes and is keyed by either a request handler class or the
+          name of a request handler class - a rate of 0 means never log
+        * ```redacted_headers``` - values of these headers are replaced
+          with ```redacted_value```
+        * ```max_body_bytes``` - request and response bodies are truncated
+          to this number of bytes (None means don't truncate)
+
+    The policy is typically configured at startup:
+
+        tor_async_util.request_response_logging_policy = tor_async_util.RequestResponseLoggingPolicy(
+            sample_rate=10,
+            route_sample_rates={
+                'HealthRequestHandler': 0,
+            },
+            max_body_bytes=1024)
+    """
+
+    redacted_value = '<redacted>'
+
+    def __init__(self,
+                 sample_rate=1,
+                 route_sample_rates=None,
+                 redacted_headers=('Authorization', 'Proxy-Authorization', 'Cookie', 'Set-Cookie'),
+                 max_body_bytes=4096):
+        object.__init__(self)
+
+        self.sample_rate = sample_rate
+        self.route_sample_rates = route_sample_rates or {}
+        self.redacted_headers = frozenset(header.lower() for header in redacted_headers)
+        self.max_body_bytes = max_body_bytes
+
+        self._counters = {}
+
+    def should_log(self, request_handler):
+        """Returns True if the request and response processed by
+        ```request_handler``` should be logged otherwise returns False.
+        """
+        route = type(request_handler)
+        rate = self.route_sample_rates.get(route)
+        if rate is None:
+            rate = self.route_sample_rates.get(route.__name__, self.sample_rate)
+
+        if rate <= 0:
+            return False
+
+        if rate == 1:
+            return True
+
+        count = self._counters.get(route, 0)
+        self._counters[route] = (count + 1) % rate
+        return count == 0
+
+    def format_headers(self, headers):
+        rv = []
+        for (key, value) in headers.items():
+            if key.lower() in self.redacted_headers:
+                value = type(self).redacted_value
+            rv.append('%s: %s' % (key, value))
+        return rv
+
+    def format_body(self, chunks):
+        """Join ```chunks``` (a list of strings) into a single string
+        without copying more than ```max_body_bytes``` bytes.
+        """
+        if self.max_body_bytes is None:
+            return ''.join(chunks)
+
+        rv = []
+        num_bytes = 0
+        num_bytes_truncated = 0
+        for chunk in chunks:
+            remaining = self.max_body_bytes - num_bytes
+            if len(chunk) <= remaining:
+                rv.append(chunk)
+                num_bytes += len(chunk)
+            else:
+                if 0 < remaining:
+                    rv.append(chunk[:remaining])
+                    num_bytes += remaining
+                num_bytes_truncated += len(chunk) - max(remaining, 0)
+
+        if num_bytes_truncated:
+            rv.append('... (%d bytes truncated)' % num_bytes_truncated)
+
+        return ''.join(rv)
+
+    def format_request(self, request):
+        lines = ['%s %s' % (request.method, request.full_url())]
+        lines.extend(self.format_headers(request.headers))
+        lines.append(self.format_body([request.body or '']))
+        return '\n'.join(lines)
+
+    def format_response(self, headers, chunks):
+        lines = ['']
+        lines.extend(self.format_headers(headers))
+        return '\n'.join(lines) + self.format_body(chunks)
+
+
+"""```request_response_logging_policy``` is the ```RequestResponseLoggingPolicy```
+used by ```RequestHandler.prepare()``` and ```RequestHandler.flush()```.
+"""
+request_response_logging_policy = RequestResponseLoggingPolicy()
+
+
+class _MetricFamily(object):
+    """Abstract base class for the metric families in a ```MetricsRegistry```.
+    Each series (unique set of label values) is pre-aggregated as it's
+    updated and the series' label text is formatted once, when the series
+    is created, so rendering is O(number of series).
+    """
+
+    metric_type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        object.__init__(self)
+
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+        # tuple of label values -> series
+        self._series = collections.OrderedDict()
+
+    def _format_labels(self, label_values, extra_labels=()):
+        labels = zip(self.label_names, label_values) + list(extra_labels)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape_label_value(value)) for (name, value) in labels)
+
+    def _render_series(self, lines):
+        raise NotImplementedError()
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help_text))
+        lines.append('# TYPE %s %s' % (self.name, type(self).metric_type))
+        self._render_series(lines)
+
+    def clear(self):
+        self._series.clear()
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_metric_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if 0 < value else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+class _Counter(_MetricFamily):
+
+    metric_type = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [self.name + self._format_labels(label_values), 0]
+        series[1] += amount
+
+    def value(self, label_values=()):
+        series = self._series.get(label_values)
+        return series[1] if series else 0
+
+    def _render_series(self, lines):
+        for (prefix, value) in self._series.itervalues():
+            lines.append('%s %s' % (prefix, _format_metric_value(value)))
+
+
+class _Gauge(_Counter):
+
+    metric_type = 'gauge'
+
+    def set(self, value, label_values=()):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [self.name + self._format_labels(label_values), 0]
+        series[1] = value
+
+    def dec(self, label_values=(), amount=1):
+        self.inc(label_values, -amount)
+
+
+class _Histogram(_MetricFamily):
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=None):
+        _MetricFamily.__init__(self, name, help_text, label_names)
+
+        self.buckets = tuple(sorted(buckets or MetricsRegistry.default_buckets))
+
+    def observe(self, value, label_values=()):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = self._create_series(label_values)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    def _create_series(self, label_values):
+        bucket_prefixes = []
+        for upper_bound in self.buckets + (float('inf'),):
+            labels = self._format_labels(label_values, [('le', _format_metric_value(float(upper_bound)))])
+            bucket_prefixes.append('%s_bucket%s' % (self.name, labels))
+
+        labels = self._format_labels(label_values)
+        return _HistogramSeries(
+            bucket_prefixes,
+            '%s_sum%s' % (self.name, labels),
+            '%s_count%s' % (self.name, labels))
+
+    def count(self, label_values=()):
+        series = self._series.get(label_values)
+        return sum(series.counts) if series else 0
+
+    def _render_series(self, lines):
+        for series in self._series.itervalues():
+            cumulative_count = 0
+            for (prefix, count) in itertools.izip(series.bucket_prefixes, series.counts):
+                cumulative_count += count
+                lines.append('%s %d' % (prefix, cumulative_count))
+            lines.append('%s %s' % (series.sum_prefix, _format_metric_value(series.sum)))
+            lines.append('%s %d' % (series.count_prefix, cumulative_count))
+
+
+class _HistogramSeries(object):
+
+    __slots__ = ('bucket_prefixes', 'counts', 'sum_prefix', 'count_prefix', 'sum')
+
+    def __init__(self, bucket_prefixes, sum_prefix, count_prefix):
+        self.bucket_prefixes = bucket_prefixes
+        self.counts = [0] * len(bucket_prefixes)
+        self.sum_prefix = sum_prefix
+        self.count_prefix = count_prefix
+        self.sum = 0.0
+
+
+class MetricsRegistry(object):
+    """A ```MetricsRegistry``` holds pre-aggregated counters, gauges and
+    histograms which ```generate_metrics_response()``` renders in the
+    [Prometheus text format](https://prometheus.io/docs/instrumenting/exposition_formats/).
+    Updates and rendering are expected to happen on the IOLoop's thread
+    so no locking is required and rendering is O(number of series).
+
+        requests_total = tor_async_util.metrics_registry.counter(
+            'my_service_widgets_created_total',
+            'Widgets created by color.',
+            ('color',))
+
+        requests_total.inc(('red',))
+
+    ```tor_async_util``` registers the following metrics with ```metrics_registry```:
+
+        * ```tor_async_util_requests_total``` - by handler class, method and status code
+        * ```tor_async_util_request_duration_seconds``` - by handler class
+        * ```tor_async_util_debug_details_total``` - by handler class and debug details code
+        * ```tor_async_util_http_client_request_duration_seconds``` - by service and status class
+        * ```tor_async_util_process_start_time_seconds```
+    """
+
+    """Histogram bucket upper bounds in seconds."""
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        object.__init__(self)
+
+        self._metric_families = collections.OrderedDict()
+
+    def _register(self, metric_family):
+        if metric_family.name in self._metric_families:
+            raise ValueError("metric '%s' already registered" % metric_family.name)
+        self._metric_families[metric_family.name] = metric_family
+        return metric_family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(_Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._register(_Gauge(name, help_text, label_names))
+
+    def histogram(self, name, help_text, label_names=(), buckets=None):
+        return self._register(_Histogram(name, help_text, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric_family in self._metric_families.itervalues():
+            metric_family.render(lines)
+        lines.append('')
+        return '\n'.join(lines)
+
+    def clear(self):
+        """Remove all series but keep all registered metrics."""
+        for metric_family in self._metric_families.itervalues():
+            metric_family.clear()
+
+
+"""```metrics_registry``` is the ```MetricsRegistry``` rendered
+by ```generate_metrics_response()```.
+"""
+metrics_registry = MetricsRegistry()
+
+_requests_total = metrics_registry.counter(
+    'tor_async_util_requests_total',
+    'Requests processed by request handler class, method and status code.',
+    ('handler', 'method', 'code'))
+
+_request_duration_seconds = metrics_registry.histogram(
+    'tor_async_util_request_duration_seconds',
+    'Request processing time by request handler class.',
+    ('handler',))
+
+_debug_details_total = metrics_registry.counter(
+    'tor_async_util_debug_details_total',
+    'Debug details added to responses by request handler class and debug details code.',
+    ('handler', 'debug_details'))
+
+_http_client_request_duration_seconds = metrics_registry.histogram(
+    'tor_async_util_http_client_request_duration_seconds',
+    'Outbound http client request time by service and status class.',
+    ('service', 'status_class'))
+
+metrics_registry.gauge(
+    'tor_async_util_process_start_time_seconds',
+    'Start time of the process since unix epoch in seconds.').set(time.time())
 
 
 class RequestHandler(tornado.web.RequestHandler):
@@ -196,11 +925,21 @@ class RequestHandler(tornado.web.RequestHandler):
         r"^\s*application/json(;\s+charset\=utf-{0,1}8){0,1}\s*$",
         re.IGNORECASE)
 
+    """Set by ```prepare()``` when the request and response should be logged."""
+    _log_request_and_response = False
+
     def add_debug_details(self, value):
         """Include debug details in a response. Specifically, include
         an HTTP header in the response with the corresponding value
-        of ```value```.
+        of ```value```. Debug details are also counted in ```metrics_registry```.
         """
+        # formatting a non-integer value would raise and arbitrary values
+        # would create an unbounded number of series so lump them together
+        if isinstance(value, (int, long)):
+            label = "0x{:04x}".format(value)
+        else:
+            label = 'other'
+        _debug_details_total.inc((type(self).__name__, label))
         if _logger.isEnabledFor(logging.DEBUG):
             self.set_header(
                 debug_details_header_name,
@@ -213,9 +952,122 @@ class RequestHandler(tornado.web.RequestHandler):
         """
         self.clear_header("Server")
 
+    """Set to True in a subclass to gzip response bodies of at least
+    ```compression_min_size``` bytes for clients whose Accept-Encoding
+    includes gzip. Compression is done by ```finish()``` and responses which
+    have been flushed before ```finish()``` is called aren't compressed.
+    A compressed body is only used if it's smaller than the original body."""
+    compress_responses = False
+
+    compression_min_size = 1024
+
+    """Static responses (see ```set_static_response()```) are compressed
+    once and then served from a cache so the cost of compressing small
+    bodies isn't paid per request - static responses use
+    ```static_compression_min_size``` rather than ```compression_min_size```."""
+    static_compression_min_size = 0
+
+    """zlib compression level - 1 (fastest) to 9 (smallest)."""
+    compression_level = 6
+
+    """Set by ```set_static_response()```."""
+    _is_static_response = False
+
+    """Used to parse Accept-Encoding headers."""
+    _accept_encoding_reg_ex = re.compile(
+        r"^\s*(?P<coding>[^;\s]+)\s*(;\s*q\s*=\s*(?P<q>[0-9.]+))?\s*$")
+
+    """Set to True in a subclass to generate ETags for responses to GET and
+    HEAD requests - see ```compute_etag()```."""
+    generate_etags = False
+
+    """Set by ```set_etag_version()```."""
+    _etag_version = None
+
+    def set_etag_version(self, version):
+        """Use ```version``` (an app supplied token which changes whenever
+        the response body changes) to generate the response's ETag rather
+        than hashing the response body. Only used if ```generate_etags``` is True.
+        """
+        self._etag_version = version
+
+    def set_static_response(self):
+        """Indicate that the response body is the same for every request
+        to this url so, when compressing responses, the compressed body can
+        be cached and reused rather than compressed for every request.
+        """
+        self._is_static_response = True
+
+    def _accepts_gzip(self):
+        for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+            match = type(self)._accept_encoding_reg_ex.match(coding)
+            if match and match.group('coding').lower() in ('gzip', '*'):
+                try:
+                    return 0 < float(match.group('q') or 1)
+                except ValueError:
+                    return False
+        return False
+
+    def _compress_write_buffer(self):
+        if 'Content-Encoding' in self._headers:
+            return
+
+        body = b''.join(self._write_buffer)
+        if self._is_static_response:
+            min_size = type(self).static_compression_min_size
+        else:
+            min_size = type(self).compression_min_size
+        if len(body) < min_size:
+            return
+
+        self.add_header('Vary', 'Accept-Encoding')
+
+        if not self._accepts_gzip():
+            return
+
+        level = type(self).compression_level
+        compressed_body = _compressed_bodies.get((level, body)) if self._is_static_response else None
+        if compressed_body is None:
+            # 16 + MAX_WBITS = gzip header and trailer
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressed_body = compressor.compress(body) + compressor.flush()
+            if self._is_static_response:
+                _compressed_bodies.put((level, body), compressed_body)
+
+        # gzip's header and trailer make very small bodies bigger
+        if len(body) <= len(compressed_body):
+            return
+
+        self._write_buffer = [compressed_body]
+        self.set_header('Content-Encoding', 'gzip')
+
+    def finish(self, chunk=None):
+        """Overwritten to compress responses - see ```compress_responses```."""
+        if chunk is not None:
+            self.write(chunk)
+        if type(self).compress_responses and not self._headers_written:
+            self._compress_write_buffer()
+        return super(RequestHandler, self).finish()
+
     def compute_etag(self):
-        """Disable auto etag generation."""
-        return None
+        """By default auto etag generation is disabled. If ```generate_etags```
+        is True an ETag is generated from the version supplied to
+        ```set_etag_version()``` or, if no version was supplied, from the
+        length and CRC-32 of the buffered response body. Tornado uses the ETag
+        to respond to a matching If-None-Match with a 304 and no body.
+        """
+        if not type(self).generate_etags:
+            return None
+
+        if self._etag_version is not None:
+            return '"%s"' % self._etag_version
+
+        length = 0
+        crc = 0
+        for chunk in self._write_buffer:
+            length += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+        return '"%x-%08x"' % (length, crc & 0xffffffff)
 
     def get_json_request_body(self, schema):
         """Get the request's JSON body and convert it into a dict
@@ -239,7 +1091,7 @@ class RequestHandler(tornado.web.RequestHandler):
 
         try:
             json_body = json.loads(self.request.body)
-            jsonschema.validate(json_body, schema)
+            jsonschema_validators.validate(json_body, schema)
         except Exception as ex:
             msg_fmt = "Error parsing/validating JSON request body - %s"
             _logger.debug(msg_fmt, ex)
@@ -252,14 +1104,18 @@ class RequestHandler(tornado.web.RequestHandler):
         with the response body and can still do so. This method
         is a replacement for self.write(). This method calls
         self.write() after validating the response body against
-        a jsonschema.
+        a jsonschema. Whether or not the response body is actually
+        validated is determined by ```response_validation_policy```.
         """
-        try:
-            jsonschema.validate(json_body, schema)
-        except Exception as ex:
-            msg = "Error validating json body before calling 'write()' - %s"
-            _logger.error(msg, ex)
-            return False
+        policy = response_validation_policy
+        if policy.should_validate(schema):
+            try:
+                jsonschema_validators.validate(json_body, schema)
+            except Exception as ex:
+                policy.num_failures += 1
+                msg = "Error validating json body before calling 'write()' - %s"
+                _logger.error(msg, ex)
+                return False
 
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.write(json.dumps(json_body))
@@ -275,9 +1131,7 @@ class RequestHandler(tornado.web.RequestHandler):
             3/ set status to bad request
             4/ possibily set the debug details header
         """
-        self.set_header('Content-Type', 'application/json; charset=UTF-8')
-        self.write({})
-        self.set_status(httplib.BAD_REQUEST)
+        _canned_response(httplib.BAD_REQUEST).write(self)
         if debug_details is not None:
             self.add_debug_details(debug_details)
 
@@ -288,6 +1142,16 @@ class RequestHandler(tornado.web.RequestHandler):
     GBAC_BAD_B64_ENCODING = 0x0003
     GBAC_INVALID_USERNAME_PASSWORD = 0x0004
 
+    """Used by ```get_basic_auth_creds()``` to parse the Authorization header."""
+    _basic_auth_hdr_val_reg_ex = re.compile(
+        r"^\s*BASIC\s+(?P<auth_hdr_val>[^\s]+)\s*$",
+        re.IGNORECASE)
+
+    """Used by ```get_basic_auth_creds()``` to parse decoded credentials."""
+    _basic_auth_creds_reg_ex = re.compile(
+        r"^\s*(?P<username>[^:]+):(?P<password>[^\s]+)\s*$",
+        re.IGNORECASE)
+
     def get_basic_auth_creds(self):
         """Assuming BASIC auth is being used, returns the username
         and password (as a pair) after extracting and decoding
@@ -298,9 +1162,7 @@ class RequestHandler(tornado.web.RequestHandler):
         if auth_hdr_val is None:
             return (None, None, self.GBAC_NO_AUTHORIZATION_HEADER)
 
-        pattern = r"^\s*BASIC\s+(?P<auth_hdr_val>[^\s]+)\s*$"
-        reg_ex = re.compile(pattern, re.IGNORECASE)
-        match = reg_ex.match(auth_hdr_val)
+        match = type(self)._basic_auth_hdr_val_reg_ex.match(auth_hdr_val)
         if not match:
             return (None, None, self.GBAC_INVALID_AUTHORIZATION_HEADER_VALUE)
 
@@ -311,9 +1173,7 @@ class RequestHandler(tornado.web.RequestHandler):
         except Exception:
             return (None, None, self.GBAC_BAD_B64_ENCODING)
 
-        pattern = r"^\s*(?P<username>[^:]+):(?P<password>[^\s]+)\s*$"
-        reg_ex = re.compile(pattern, re.IGNORECASE)
-        match = reg_ex.match(auth_hdr_val)
+        match = type(self)._basic_auth_creds_reg_ex.match(auth_hdr_val)
         if not match:
             return (None, None, self.GBAC_INVALID_USERNAME_PASSWORD)
 
@@ -321,101 +1181,402 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def set_status(self, status_code, reason=None):
         # Python 2.7.3 doesn't support webdav status codes such as 422.
-        # See http://bugs.python.org/issue15025
-        responses = dict(httplib.responses)
-        responses.update({
-            102: 'Processing',
-            207: 'Multi-Status',
-            226: 'IM Used',
-            422: 'Unprocessable Entity',
-            423: 'Locked',
-            424: 'Failed Dependency',
-            426: 'Upgrade Required',
-            507: 'Insufficient Storage',
-            510: 'Not Extended',
-        })
+        # See http://bugs.python.org/issue15025 and _status_code_reasons
         if not reason:
             try:
-                reason = responses[status_code]
+                reason = _status_code_reasons[status_code]
             except KeyError:
                 raise ValueError("unknown status code %d", status_code)
         return super(RequestHandler, self).set_status(status_code, reason)
 
     def prepare(self):
-        """Overwritten to log requests."""
-        request = ["%s %s" % (self.request.method, self.request.full_url())]
-        for key, value in self.request.headers.items():
-            request.append("%s: %s" % (key, value))
-        request.append(self.request.body)
-        request = "\n".join(request)
-        _logger.debug("Received Request:\n%s", request)
+        """Overwritten to log requests. See ```RequestResponseLoggingPolicy```
+        for details on which requests are logged.
+        """
+        if not _logger.isEnabledFor(logging.DEBUG):
+            return
+
+        policy = request_response_logging_policy
+        self._log_request_and_response = policy.should_log(self)
+        if self._log_request_and_response:
+            _logger.debug("Received Request:\n%s", policy.format_request(self.request))
 
     def flush(self, include_footers=False, callback=None):
-        """Overwritten to log responses."""
-        headers = "\n" + "\n".join(
-            ["%s: %s" % (key, value) for key, value in self._headers.items()])
-        body = "".join(self._write_buffer)
-        _logger.debug("Sending Response:%s%s", headers, body)
+        """Overwritten to log responses. Responses are only logged
+        if the corresponding request was logged.
+        """
+        if self._log_request_and_response and _logger.isEnabledFor(logging.DEBUG):
+            response = request_response_logging_policy.format_response(self._headers, self._write_buffer)
+            _logger.debug("Sending Response:%s", response)
         return super(RequestHandler, self).flush(include_footers, callback)
 
+    def on_finish(self):
+        """Overwritten to record the request's count and duration
+        in ```metrics_registry```. Subclasses which override ```on_finish()```
+        should call this method.
+        """
+        handler = type(self).__name__
+        _requests_total.inc((handler, self.request.method, str(self.get_status())))
+        _request_duration_seconds.observe(self.request.request_time(), (handler,))
+
     def write_error(self, status_code, **kwargs):
         """Override write_error() to generate a json rather than html
         response on error.
         """
-        if self.request.method != "HEAD":
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
-            self.write({})
-        self.set_status(status_code)
+        _canned_response(status_code).write(self, self.request.method != "HEAD")
 
 
-class Config(object):
-    """```Config``` is a thin wrapper around
-    ```ConfigParser.ConfigParser```.
+class _LRUCache(object):
+    """A bounded cache which evicts the least recently used entry
+    when full and (optionally) expires entries ```ttl``` seconds after
+    they're added.
     """
 
-    """```instance``` is intended to enable implementation
-    of the Singleton pattern for an instance of ```Config```.
-    The following illustrates how ```instance``` was intended
-    to be used:
+    def __init__(self, max_size=1024, ttl=None, clock=time.time):
+        object.__init__(self)
 
-        .
-        .
-        .
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
 
-        if __name__ == "__main__":
-            clp = CommandLineParser()
-            (clo, cla) = clp.parse_args()
+        self._entries = collections.OrderedDict()
 
-            Config.instance = Config(clo.config)
-            config_section = "some_section"
+    def __len__(self):
+        return len(self._entries)
 
-            .
-            .
-            .
-    """
-    instance = None
+    def get(self, key, value_if_not_found=None):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return value_if_not_found
 
-    """Used to determine if a string represents an integer value."""
-    _int_reg_ex = re.compile(
-        r"^\-{0,1}\d+$",
-        re.IGNORECASE)
+        (value, expires_at) = entry
+        if expires_at is not None and expires_at <= self.clock():
+            return value_if_not_found
 
-    """Used to determine if a string represents a "true" boolean value."""
-    _true_reg_ex = re.compile(
-        r"^(true|t|y|yes|1)$",
-        re.IGNORECASE)
+        # re-insert so the entry becomes the most recently used
+        self._entries[key] = entry
+        return value
 
-    """Used to determine if a string represents a "false" boolean value."""
-    _false_reg_ex = re.compile(
-        r"^(false|f|n|no|0)$",
-        re.IGNORECASE)
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        if self.max_size <= len(self._entries):
+            self._entries.popitem(last=False)
+        expires_at = None if self.ttl is None else self.clock() + self.ttl
+        self._entries[key] = (value, expires_at)
 
-    """Used to turn a logging level string into a logging level."""
-    _logging_level_reg_ex = re.compile(
-        r"^(DEBUG|INFO|WARNING|ERROR|CRITICAL|FATAL)$",
-        re.IGNORECASE)
+    def remove(self, key):
+        self._entries.pop(key, None)
 
-    def __init__(self, config_file):
+    def clear(self):
+        self._entries.clear()
+
+
+"""```_compressed_bodies``` caches compressed static response bodies keyed
+by (compression level, body). See ```RequestHandler.set_static_response()```.
+"""
+_compressed_bodies = _LRUCache(max_size=256)
+
+
+class BasicAuthenticator(object):
+    """```RequestHandler.get_basic_auth_creds()``` only extracts credentials
+    which leaves every service to verify those credentials on every request.
+    Verifying a password (bcrypt, scrypt, etc) is intentionally expensive.
+    ```BasicAuthenticator``` verifies credentials using a pluggable
+    ```verifier``` and caches the result so the expensive check is only
+    done once per ```cache_ttl``` seconds for a given Authorization header.
+
+    ```verifier``` is called with a username and password and should return
+    a principal (anything other than None) if the credentials are valid
+    or None if they're not. If ```is_verifier_slow``` is True the verifier is
+    run on a thread pool of ```max_workers``` threads so the IOLoop isn't
+    blocked.
+
+    Caches are keyed by a digest of the Authorization header rather than
+    by the header itself so credentials aren't kept in memory. Failed
+    authentications are remembered in a negative cache for
+    ```negative_cache_ttl``` seconds so repeated bad credentials (think brute
+    force attacks) are rejected without calling ```verifier```.
+    Concurrent requests with the same Authorization header share
+    a single call to ```verifier```.
+
+    Expected usage
+
+        def verifier(username, password):
+            ...
+            return username if is_ok else None
+
+        authenticator = tor_async_util.BasicAuthenticator(verifier, is_verifier_slow=True)
+
+        class SomethingRequestHandler(tor_async_util.RequestHandler):
+
+            @tornado.web.asynchronous
+            def get(self):
+                authenticator.authenticate(self, self._on_authenticate_done)
+
+            def _on_authenticate_done(self, principal, error_code, request_handler):
+                if principal is None:
+                    self.set_status(httplib.UNAUTHORIZED)
+                    self.add_debug_details(error_code)
+                    self.finish()
+                    return
+                ...
+    """
+
+    """Error codes (in addition to ```RequestHandler.GBAC_*```) passed
+    to ```authenticate()```'s callback.
+    """
+    VERIFICATION_FAILED = 0x0005
+    VERIFIER_ERROR = 0x0006
+
+    def __init__(self,
+                 verifier,
+                 is_verifier_slow=False,
+                 max_workers=4,
+                 cache_max_size=1024,
+                 cache_ttl=5 * 60,
+                 negative_cache_max_size=1024,
+                 negative_cache_ttl=30,
+                 clock=time.time):
+        object.__init__(self)
+
+        self.verifier = verifier
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers) if is_verifier_slow else None
+
+        self._cache = _LRUCache(cache_max_size, cache_ttl, clock)
+        self._negative_cache = _LRUCache(negative_cache_max_size, negative_cache_ttl, clock)
+
+        # digest of Authorization header -> list of callbacks waiting
+        # for the verifier to complete
+        self._in_flight = {}
+
+    def authenticate(self, request_handler, callback):
+        """Authenticate the request being processed by ```request_handler```.
+        On completion ```callback``` is called with the principal returned
+        by the verifier (None if authentication failed), an error code
+        and ```request_handler```.
+        """
+        auth_hdr_val = request_handler.request.headers.get('Authorization', None)
+        if auth_hdr_val is None:
+            callback(None, RequestHandler.GBAC_NO_AUTHORIZATION_HEADER, request_handler)
+            return
+
+        key = hashlib.sha256(tornado.escape.utf8(auth_hdr_val)).digest()
+
+        principal = self._cache.get(key)
+        if principal is not None:
+            callback(principal, RequestHandler.GBAC_OK, request_handler)
+            return
+
+        error_code = self._negative_cache.get(key)
+        if error_code is not None:
+            callback(None, error_code, request_handler)
+            return
+
+        callbacks = self._in_flight.get(key)
+        if callbacks is not None:
+            callbacks.append((callback, request_handler))
+            return
+
+        (username, password, error_code) = request_handler.get_basic_auth_creds()
+        if error_code != RequestHandler.GBAC_OK:
+            self._negative_cache.put(key, error_code)
+            callback(None, error_code, request_handler)
+            return
+
+        self._in_flight[key] = [(callback, request_handler)]
+
+        if self._executor is None:
+            try:
+                principal = self.verifier(username, password)
+            except Exception as ex:
+                self._on_verify_done(key, None, ex)
+            else:
+                self._on_verify_done(key, principal, None)
+            return
+
+        def on_future_done(future):
+            ex = future.exception()
+            self._on_verify_done(key, None if ex else future.result(), ex)
+
+        future = self._executor.submit(self.verifier, username, password)
+        IOLoop.current().add_future(future, on_future_done)
+
+    def _on_verify_done(self, key, principal, ex):
+        if ex is not None:
+            _logger.error("Error verifying credentials - %s", ex)
+            error_code = type(self).VERIFIER_ERROR
+        elif principal is None:
+            self._negative_cache.put(key, type(self).VERIFICATION_FAILED)
+            error_code = type(self).VERIFICATION_FAILED
+        else:
+            self._cache.put(key, principal)
+            error_code = RequestHandler.GBAC_OK
+
+        for (callback, request_handler) in self._in_flight.pop(key, []):
+            callback(principal, error_code, request_handler)
+
+    def clear(self):
+        """Forget all cached authentication results - useful when
+        credentials are changed or revoked.
+        """
+        self._cache.clear()
+        self._negative_cache.clear()
+
+
+class ConfigError(ValueError):
+    """Raised by ```Config.snapshot()``` when a config file doesn't
+    match the declared ```ConfigOption```s."""
+    pass
+
+
+"""Used by ```ConfigOption``` to indicate an option has no default."""
+_required = object()
+
+
+class ConfigOption(object):
+    """A ```ConfigOption``` declares an option that ```Config.snapshot()```
+    reads, converts and validates. ```type``` is one of ```STRING```, ```INT```,
+    ```BOOLEAN```, ```LOGGING_LEVEL```, ```RESPONSE_VALIDATION_POLICY```,
+    ```KEYCZAR_CRYPTER``` or ```KEYCZAR_SIGNER``` and determines which of
+    ```Config```'s getters is used to convert the option's value. If
+    ```default``` isn't supplied the option is required. The option's value
+    is available in the snapshot as ```snapshot.<section_name>.<name>```
+    where ```section_name``` defaults to ```section``` and ```name``` defaults
+    to ```option``` - supply them when ```section``` or ```option``` aren't
+    valid identifiers (think ```my-service``` or ```max-port```).
+    """
+
+    STRING = 'string'
+    INT = 'int'
+    BOOLEAN = 'boolean'
+    LOGGING_LEVEL = 'logging_level'
+    RESPONSE_VALIDATION_POLICY = 'response_validation_policy'
+    KEYCZAR_CRYPTER = 'keyczar_crypter'
+    KEYCZAR_SIGNER = 'keyczar_signer'
+
+    """Maps a type to the name of the ```Config``` method used to convert values."""
+    _getters = {
+        STRING: 'get',
+        INT: 'get_int',
+        BOOLEAN: 'get_boolean',
+        LOGGING_LEVEL: 'get_logging_level',
+        RESPONSE_VALIDATION_POLICY: 'get_response_validation_policy',
+        KEYCZAR_CRYPTER: 'get_keyczar_crypter',
+        KEYCZAR_SIGNER: 'get_keyczar_signer',
+    }
+
+    _identifier_reg_ex = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+    def __init__(self, section, option, type=STRING, default=_required, name=None, section_name=None):
+        object.__init__(self)
+
+        if type not in ConfigOption._getters:
+            raise ConfigError("unknown type '%s' for option '%s' in section '%s'" % (type, option, section))
+
+        section_name = section if section_name is None else section_name
+        if not ConfigOption._identifier_reg_ex.match(section_name):
+            raise ConfigError("section '%s' isn't a valid identifier - use section_name" % section_name)
+
+        name = option if name is None else name
+        if not ConfigOption._identifier_reg_ex.match(name):
+            raise ConfigError("option '%s' isn't a valid identifier - use name" % name)
+
+        self.section = section
+        self.option = option
+        self.type = type
+        self.default = default
+        self.name = name
+        self.section_name = section_name
+
+    @property
+    def is_required(self):
+        return self.default is _required
+
+
+class _FrozenConfigValues(object):
+    """Abstract base class for the immutable, slot based objects created
+    by ```Config.snapshot()```."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("config snapshots are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("config snapshots are immutable")
+
+    def __repr__(self):
+        values = ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+        return '%s(%s)' % (type(self).__name__, values)
+
+    @classmethod
+    def _create(cls, class_name, values):
+        frozen_class = type(class_name, (cls,), {'__slots__': tuple(values.keys())})
+        frozen_values = frozen_class()
+        for (name, value) in values.items():
+            object.__setattr__(frozen_values, name, value)
+        return frozen_values
+
+
+class Config(object):
+    """```Config``` is a thin wrapper around
+    ```ConfigParser.ConfigParser```.
+    """
+
+    """```instance``` is intended to enable implementation
+    of the Singleton pattern for an instance of ```Config```.
+    The following illustrates how ```instance``` was intended
+    to be used:
+
+        .
+        .
+        .
+
+        if __name__ == "__main__":
+            clp = CommandLineParser()
+            (clo, cla) = clp.parse_args()
+
+            Config.instance = Config(clo.config)
+            config_section = "some_section"
+
+            .
+            .
+            .
+    """
+    instance = None
+
+    """Used to determine if a string represents an integer value."""
+    _int_reg_ex = re.compile(
+        r"^\-{0,1}\d+$",
+        re.IGNORECASE)
+
+    """Used to determine if a string represents a "true" boolean value."""
+    _true_reg_ex = re.compile(
+        r"^(true|t|y|yes|1)$",
+        re.IGNORECASE)
+
+    """Used to determine if a string represents a "false" boolean value."""
+    _false_reg_ex = re.compile(
+        r"^(false|f|n|no|0)$",
+        re.IGNORECASE)
+
+    """Used to turn a logging level string into a logging level."""
+    _logging_level_reg_ex = re.compile(
+        r"^(DEBUG|INFO|WARNING|ERROR|CRITICAL|FATAL)$",
+        re.IGNORECASE)
+
+    """Used to parse the mode of a response validation policy."""
+    _response_validation_reg_ex = re.compile(
+        r"^(?P<mode>always|off|sample)(\s+(?P<sample_rate>\d+)){0,1}$",
+        re.IGNORECASE)
+
+    """Used to parse a schema's sample rate in a response validation policy."""
+    _schema_sample_rate_reg_ex = re.compile(
+        r"^(?P<title>[^:]+):\s*(?P<sample_rate>\d+)$",
+        re.IGNORECASE)
+
+    def __init__(self, config_file):
         """Create an instance of ```Config``` by reading the
         contents of the ini file ```config_file```.
         ```os.path.expanduser``` is used to transform ```config_file```
@@ -429,6 +1590,57 @@ class Config(object):
         self._config = ConfigParser.ConfigParser()
         self._config.read(self.config_file)
 
+    def snapshot(self, options):
+        """Read, convert and validate all ```options``` (an iterable of
+        ```ConfigOption```) and return an immutable snapshot of the values.
+        Each section is an attribute of the snapshot and each option is an
+        attribute of its section so reading a value is plain attribute
+        access - a good fit for code which reads config on every request:
+
+            options = [
+                tor_async_util.ConfigOption('service', 'port', tor_async_util.ConfigOption.INT, default=8000),
+                tor_async_util.ConfigOption('service', 'logging_level', tor_async_util.ConfigOption.LOGGING_LEVEL),
+            ]
+            config = tor_async_util.Config(clo.config).snapshot(options)
+            ...
+            config.service.port
+
+        Rather than falling back to defaults when values are invalid,
+        ```ConfigError``` is raised describing all missing and invalid values
+        so a bad config file fails fast at startup.
+        """
+        invalid = object()
+        sections = collections.OrderedDict()
+        errors = []
+
+        for option in options:
+            values = sections.setdefault(option.section_name, collections.OrderedDict())
+            if option.name in values:
+                errors.append("option '%s' in section '%s' declared more than once" % (option.name, option.section))
+                continue
+
+            if not self._config.has_option(option.section, option.option):
+                if option.is_required:
+                    errors.append("option '%s' not found in section '%s'" % (option.option, option.section))
+                values[option.name] = None if option.is_required else option.default
+                continue
+
+            getter = getattr(self, ConfigOption._getters[option.type])
+            value = getter(option.section, option.option, invalid)
+            if value is invalid:
+                errors.append("option '%s' in section '%s' isn't a valid %s" % (
+                    option.option,
+                    option.section,
+                    option.type.replace('_', ' ')))
+            values[option.name] = value
+
+        if errors:
+            raise ConfigError("invalid config file '%s' - %s" % (self.config_file, '; '.join(errors)))
+
+        return _FrozenConfigValues._create('ConfigSnapshot', collections.OrderedDict(
+            (section_name, _FrozenConfigValues._create('ConfigSection', values))
+            for (section_name, values) in sections.items()))
+
     def get_all_values(self, section, values_if_not_found=None):
         return self._config.items(section) if self._config.has_section(section) else values_if_not_found
 
@@ -464,17 +1676,62 @@ class Config(object):
 
         return getattr(logging, logging_level_as_str.upper())
 
+    def get_response_validation_policy(self, section, option, value_if_not_found=None):
+        """Creates and returns a ```ResponseValidationPolicy``` from
+        a section & option with a value in one of the following forms:
+
+            response_validation = always
+            response_validation = off
+            response_validation = sample 100
+            response_validation = sample 100, get health response: 1, get version response: 0
+
+        With the last form, the title of a schema is followed by a colon and
+        the 1-in-N sample rate for the schema. If the option isn't found or
+        the value isn't in one of the above forms ```value_if_not_found```
+        is returned.
+        """
+        value = self.get(section, option, None)
+        if value is None:
+            return value_if_not_found
+
+        entries = [entry.strip() for entry in value.split(',')]
+
+        match = type(self)._response_validation_reg_ex.match(entries[0])
+        if not match:
+            return value_if_not_found
+
+        mode = match.group('mode').lower()
+        sample_rate = match.group('sample_rate')
+        if mode == ResponseValidationPolicy.SAMPLE:
+            if sample_rate is None:
+                return value_if_not_found
+            sample_rate = int(sample_rate)
+        else:
+            if sample_rate is not None or 1 < len(entries):
+                return value_if_not_found
+            sample_rate = 1
+
+        schema_sample_rates = {}
+        for entry in entries[1:]:
+            match = type(self)._schema_sample_rate_reg_ex.match(entry)
+            if not match:
+                return value_if_not_found
+            schema_sample_rates[match.group('title').strip()] = int(match.group('sample_rate'))
+
+        return ResponseValidationPolicy(mode, sample_rate, schema_sample_rates)
+
     def get_keyczar_crypter(self, section, option, value_if_not_found=None):
         """Creates and returns the keyczar crypter who's key store is in the
         directory pointed to by section & option. If something doesn't
         get found or an error occurs during crypter creation, then
-        ```value_if_not_found``` is returned.
+        ```value_if_not_found``` is returned. Crypters are cached - see
+        ```KeyczarKeyStoreCache```.
         """
         dir_name = self.get(section, option, None)
         if not dir_name:
             return value_if_not_found
         try:
-            return keyczar.Crypter.Read(dir_name)
+            return keyczar_key_store_cache.get(keyczar.Crypter, dir_name)
         except Exception:
             return value_if_not_found
 
@@ -482,17 +1739,350 @@ class Config(object):
         """Creates and returns the keyczar signer who's key store is in the
         directory pointed to by section & option. If something doesn't
         get found or an error occurs during signer creation, then
-        ```value_if_not_found``` is returned.
+        ```value_if_not_found``` is returned. Signers are cached - see
+        ```KeyczarKeyStoreCache```.
         """
         dir_name = self.get(section, option, None)
         if not dir_name:
             return value_if_not_found
         try:
-            return keyczar.Signer.Read(dir_name)
+            return keyczar_key_store_cache.get(keyczar.Signer, dir_name)
         except Exception:
             return value_if_not_found
 
 
+class ConfigReloader(object):
+    """A ```ConfigReloader``` lets a service pick up changes to its config
+    file without restarting (and losing warm caches and connection pools):
+
+        * ```start()``` checks the config file every ```interval``` seconds
+          using ```os.stat()``` on the IOLoop - the config file is only
+          re-read when its modification time, size or inode changes
+        * ```install_sighup_handler()``` reloads the config file when the
+          process receives SIGHUP
+        * on reload a new ```Config``` is created and, if ```options``` were
+          supplied, validated with ```Config.snapshot()``` - if the new config
+          file is invalid an error is logged and the current config is kept
+        * the new ```Config``` (and snapshot) are swapped in with a single
+          assignment each - ```Config.instance``` is updated if it's the
+          current config - and then listeners are called with the new and
+          old ```Config```
+
+    Long lived components register listeners to adopt new values:
+
+        reloader = tor_async_util.ConfigReloader(Config.instance, options=options)
+        reloader.add_listener(on_config_reloaded)
+        reloader.start()
+        reloader.install_sighup_handler()
+    """
+
+    def __init__(self, config, interval=5.0, options=None):
+        object.__init__(self)
+
+        self.config = config
+        self.interval = interval
+        self.options = options
+        self.snapshot = config.snapshot(options) if options is not None else None
+
+        self._listeners = []
+        self._stat = self._stat_config_file()
+
+        self._periodic_callback = None
+
+    def add_listener(self, listener):
+        """```listener``` is called with the new and old ```Config``` after a reload."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def start(self):
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.check, self.interval * 1000)
+        self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def install_sighup_handler(self):
+        io_loop = IOLoop.current()
+
+        def sighup_handler(signal_number, frame):
+            io_loop.add_callback_from_signal(self.reload)
+
+        signal.signal(signal.SIGHUP, sighup_handler)
+
+    def _stat_config_file(self):
+        try:
+            stat = os.stat(self.config.config_file)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def check(self):
+        """Reload the config file if it has changed since it was last read."""
+        stat = self._stat_config_file()
+        if stat is None or stat == self._stat:
+            return
+        self.reload()
+
+    def reload(self):
+        """Re-read the config file. Returns True if the new config was
+        swapped in otherwise returns False.
+        """
+        self._stat = self._stat_config_file()
+
+        try:
+            new_config = Config(self.config.config_file)
+            # a missing, empty or truncated config file reads as no sections
+            if not new_config._config.sections():
+                raise ValueError("no sections found")
+            new_snapshot = new_config.snapshot(self.options) if self.options is not None else None
+        except Exception as ex:
+            _logger.error("Error reloading config file '%s' - %s", self.config.config_file, ex)
+            return False
+
+        old_config = self.config
+        self.config = new_config
+        self.snapshot = new_snapshot
+        if Config.instance is old_config:
+            Config.instance = new_config
+
+        _logger.info("Reloaded config file '%s'", new_config.config_file)
+
+        for listener in list(self._listeners):
+            try:
+                listener(new_config, old_config)
+            except Exception as ex:
+                _logger.error("Error notifying config listener - %s", ex)
+
+        return True
+
+
+class KeyczarKeyStoreCache(object):
+    """Reading a keyczar key store parses every key in the key store
+    so ```Config.get_keyczar_crypter()``` and ```Config.get_keyczar_signer()```
+    use a ```KeyczarKeyStoreCache``` to cache crypters and signers by key
+    store directory:
+
+        * a cached crypter or signer is used until its key store changes - a
+          key store has changed if the modification time, size or inode of the
+          key store directory or its meta file (which keyczart rewrites when
+          keys are added, promoted, demoted or revoked) have changed
+        * to avoid disk I/O on every call, key stores are checked for changes
+          at most once every ```check_interval``` seconds so key rotation is
+          picked up within ```check_interval``` seconds without a restart
+    """
+
+    def __init__(self, check_interval=1.0, clock=time.time):
+        object.__init__(self)
+
+        self.check_interval = check_interval
+        self._clock = clock
+
+        # (reader class, dir name) -> [crypter or signer, key store signature, time of last check]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _signature(self, dir_name):
+        signature = []
+        for path in [dir_name, os.path.join(dir_name, 'meta')]:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            signature.append((stat.st_mtime, stat.st_size, stat.st_ino))
+        return tuple(signature)
+
+    def get(self, reader_class, dir_name):
+        """Returns ```reader_class.Read(dir_name)``` (```reader_class``` is
+        ```keyczar.Crypter``` or ```keyczar.Signer```) reading the key
+        store only if it isn't cached or has changed. Exceptions raised
+        by ```reader_class.Read()``` are not caught.
+        """
+        key = (reader_class, dir_name)
+        now = self._clock()
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            if now - entry[2] < self.check_interval:
+                return entry[0]
+
+            signature = self._signature(dir_name)
+            if signature is not None and signature == entry[1]:
+                entry[2] = now
+                return entry[0]
+
+            _logger.info("keyczar key store '%s' changed", dir_name)
+            del self._entries[key]
+
+        signature = self._signature(dir_name)
+        reader = reader_class.Read(dir_name)
+        self._entries[key] = [reader, signature, now]
+        return reader
+
+    def clear(self):
+        self._entries.clear()
+
+
+"""```keyczar_key_store_cache``` is the ```KeyczarKeyStoreCache``` used by
+```Config.get_keyczar_crypter()``` and ```Config.get_keyczar_signer()```.
+"""
+keyczar_key_store_cache = KeyczarKeyStoreCache()
+
+
+_keyczar_queue_depth = metrics_registry.gauge(
+    'tor_async_util_keyczar_queue_depth',
+    'keyczar operations submitted to the keyczar executor but not yet complete by operation.',
+    ('operation',))
+
+_keyczar_queue_seconds = metrics_registry.histogram(
+    'tor_async_util_keyczar_queue_seconds',
+    'Time keyczar operations spent waiting for a keyczar executor thread by operation.',
+    ('operation',))
+
+_keyczar_duration_seconds = metrics_registry.histogram(
+    'tor_async_util_keyczar_duration_seconds',
+    'keyczar operation execution time by operation.',
+    ('operation',))
+
+
+"""```keyczar_max_workers``` is the number of threads in the executor
+returned by ```get_keyczar_executor()```. Changes only take effect if
+the executor hasn't yet been created.
+"""
+keyczar_max_workers = 4
+
+_keyczar_executor = None
+
+
+def get_keyczar_executor():
+    """Returns the ```concurrent.futures.ThreadPoolExecutor``` shared by
+    all ```AsyncKeyczar``` instances creating it on first use.
+    """
+    global _keyczar_executor
+    if _keyczar_executor is None:
+        _keyczar_executor = concurrent.futures.ThreadPoolExecutor(keyczar_max_workers)
+    return _keyczar_executor
+
+
+def _keyczar_call(method, args):
+    try:
+        return method(*args)
+    except Exception:
+        return None
+
+
+class AsyncKeyczar(object):
+    """keyczar operations are CPU bound so calling a crypter or signer
+    directly from a request handler blocks the IOLoop. ```AsyncKeyczar```
+    wraps a crypter or signer (typically returned by
+    ```Config.get_keyczar_crypter()``` or ```Config.get_keyczar_signer()```)
+    and runs operations on a bounded thread pool (```get_keyczar_executor()```
+    by default):
+
+        * ```encrypt()```, ```decrypt()```, ```sign()``` and ```verify()```
+          return a ```tornado.concurrent.Future``` which raises the operation's
+          exception, if any - if ```callback``` is supplied it's called with
+          the operation's result (None if the operation raised an exception)
+          and the ```AsyncKeyczar``` and the future's result is the same result
+        * ```encrypt_batch()```, ```decrypt_batch()```, ```sign_batch()```
+          and ```verify_batch()``` run a list of operations as a single
+          executor task so a request which handles many tokens pays for
+          one thread hand-off rather than one per token - the result is
+          a list with None for each operation which raised an exception
+        * queue depth, time waiting for a thread and execution time are
+          recorded in ```metrics_registry``` by operation
+
+    ```AsyncKeyczar``` instances are cheap so create one per request from
+    the ```Config``` to pick up key rotation:
+
+        class SomethingRequestHandler(tor_async_util.RequestHandler):
+
+            @tornado.gen.coroutine
+            def get(self):
+                crypter = tor_async_util.AsyncKeyczar(config.get_keyczar_crypter('service', 'crypter'))
+                plaintext = yield crypter.decrypt(self.get_argument('token'))
+                ...
+    """
+
+    def __init__(self, reader, executor=None, clock=time.time):
+        object.__init__(self)
+
+        self.reader = reader
+        self.executor = executor
+        self._clock = clock
+
+    def encrypt(self, data, callback=None):
+        return self._submit('encrypt', self.reader.Encrypt, [(data,)], False, callback)
+
+    def decrypt(self, ciphertext, callback=None):
+        return self._submit('decrypt', self.reader.Decrypt, [(ciphertext,)], False, callback)
+
+    def sign(self, data, callback=None):
+        return self._submit('sign', self.reader.Sign, [(data,)], False, callback)
+
+    def verify(self, data, signature, callback=None):
+        return self._submit('verify', self.reader.Verify, [(data, signature)], False, callback)
+
+    def encrypt_batch(self, datas, callback=None):
+        args_list = [(data,) for data in datas]
+        return self._submit('encrypt_batch', self.reader.Encrypt, args_list, True, callback)
+
+    def decrypt_batch(self, ciphertexts, callback=None):
+        args_list = [(ciphertext,) for ciphertext in ciphertexts]
+        return self._submit('decrypt_batch', self.reader.Decrypt, args_list, True, callback)
+
+    def sign_batch(self, datas, callback=None):
+        args_list = [(data,) for data in datas]
+        return self._submit('sign_batch', self.reader.Sign, args_list, True, callback)
+
+    def verify_batch(self, datas_and_signatures, callback=None):
+        """```datas_and_signatures``` is a list of (data, signature) tuples."""
+        args_list = [tuple(data_and_signature) for data_and_signature in datas_and_signatures]
+        return self._submit('verify_batch', self.reader.Verify, args_list, True, callback)
+
+    def _submit(self, operation, method, args_list, is_batch, callback):
+        label_values = (operation,)
+        future = tornado.concurrent.Future()
+        submitted = self._clock()
+
+        def run():
+            started = self._clock()
+            if is_batch:
+                (result, ex) = ([_keyczar_call(method, args) for args in args_list], None)
+            else:
+                try:
+                    (result, ex) = (method(*args_list[0]), None)
+                except Exception as ex:
+                    result = None
+            return (result, ex, started, self._clock())
+
+        def on_executor_future_done(executor_future):
+            _keyczar_queue_depth.dec(label_values)
+
+            (result, ex, started, finished) = executor_future.result()
+            _keyczar_queue_seconds.observe(started - submitted, label_values)
+            _keyczar_duration_seconds.observe(finished - started, label_values)
+
+            if callback is not None:
+                future.set_result(result)
+                callback(result, self)
+            elif ex is None:
+                future.set_result(result)
+            else:
+                future.set_exception(ex)
+
+        _keyczar_queue_depth.inc(label_values)
+        executor = self.executor or get_keyczar_executor()
+        IOLoop.current().add_future(executor.submit(run), on_executor_future_done)
+
+        return future
+
+
 """```GVR_INVALID_RESPONSE_BODY``` is used in ```generate_version_response()```
 to indicate that an invalid response body has been generated. This should
 never happen!
@@ -535,6 +2125,7 @@ def generate_version_response(request_handler, version):
         request_handler.finish()
         return
 
+    request_handler.set_static_response()
     request_handler.set_header('Location', location)
 
     request_handler.set_status(httplib.OK)
@@ -582,12 +2173,38 @@ def generate_noop_response(request_handler):
         request_handler.finish()
         return
 
+    request_handler.set_static_response()
     request_handler.set_header('Location', location)
 
     request_handler.set_status(httplib.OK)
     request_handler.finish()
 
 
+def generate_metrics_response(request_handler, registry=None):
+    """This function encapsulates all the functionality required
+    to generate a response to a metrics request. The response body
+    is ```registry``` (```metrics_registry``` by default) rendered in
+    the Prometheus text format.
+
+        import tor_async_util
+
+        class ServiceMetricsRequestHandler(tor_async_util.RequestHandler):
+
+            url_spec = r'/v1.0/service/_metrics'
+
+            @tornado.web.asynchronous
+            def get(self):
+                tor_async_util.generate_metrics_response(self)
+    """
+    body = (registry or metrics_registry).render()
+
+    request_handler.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    request_handler.write(body)
+
+    request_handler.set_status(httplib.OK)
+    request_handler.finish()
+
+
 def _health_check_color(is_ok):
     """Used by ```generate_health_check_response()``` to turn
     a boolean into a color.
@@ -625,17 +2242,127 @@ never happen.
 HEALTH_CHECK_GDD_INVALID_RESPONSE_BODY = 0x0002
 
 
-def generate_health_check_response(request_handler, async_health_check_class):
-    """Every service should have a health check endpoint. For a more
-    complete exploration of what the health check endpoint should do
-    see the microservice architectural guidance.
-    ```generate_health_check_response()``` is intended to make it
-    super easy to implement a health check endpoint.
+"""Used by ```generate_health_check_response()``` to indicate
+in a debug details HTTP header that processing the request failed
+because the async health check's ```check()``` raised an exception.
+"""
+HEALTH_CHECK_GDD_CHECK_FAILED = 0x0003
 
-    Expected usage
 
-        import tor_async_util
-        from async_actions import AsyncHealthCheck
+"""Used by ```generate_health_check_response()``` to indicate
+in a debug details HTTP header that processing the request failed
+because the async health check didn't call back within
+```HealthCheckCache.in_flight_timeout``` seconds.
+"""
+HEALTH_CHECK_GDD_CHECK_TIMED_OUT = 0x0004
+
+
+class HealthCheckCache(object):
+    """Load balancers, orchestrators and dashboards tend to all hit
+    a service's health endpoint at the same time. ```HealthCheckCache```
+    is used by ```generate_health_check_response()``` to make sure
+    that these requests don't multiply the load on a service's dependencies:
+
+        * concurrent requests for the same health check (same async health
+          check class and same quick/deep tier) share a single in flight check
+        * results of quick and deep health checks are cached for ```quick_ttl```
+          and ```deep_ttl``` seconds respectively - a ttl of 0 disables caching -
+          and responses generated from cached results include an Age header
+        * if an in flight check raises an exception or doesn't call back
+          within ```in_flight_timeout``` seconds all waiting requests get an
+          error response and the next request starts a new check - an
+          ```in_flight_timeout``` of None disables the timeout
+
+    Caching is configured at startup:
+
+        tor_async_util.health_check_cache = tor_async_util.HealthCheckCache(quick_ttl=1, deep_ttl=10)
+    """
+
+    def __init__(self, quick_ttl=0, deep_ttl=0, in_flight_timeout=30, clock=time.time):
+        object.__init__(self)
+
+        self.quick_ttl = quick_ttl
+        self.deep_ttl = deep_ttl
+        self.in_flight_timeout = in_flight_timeout
+        self.clock = clock
+
+        # (async health check class, is quick) -> (details, time details were cached)
+        self._results = {}
+        # (async health check class, is quick) -> request handlers waiting for details
+        self._in_flight = {}
+
+    def _ttl(self, key):
+        (_, is_quick) = key
+        return self.quick_ttl if is_quick else self.deep_ttl
+
+    def get(self, key):
+        """Returns a (details, age) pair if there are unexpired cached
+        results for ```key``` otherwise returns None.
+        """
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+
+        (details, cached_at) = entry
+        age = self.clock() - cached_at
+        if self._ttl(key) <= age:
+            del self._results[key]
+            return None
+
+        return (details, age)
+
+    def start(self, key, request_handler):
+        """Returns True if the caller should start a health check
+        for ```key``` or False if a health check for ```key``` is
+        already in flight in which case ```request_handler``` will be
+        returned by ```finish()``` when the in flight check completes.
+        """
+        request_handlers = self._in_flight.get(key)
+        if request_handlers is not None:
+            request_handlers.append(request_handler)
+            return False
+
+        self._in_flight[key] = [request_handler]
+        return True
+
+    def finish(self, key, details):
+        """Record the results of the in flight health check for ```key```
+        and return the list of request handlers waiting for the results.
+        """
+        if 0 < self._ttl(key):
+            self._results[key] = (details, self.clock())
+
+        return self._in_flight.pop(key, [])
+
+    def abandon(self, key):
+        """The in flight health check for ```key``` failed - return the
+        list of request handlers waiting for its results without caching
+        anything.
+        """
+        return self._in_flight.pop(key, [])
+
+    def clear(self):
+        self._results.clear()
+
+
+"""```health_check_cache``` is the ```HealthCheckCache``` used by
+```generate_health_check_response()```. By default results aren't
+cached but concurrent requests are coalesced.
+"""
+health_check_cache = HealthCheckCache()
+
+
+def generate_health_check_response(request_handler, async_health_check_class):
+    """Every service should have a health check endpoint. For a more
+    complete exploration of what the health check endpoint should do
+    see the microservice architectural guidance.
+    ```generate_health_check_response()``` is intended to make it
+    super easy to implement a health check endpoint.
+
+    Expected usage
+
+        import tor_async_util
+        from async_actions import AsyncHealthCheck
 
         .
         .
@@ -679,17 +2406,99 @@ def generate_health_check_response(request_handler, async_health_check_class):
         request_handler.finish()
         return
 
+    key = (async_health_check_class, is_quick)
+
+    cached = health_check_cache.get(key)
+    if cached is not None:
+        (details, age) = cached
+        _health_check_write_response(request_handler, details, age)
+        return
+
+    if not health_check_cache.start(key, request_handler):
+        # an identical health check is already in flight
+        return
+
+    io_loop = IOLoop.current()
+    timeout = None
+    is_done = []
+
+    def on_check_done(details, ahc):
+        if is_done:
+            return
+        is_done.append(True)
+        if timeout is not None:
+            io_loop.remove_timeout(timeout)
+        _health_check_on_ahc_check_done(key, details, ahc)
+
+    def on_check_failed(status_code, debug_details):
+        if is_done:
+            return
+        is_done.append(True)
+        if timeout is not None:
+            io_loop.remove_timeout(timeout)
+        for waiting_request_handler in health_check_cache.abandon(key):
+            try:
+                waiting_request_handler.add_debug_details(debug_details)
+                waiting_request_handler.set_status(status_code)
+                waiting_request_handler.finish()
+            except Exception as ex:
+                _logger.error("Error writing health check response - %s", ex)
+
+    if health_check_cache.in_flight_timeout is not None:
+        timeout = io_loop.call_later(
+            health_check_cache.in_flight_timeout,
+            on_check_failed,
+            httplib.SERVICE_UNAVAILABLE,
+            HEALTH_CHECK_GDD_CHECK_TIMED_OUT)
+
     ahc = async_health_check_class(is_quick, async_state=request_handler)
-    ahc.check(_health_check_on_ahc_check_done)
+    try:
+        ahc.check(on_check_done)
+    except Exception as ex:
+        _logger.error("Error running health check - %s", ex)
+        on_check_failed(httplib.INTERNAL_SERVER_ERROR, HEALTH_CHECK_GDD_CHECK_FAILED)
+
+
+def generate_polled_health_check_response(request_handler, health_check_poller):
+    """An alternative to ```generate_health_check_response()``` which
+    responds using the most recent results of ```health_check_poller```
+    rather than running a health check. Until the poller's first health
+    check completes ```generate_health_check_response()``` is used.
+    See ```HealthCheckPoller``` for details.
+    """
+    is_quick = _health_check_is_quick(request_handler)
+    if is_quick is None:
+        request_handler.write_bad_request_response(HEALTH_CHECK_GDD_INVALID_QUICK_ARGUMENT)
+        request_handler.finish()
+        return
+
+    snapshot = health_check_poller.snapshot(is_quick)
+    if snapshot is None:
+        generate_health_check_response(request_handler, health_check_poller.async_health_check_class)
+        return
+
+    snapshot.write(request_handler, health_check_poller.clock() - snapshot.created_at)
 
 
-def _health_check_on_ahc_check_done(details, ahc):
+def _health_check_on_ahc_check_done(key, details, ahc):
     """```_health_check_on_ahc_check_done()``` is an async callback used
     by ```generate_health_check_response()``` to finish processing of an
-    async health check request.
+    async health check request and all the identical requests which
+    arrived while the health check was in flight.
     """
-    request_handler = ahc.async_state
+    for request_handler in health_check_cache.finish(key, details):
+        try:
+            _health_check_write_response(request_handler, details)
+        except Exception as ex:
+            _logger.error("Error writing health check response - %s", ex)
 
+
+def _health_check_write_response(request_handler, details, age=None):
+    """Used by ```generate_health_check_response()``` to write
+    a health check response. If the response was generated from
+    cached health check results ```age``` is the age of the results
+    in seconds and is returned in the response's Age header.
+    """
     location = '%s://%s%s' % (
         request_handler.request.protocol,
         request_handler.request.host,
@@ -713,6 +2522,9 @@ def _health_check_on_ahc_check_done(details, ahc):
 
     request_handler.set_header('location', location)
 
+    if age is not None:
+        request_handler.set_header('Age', int(age))
+
     status = httplib.OK if body['status'] == _health_check_color(True) else httplib.SERVICE_UNAVAILABLE
     request_handler.set_status(status)
 
@@ -802,13 +2614,380 @@ def _health_check_gen_response_body(details):
     return rv
 
 
+class _HealthCheckSnapshot(object):
+    """A ```_HealthCheckSnapshot``` is created by ```HealthCheckPoller```
+    and contains a pre-validated and pre-serialized health check response.
+    The only part of a health check response which varies by request is the
+    self link so the snapshot holds the serialized body less the links and
+    ```write()``` splices in the (json encoded) self link.
+    """
+
+    _body_prefix = '{"links": {"self": {"href": '
+
+    def __init__(self, details, created_at):
+        object.__init__(self)
+
+        self.created_at = created_at
+
+        body = _health_check_gen_response_body(details)
+
+        try:
+            body_with_links = {
+                'links': {
+                    'self': {
+                        'href': 'http://localhost/_health',
+                    },
+                },
+            }
+            body_with_links.update(body)
+            jsonschema_validators.validate(body_with_links, jsonschemas.get_health_response)
+            self.is_valid = True
+        except Exception as ex:
+            _logger.error("Error validating polled health check response body - %s", ex)
+            self.is_valid = False
+
+        self.status_code = httplib.OK if body['status'] == _health_check_color(True) else httplib.SERVICE_UNAVAILABLE
+        self.body_suffix = '}}, ' + json.dumps(body)[1:]
+
+    def write(self, request_handler, age):
+        if not self.is_valid:
+            request_handler.add_debug_details(HEALTH_CHECK_GDD_INVALID_RESPONSE_BODY)
+            request_handler.set_status(httplib.INTERNAL_SERVER_ERROR)
+            request_handler.finish()
+            return
+
+        location = '%s://%s%s' % (
+            request_handler.request.protocol,
+            request_handler.request.host,
+            request_handler.request.path,
+        )
+
+        request_handler.set_header('Content-Type', 'application/json; charset=UTF-8')
+        request_handler.write(type(self)._body_prefix + json.dumps(location) + self.body_suffix)
+        request_handler.set_header('location', location)
+        request_handler.set_header('Age', int(age))
+        request_handler.set_status(self.status_code)
+        request_handler.finish()
+
+
+class HealthCheckPoller(object):
+    """Rather than running health checks on the request path
+    a ```HealthCheckPoller``` runs quick and deep health checks on
+    a fixed schedule (every ```interval``` seconds) and keeps a snapshot
+    of the most recent response for each. The health endpoint then
+    uses ```generate_polled_health_check_response()``` to write the
+    snapshot so health endpoint latency is constant regardless of how
+    slow a service's dependencies are and the rate at which dependencies
+    are probed is fixed regardless of how many callers use the health endpoint.
+
+    Note that health checks run by a ```HealthCheckPoller``` have the
+    poller rather than a request handler as their ```async_state```.
+
+    A health check which doesn't call back within ```timeout``` seconds
+    is abandoned (a late callback is ignored) and recorded as a red
+    snapshot so a hung dependency can't leave the last (possibly green)
+    snapshot being served forever.
+
+        poller = tor_async_util.HealthCheckPoller(AsyncHealthCheck, interval=5)
+
+        class HealthRequestHandler(tor_async_util.RequestHandler):
+
+            url_spec = r'/v1.0/something/_health'
+
+            @tornado.web.asynchronous
+            def get(self):
+                tor_async_util.generate_polled_health_check_response(self, poller)
+
+        if __name__ == "__main__":
+            ...
+            poller.start()
+            tornado.ioloop.IOLoop.current().start()
+    """
+
+    """Name of the red component in the snapshot recorded when a health check times out."""
+    timed_out_component_name = 'health_check'
+
+    def __init__(self, async_health_check_class, interval=10.0, timeout=30.0, clock=time.time):
+        object.__init__(self)
+
+        self.async_health_check_class = async_health_check_class
+        self.interval = interval
+        self.timeout = timeout
+        self.clock = clock
+
+        # is quick -> _HealthCheckSnapshot
+        self._snapshots = {}
+        # is quick -> timeout handle of the health check which is in flight
+        self._in_flight = {}
+
+        self._periodic_callback = None
+
+    def start(self):
+        """Poll immediately and then every ```interval``` seconds."""
+        self.poll()
+        self._periodic_callback = tornado.ioloop.PeriodicCallback(self.poll, self.interval * 1000)
+        self._periodic_callback.start()
+
+    def stop(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.stop()
+            self._periodic_callback = None
+
+    def poll(self):
+        for is_quick in (True, False):
+            # don't pile up checks if the previous check hasn't completed
+            if is_quick in self._in_flight:
+                continue
+
+            in_flight = IOLoop.current().call_later(self.timeout, self._on_check_timeout, is_quick)
+            self._in_flight[is_quick] = in_flight
+            try:
+                ahc = self.async_health_check_class(is_quick, async_state=self)
+                ahc.check(functools.partial(self._on_check_done, is_quick, in_flight))
+            except Exception as ex:
+                _logger.error("Error polling health check - %s", ex)
+                self._in_flight.pop(is_quick, None)
+                IOLoop.current().remove_timeout(in_flight)
+
+    def _on_check_done(self, is_quick, in_flight, details, ahc):
+        if self._in_flight.get(is_quick) is not in_flight:
+            # health check timed out
+            return
+        del self._in_flight[is_quick]
+        IOLoop.current().remove_timeout(in_flight)
+        self._snapshots[is_quick] = _HealthCheckSnapshot(details, self.clock())
+
+    def _on_check_timeout(self, is_quick):
+        _logger.error("Polled %s health check timed out", 'quick' if is_quick else 'deep')
+        del self._in_flight[is_quick]
+        details = [
+            ComponentHealth(type(self).timed_out_component_name, is_ok=False),
+        ]
+        self._snapshots[is_quick] = _HealthCheckSnapshot(details, self.clock())
+
+    def snapshot(self, is_quick):
+        """Returns the most recent ```_HealthCheckSnapshot``` for
+        the quick/deep tier or None if there isn't a snapshot yet.
+        """
+        return self._snapshots.get(is_quick)
+
+
+class LatencyHistogram(object):
+    """A fixed memory, log bucketed (HDR style) histogram of latencies.
+    Latencies are recorded in milliseconds with microsecond resolution.
+    Each power of 2 range of microseconds is split into ```2 ** (sub_bucket_bits - 1)```
+    linear sub-buckets so the relative error of reported percentiles is
+    at most ```1 / 2 ** (sub_bucket_bits - 1)``` (about 6% with the
+    default of 5 sub-bucket bits). Latencies greater than
+    ```2 ** max_bits``` microseconds (about 19 hours with the default
+    of 36 max bits) are recorded as ```2 ** max_bits``` microseconds.
+    """
+
+    def __init__(self, sub_bucket_bits=5, max_bits=36):
+        object.__init__(self)
+
+        self._sub_bucket_bits = sub_bucket_bits
+        self._half_sub_bucket_count = 2 ** (sub_bucket_bits - 1)
+        self._max_value = 2 ** max_bits
+
+        self._counts = array.array('L', [0]) * (self._bucket_index(self._max_value) + 1)
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket_index(self, value):
+        exponent = max(0, value.bit_length() - self._sub_bucket_bits)
+        return exponent * self._half_sub_bucket_count + (value >> exponent)
+
+    def _bucket_value(self, index):
+        """Returns the value (in microseconds) in the middle of
+        the bucket with index ```index```.
+        """
+        exponent = max(0, index // self._half_sub_bucket_count - 1)
+        lower_bound = (index - exponent * self._half_sub_bucket_count) << exponent
+        return lower_bound + ((1 << exponent) - 1) / 2.0
+
+    def record(self, value_in_ms):
+        value = min(max(int(value_in_ms * 1000), 0), self._max_value)
+        self._counts[self._bucket_index(value)] += 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or self.max < value:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Returns the latency in milliseconds at ```percentile```
+        (0.0 to 100.0) or None if nothing has been recorded.
+        """
+        if not self.count:
+            return None
+
+        threshold = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        cumulative_count = 0
+        for (index, count) in enumerate(self._counts):
+            cumulative_count += count
+            if threshold <= cumulative_count:
+                value = min(max(self._bucket_value(index), self.min), self.max)
+                return value / 1000.0
+
+        return self.max / 1000.0
+
+    def snapshot(self):
+        """Returns a dict summarizing the histogram. All times are in milliseconds."""
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'min': self.min / 1000.0,
+            'max': self.max / 1000.0,
+            'mean': self.total / 1000.0 / self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+    def reset(self):
+        for index in range(len(self._counts)):
+            self._counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+
+class HTTPClientLatencyHistograms(object):
+    """```AsyncAction.create_log_msg_for_http_client_response()``` records
+    the request time and the cURL timing phases of each response in a
+    ```HTTPClientLatencyHistograms``` so percentiles per downstream service
+    are available without having to parse logs. Histograms are keyed by
+    service name and status class (2xx, 4xx, 5xx, etc).
+
+        snapshot = tor_async_util.http_client_latency_histograms.snapshot()
+        p99 = snapshot[('my service', '2xx')]['request_time']['p99']
+    """
+
+    """The names of the timings recorded for each response. See
+    ```AsyncAction.create_log_msg_for_http_client_response()```.
+    """
+    phases = (
+        'request_time',
+        'queue',
+        'namelookup',
+        'connect',
+        'pretransfer',
+        'starttransfer',
+        'total',
+        'redirect',
+    )
+
+    def __init__(self, sub_bucket_bits=5, max_bits=36):
+        object.__init__(self)
+
+        self._sub_bucket_bits = sub_bucket_bits
+        self._max_bits = max_bits
+
+        # (service, status class) -> phase -> LatencyHistogram
+        self._histograms = {}
+
+    def _histograms_for(self, service, status_class):
+        key = (service, status_class)
+        histograms = self._histograms.get(key)
+        if histograms is None:
+            histograms = {}
+            for phase in type(self).phases:
+                histograms[phase] = LatencyHistogram(self._sub_bucket_bits, self._max_bits)
+            self._histograms[key] = histograms
+        return histograms
+
+    def record(self, response, service):
+        """Record the timings of ```response``` (a ```tornado.httpclient.HTTPResponse```)."""
+        histograms = self._histograms_for(service, '%dxx' % (response.code // 100))
+        histograms['request_time'].record(response.request_time * 1000)
+        time_info = response.time_info
+        for phase in type(self).phases[1:]:
+            if phase in time_info:
+                histograms[phase].record(time_info[phase] * 1000)
+
+    def snapshot(self, reset=False):
+        """Returns a dict keyed by (service, status class) pairs. Each value
+        is a dict keyed by phase with ```LatencyHistogram.snapshot()``` values.
+        If ```reset``` is True all histograms are reset after the snapshot is taken.
+        """
+        rv = {}
+        for (key, histograms) in self._histograms.items():
+            rv[key] = dict((phase, histogram.snapshot()) for (phase, histogram) in histograms.items())
+        if reset:
+            self.reset()
+        return rv
+
+    def reset(self):
+        for histograms in self._histograms.values():
+            for histogram in histograms.values():
+                histogram.reset()
+
+
+"""```http_client_latency_histograms``` is the ```HTTPClientLatencyHistograms```
+used by ```AsyncAction.create_log_msg_for_http_client_response()```.
+"""
+http_client_latency_histograms = HTTPClientLatencyHistograms()
+
+
+class AsyncActionIdGenerator(object):
+    """```AsyncAction``` instances are assigned a unique id which
+    is useful for logging and debugging. ```uuid.uuid4()``` requires
+    a call to ```os.urandom()``` (a syscall) and a bunch of formatting for
+    each id. ```AsyncActionIdGenerator``` generates ids that look like
+    ```uuid.uuid4().hex``` (32 hex digits) but which are a per process random
+    prefix followed by a counter. The prefix is regenerated when the
+    generator finds itself in a new process so ids are unique across forked
+    workers.
+    """
+
+    def __init__(self):
+        object.__init__(self)
+
+        self._pid = None
+        self._prefix = None
+        self._counter = None
+
+    def __call__(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._prefix = binascii.hexlify(os.urandom(8))
+            self._counter = itertools.count()
+        return '%s%016x' % (self._prefix, next(self._counter))
+
+
+def uuid4_async_action_id_generator():
+    """An alternative to ```AsyncActionIdGenerator```
+    which generates ```uuid.uuid4()``` based ids."""
+    return uuid.uuid4().hex
+
+
+"""```async_action_id_generator``` is called by ```AsyncAction.__init__()```
+to generate an id for each ```AsyncAction```. Any callable returning a string
+can be used. For example, to revert to uuid4 based ids:
+
+    tor_async_util.async_action_id_generator = tor_async_util.uuid4_async_action_id_generator
+"""
+async_action_id_generator = AsyncActionIdGenerator()
+
+
 class AsyncAction(object):
     """Abstract base class for any async actions."""
 
     def __init__(self, async_state=None):
         object.__init__(self)
 
-        self.id = uuid.uuid4().hex
+        self.id = async_action_id_generator()
 
         self.async_state = async_state
 
@@ -826,7 +3005,12 @@ class AsyncAction(object):
         of these timing details can be found at
         http://curl.haxx.se/libcurl/c/curl_easy_getinfo.html#TIMES
         and it is these detailed timings which are written to ```logger```
+
+        The timings are also recorded in ```http_client_latency_histograms```
+        and ```metrics_registry```.
         """
+        self.record_http_client_response(response, service)
+
         fmt = (
             '{service} took {request_time:.2f} ms to respond '
             'with {http_response_code:d} to {http_method} '
@@ -856,59 +3040,295 @@ class AsyncAction(object):
 
         return fmt.format(**msg_format_args)
 
+    def record_http_client_response(self, response, service):
+        """Record the timing details of ```response``` in
+        ```http_client_latency_histograms``` and ```metrics_registry```
+        without creating a log message.
+        """
+        http_client_latency_histograms.record(response, service)
+        _http_client_request_duration_seconds.observe(
+            response.request_time,
+            (service, '%dxx' % (response.code // 100)))
+
+
+class ComponentHealthCheck(object):
+    """A ```ComponentHealthCheck``` describes how to check the health of
+    a single component of a service. ```check``` is a function which takes
+    a single callback argument and, when the check is complete, calls the
+    callback with a ```ComponentHealth```. If the callback isn't called
+    within ```timeout``` seconds (or ```check``` raises an exception)
+    the component is reported as unhealthy. See
+    ```AsyncHealthCheck.register_component_health_check()```.
+    """
+
+    def __init__(self, name, check, timeout=5.0):
+        object.__init__(self)
+
+        self.name = name
+        self.check = check
+        self.timeout = timeout
+
 
 class AsyncHealthCheck(AsyncAction):
     """When a service uses ```generate_health_check_response()``` to implement
     a health check endpoint, it's entirely possible that an async class will
     not be required however ```generate_health_check_response()``` still
     requires an async class. Hence the creation of this super simple class.
+
+    Rather than implementing ```check()``` a service can register a check
+    for each component. For deep (not quick) health checks all component
+    checks are run concurrently, each with its own timeout, so the time
+    taken is that of the slowest component rather than the sum of all
+    components and a hung component is reported as unhealthy rather than
+    stalling the response.
+
+        def check_database(callback):
+            ...
+            callback(tor_async_util.ComponentHealth('database', is_ok=is_ok))
+
+        class ServiceHealthCheck(tor_async_util.AsyncHealthCheck):
+            pass
+
+        ServiceHealthCheck.register_component_health_check('database', check_database, timeout=2.0)
     """
 
+    component_health_checks = []
+
+    @classmethod
+    def register_component_health_check(cls, name, check, timeout=5.0):
+        # copy on first registration so registering a check with a
+        # subclass doesn't register the check with all subclasses
+        if 'component_health_checks' not in cls.__dict__:
+            cls.component_health_checks = list(cls.component_health_checks)
+        cls.component_health_checks.append(ComponentHealthCheck(name, check, timeout))
+
     def __init__(self, is_quick, async_state=None):
         AsyncAction.__init__(self, async_state)
 
         self.is_quick = is_quick
 
+        self._callback = None
+        self._component_healths = None
+        self._timeouts = None
+        self._num_pending = 0
+
     def check(self, callback):
-        callback(None, self)
+        component_health_checks = type(self).component_health_checks
+        if self.is_quick or not component_health_checks:
+            callback(None, self)
+            return
+
+        self._callback = callback
+        self._component_healths = [None] * len(component_health_checks)
+        self._timeouts = [None] * len(component_health_checks)
+        self._num_pending = len(component_health_checks)
+
+        io_loop = IOLoop.current()
+
+        for (index, component_health_check) in enumerate(component_health_checks):
+            self._timeouts[index] = io_loop.call_later(
+                component_health_check.timeout,
+                self._on_component_health_check_timeout,
+                index,
+                component_health_check)
+
+        for (index, component_health_check) in enumerate(component_health_checks):
+            def on_component_health_check_done(component_health, index=index):
+                self._on_component_health_check_done(index, component_health)
+
+            try:
+                component_health_check.check(on_component_health_check_done)
+            except Exception as ex:
+                _logger.error("Error checking health of '%s' - %s", component_health_check.name, ex)
+                on_component_health_check_done(ComponentHealth(component_health_check.name, is_ok=False))
+
+    def _on_component_health_check_timeout(self, index, component_health_check):
+        _logger.error("Timed out checking health of '%s'", component_health_check.name)
+        self._timeouts[index] = None
+        self._on_component_health_check_done(index, ComponentHealth(component_health_check.name, is_ok=False))
+
+    def _on_component_health_check_done(self, index, component_health):
+        if self._component_healths[index] is not None:
+            # component has already timed out or completed
+            return
+
+        if self._timeouts[index] is not None:
+            IOLoop.current().remove_timeout(self._timeouts[index])
+            self._timeouts[index] = None
+
+        self._component_healths[index] = component_health
+        self._num_pending -= 1
+        if self._num_pending:
+            return
+
+        callback = self._callback
+        self._callback = None
+        callback(self._component_healths, self)
+
+
+class RetryBudget(object):
+    """A ```RetryBudget``` is a token bucket shared by the
+    ```ExponentialBackoffRetryStrategy``` instances in a process which opt in
+    (```use_retry_budget``` - ```AsyncHTTPAction``` always does) to limit
+    retries to a percentage of requests so an outage of a downstream service
+    doesn't turn into a self-inflicted retry storm.
+
+        * each new ```ExponentialBackoffRetryStrategy``` (ie each request)
+          deposits ```retry_ratio``` tokens
+        * tokens also accrue at ```min_retries_per_second``` so services with
+          low request rates can still retry
+        * each retry withdraws 1 token - when there are no tokens the retry
+          is rejected
+        * the bucket never holds more than ```max_tokens``` tokens
+
+    With the defaults, once the initial tokens are spent, retries are limited
+    to about 20% of requests plus 10 retries per second.
+    """
+
+    def __init__(self, retry_ratio=0.2, min_retries_per_second=10, max_tokens=100, clock=time.time):
+        object.__init__(self)
+
+        self.retry_ratio = retry_ratio
+        self.min_retries_per_second = min_retries_per_second
+        self.max_tokens = max_tokens
+        self._clock = clock
+
+        self.tokens = float(max_tokens)
+        self._last_refill = clock()
+
+        self.num_retries_allowed = 0
+        self.num_retries_rejected = 0
+
+    def _refill(self, num_tokens):
+        self.tokens = min(self.max_tokens, self.tokens + num_tokens)
+
+    def deposit(self):
+        """Called once per request."""
+        self._refill(self.retry_ratio)
+
+    def withdraw(self):
+        """Called before each retry. Returns True if the retry is
+        within budget otherwise returns False.
+        """
+        now = self._clock()
+        self._refill(max(0, now - self._last_refill) * self.min_retries_per_second)
+        self._last_refill = now
+
+        if 1 <= self.tokens:
+            self.tokens -= 1
+            self.num_retries_allowed += 1
+            return True
+
+        self.num_retries_rejected += 1
+        return False
+
+
+"""```retry_budget``` is the process-wide ```RetryBudget``` used by
+```ExponentialBackoffRetryStrategy```. Set to None to disable.
+"""
+retry_budget = RetryBudget()
 
 
 class ExponentialBackoffRetryStrategy(object):
     """```ExponentialBackoffRetryStrategy``` implements a retry strategy
     that, as the name suggests, waits exponentially longer time as the
-    number of retry attempts increases. The specific time waited is calculated
-    with the formula:
+    number of retry attempts increases. How the specific time waited is
+    calculated depends on ```jitter```:
 
-        (2 ** retry_number) * 25 +/- random # between -10 & 10
+        * ```PLUS_MINUS_JITTER``` - (2 ** retry_number) * base_delay_in_ms +/- random # between -10 & 10
+        * ```FULL_JITTER``` - random # between 0 & (2 ** retry_number) * base_delay_in_ms
+        * ```DECORRELATED_JITTER``` - random # between base_delay_in_ms & 3 * previous wait time
+
+    ```PLUS_MINUS_JITTER``` is the default for backward compatibility but
+    does little to spread out retries from many clients which started
+    retrying at the same time - ```FULL_JITTER``` and ```DECORRELATED_JITTER```
+    are better choices when many clients retry against the same service.
+
+    Wait times are capped at ```max_delay_in_ms``` and, if ```max_elapsed_in_ms```
+    isn't None, no wait ends more than ```max_elapsed_in_ms``` after the
+    strategy was created. If ```use_retry_budget``` is True retries must
+    also be within the process-wide ```retry_budget```.
 
     To get a general sense of wait times:
 
-        for retry in range(1, 20): print (2**retry) * 100
+        for retry in range(1, 20): print (2**retry) * 25
 
     References
 
         * https://developers.google.com/google-apps/documents-list/?csw=1#implementing_exponential_backoff
         * http://googleappsdeveloper.blogspot.ca/2011/12/documents-list-api-best-practices.html
         * http://docs.aws.amazon.com/general/latest/gr/api-retries.html
+        * https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
     """
 
-    def __init__(self, max_num_retries=20):
+    PLUS_MINUS_JITTER = 'plus_minus'
+    FULL_JITTER = 'full'
+    DECORRELATED_JITTER = 'decorrelated'
+
+    def __init__(self,
+                 max_num_retries=20,
+                 jitter=PLUS_MINUS_JITTER,
+                 base_delay_in_ms=25,
+                 max_delay_in_ms=None,
+                 max_elapsed_in_ms=None,
+                 use_retry_budget=False,
+                 clock=time.time):
         object.__init__(self)
 
+        if jitter not in [self.PLUS_MINUS_JITTER, self.FULL_JITTER, self.DECORRELATED_JITTER]:
+            raise ValueError("unknown jitter '%s'" % jitter)
+
         self.num_retries = 0
         self.max_num_retries = max_num_retries
+        self.jitter = jitter
+        self.base_delay_in_ms = base_delay_in_ms
+        self.max_delay_in_ms = max_delay_in_ms
+        self.max_elapsed_in_ms = max_elapsed_in_ms
+        self.use_retry_budget = use_retry_budget
+
+        self._clock = clock
+        self._start_time = clock()
+        self._previous_delay_in_ms = base_delay_in_ms
+
+        if use_retry_budget and retry_budget is not None:
+            retry_budget.deposit()
 
     def next_attempt(self):
         self.num_retries += 1
         return self.num_retries < self.max_num_retries
 
+    def _delay_in_ms(self):
+        if self.jitter == self.FULL_JITTER:
+            delay_in_ms = random.uniform(0, (2 ** self.num_retries) * self.base_delay_in_ms)
+        elif self.jitter == self.DECORRELATED_JITTER:
+            delay_in_ms = random.uniform(self.base_delay_in_ms, self._previous_delay_in_ms * 3)
+        else:
+            delay_in_ms = (2 ** self.num_retries) * self.base_delay_in_ms + random.randint(-10, 10)
+
+        if self.max_delay_in_ms is not None:
+            delay_in_ms = min(delay_in_ms, self.max_delay_in_ms)
+
+        self._previous_delay_in_ms = delay_in_ms
+
+        return delay_in_ms
+
     def wait(self, callback, *callback_args, **callback_kwargs):
 
         if not self.next_attempt():
             callback(0, *callback_args, **callback_kwargs)
             return
 
-        delay_in_ms = (2 ** self.num_retries) * 25 + random.randint(-10, 10)
+        delay_in_ms = self._delay_in_ms()
+
+        if self.max_elapsed_in_ms is not None:
+            elapsed_in_ms = (self._clock() - self._start_time) * 1000.0
+            if self.max_elapsed_in_ms < elapsed_in_ms + delay_in_ms:
+                callback(0, *callback_args, **callback_kwargs)
+                return
+
+        if self.use_retry_budget and retry_budget is not None and not retry_budget.withdraw():
+            callback(0, *callback_args, **callback_kwargs)
+            return
 
         IOLoop.current().add_timeout(
             datetime.timedelta(0, delay_in_ms / 1000.0, 0),
@@ -918,3 +3338,1062 @@ class ExponentialBackoffRetryStrategy(object):
             **callback_kwargs)
 
         return delay_in_ms
+
+
+_circuit_breaker_state = metrics_registry.gauge(
+    'tor_async_util_circuit_breaker_state',
+    'Circuit breaker state by service (0 = closed, 1 = half open, 2 = open).',
+    ('service',))
+
+_circuit_breaker_fast_failures_total = metrics_registry.counter(
+    'tor_async_util_circuit_breaker_fast_failures_total',
+    'Calls failed fast by an open circuit breaker by service.',
+    ('service',))
+
+
+class CircuitBreaker(object):
+    """A ```CircuitBreaker``` stops calls to an unhealthy downstream service
+    so requests fail fast rather than each waiting out timeouts and retries.
+
+        * ```CLOSED``` - calls are allowed and the outcome of the last
+          ```window_size``` calls is tracked. Once at least ```min_num_calls```
+          outcomes have been tracked and the failure rate reaches
+          ```failure_rate_threshold``` the circuit opens.
+        * ```OPEN``` - calls fail fast. After ```open_duration``` seconds
+          the circuit becomes half open.
+        * ```HALF_OPEN``` - up to ```num_half_open_calls``` trial calls are
+          allowed. If the trial calls succeed the circuit closes, if any
+          trial call fails the circuit opens again.
+
+    ```allow_request()``` returns a permit which should be passed to
+    ```record()``` - outcomes of calls permitted before the circuit last
+    changed state (think calls which were in flight when the circuit
+    opened) are ignored.
+
+    Circuit breakers are typically obtained from ```circuit_breakers```
+    and used by an ```AsyncAction``` around a downstream call:
+
+        class AsyncWidgetRetriever(tor_async_util.AsyncAction):
+
+            def fetch(self, callback):
+                breaker = tor_async_util.circuit_breakers.get('widget service')
+                breaker.call(
+                    self._fetch,
+                    callback,
+                    lambda: callback(None, self),
+                    lambda widget, async_action: widget is not None)
+    """
+
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    _metric_values = {
+        CLOSED: 0,
+        HALF_OPEN: 1,
+        OPEN: 2,
+    }
+
+    def __init__(self,
+                 service,
+                 failure_rate_threshold=0.5,
+                 window_size=20,
+                 min_num_calls=10,
+                 open_duration=30.0,
+                 num_half_open_calls=1,
+                 clock=time.time):
+        object.__init__(self)
+
+        self.service = service
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_num_calls = min_num_calls
+        self.open_duration = open_duration
+        self.num_half_open_calls = num_half_open_calls
+        self._clock = clock
+
+        # outcomes (True = failure) of the most recent calls
+        self._window = collections.deque(maxlen=window_size)
+        self._num_failures_in_window = 0
+
+        self._opened_at = None
+        self._num_half_open_calls_in_flight = 0
+        self._num_half_open_successes = 0
+
+        self.num_fast_failures = 0
+
+        # incremented on every change of state
+        self._generation = 0
+
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state):
+        self._generation += 1
+        self._state = state
+        _circuit_breaker_state.set(type(self)._metric_values[state], (self.service,))
+
+    @property
+    def state(self):
+        if self._state == self.OPEN and self.open_duration <= self._clock() - self._opened_at:
+            self._set_state(self.HALF_OPEN)
+            self._num_half_open_calls_in_flight = 0
+            self._num_half_open_successes = 0
+        return self._state
+
+    @property
+    def failure_rate(self):
+        if not self._window:
+            return 0.0
+        return float(self._num_failures_in_window) / len(self._window)
+
+    def allow_request(self):
+        """Returns a (truthy) ```_CircuitBreakerPermit``` if a call should be
+        made to the downstream service. Every call for which a permit is
+        returned must be followed by a call to ```record()``` with the permit.
+        If False is returned the call should fail fast.
+        """
+        state = self.state
+
+        if state == self.CLOSED:
+            return _CircuitBreakerPermit(self._generation)
+
+        if state == self.HALF_OPEN and self._num_half_open_calls_in_flight < self.num_half_open_calls:
+            self._num_half_open_calls_in_flight += 1
+            return _CircuitBreakerPermit(self._generation)
+
+        self.num_fast_failures += 1
+        _circuit_breaker_fast_failures_total.inc((self.service,))
+        return False
+
+    def record(self, is_ok, permit=None):
+        """Record the outcome of a call allowed by ```allow_request()```.
+        ```permit``` is the permit returned by ```allow_request()```.
+        """
+        if permit is not None and permit.generation != self._generation:
+            # call was allowed before the circuit last changed state
+            return
+
+        if self._state == self.HALF_OPEN:
+            self._num_half_open_calls_in_flight = max(0, self._num_half_open_calls_in_flight - 1)
+            if not is_ok:
+                self._open()
+                return
+            self._num_half_open_successes += 1
+            if self.num_half_open_calls <= self._num_half_open_successes:
+                self._close()
+            return
+
+        if self._state == self.OPEN:
+            # call was allowed before the circuit opened
+            return
+
+        if len(self._window) == self._window.maxlen and self._window[0]:
+            self._num_failures_in_window -= 1
+        self._window.append(not is_ok)
+        if not is_ok:
+            self._num_failures_in_window += 1
+
+        if self.min_num_calls <= len(self._window) and self.failure_rate_threshold <= self.failure_rate:
+            self._open()
+
+    def record_success(self):
+        self.record(True)
+
+    def record_failure(self):
+        self.record(False)
+
+    def _open(self):
+        _logger.error("Circuit breaker for '%s' opened", self.service)
+        self._opened_at = self._clock()
+        self._set_state(self.OPEN)
+
+    def _close(self):
+        _logger.info("Circuit breaker for '%s' closed", self.service)
+        self._window.clear()
+        self._num_failures_in_window = 0
+        self._set_state(self.CLOSED)
+
+    def call(self, start, callback, fast_fail_callback, is_ok):
+        """Make a downstream call through this circuit breaker. If the
+        circuit allows the call ```start``` is called with a single callback
+        argument. When the call completes ```is_ok``` is called with the
+        callback's arguments to determine the outcome of the call and then
+        ```callback``` is called with the same arguments. If the circuit
+        doesn't allow the call ```fast_fail_callback``` is called with no
+        arguments.
+        """
+        permit = self.allow_request()
+        if not permit:
+            fast_fail_callback()
+            return
+
+        def on_done(*args, **kwargs):
+            self.record(is_ok(*args, **kwargs), permit)
+            callback(*args, **kwargs)
+
+        try:
+            start(on_done)
+        except Exception:
+            self.record(False, permit)
+            raise
+
+    @property
+    def aspect_health(self):
+        """An ```AspectHealth``` which is unhealthy when the circuit is open."""
+        return AspectHealth(re.sub(r'[^a-zA-Z_]', '_', self.service), self.state != self.OPEN)
+
+
+class _CircuitBreakerPermit(object):
+    """Returned by ```CircuitBreaker.allow_request()```."""
+
+    __slots__ = ('generation',)
+
+    def __init__(self, generation):
+        self.generation = generation
+
+
+class CircuitBreakerRegistry(object):
+    """A ```CircuitBreakerRegistry``` creates and holds a ```CircuitBreaker```
+    per service name. Keyword arguments to the constructor are used when
+    creating circuit breakers. ```component_health_check()``` can be
+    registered with an ```AsyncHealthCheck``` so open circuits are reported
+    as unhealthy by the health check endpoint:
+
+        ServiceHealthCheck.register_component_health_check(
+            'circuit_breakers',
+            tor_async_util.circuit_breakers.component_health_check)
+    """
+
+    def __init__(self, **circuit_breaker_kwargs):
+        object.__init__(self)
+
+        self.circuit_breaker_kwargs = circuit_breaker_kwargs
+
+        self._circuit_breakers = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._circuit_breakers)
+
+    def __iter__(self):
+        return iter(self._circuit_breakers.values())
+
+    def get(self, service):
+        circuit_breaker = self._circuit_breakers.get(service)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(service, **self.circuit_breaker_kwargs)
+            self._circuit_breakers[service] = circuit_breaker
+        return circuit_breaker
+
+    def component_health(self, name='circuit_breakers'):
+        """Returns a ```ComponentHealth``` with an aspect per circuit breaker."""
+        if not self._circuit_breakers:
+            return ComponentHealth(name, is_ok=True)
+        return ComponentHealth(name, aspects=[circuit_breaker.aspect_health for circuit_breaker in self])
+
+    def component_health_check(self, callback):
+        callback(self.component_health())
+
+    def clear(self):
+        self._circuit_breakers.clear()
+
+
+"""```circuit_breakers``` is the process-wide ```CircuitBreakerRegistry```."""
+circuit_breakers = CircuitBreakerRegistry()
+
+
+_hedges_total = metrics_registry.counter(
+    'tor_async_util_hedges_total',
+    'Hedge requests sent by service.',
+    ('service',))
+
+_hedge_wins_total = metrics_registry.counter(
+    'tor_async_util_hedge_wins_total',
+    'Hedge requests which responded before the original request by service.',
+    ('service',))
+
+
+class HedgingPolicy(object):
+    """```AsyncHTTPAction``` uses a ```HedgingPolicy``` to reduce tail latency
+    of idempotent GET and HEAD requests. If a request hasn't been answered
+    after the ```percentile``` of recently observed latencies for the service
+    a second (hedge) request is sent, the first response to arrive is used
+    and the other request is cancelled.
+
+        * latencies are tracked per service in a ```LatencyHistogram```
+          which is reset every ```window_size``` samples - no hedges are
+          sent for a service until ```min_num_samples``` latencies have
+          been observed
+        * hedges are limited to ```max_hedge_rate``` of requests by a token
+          bucket - each request deposits ```max_hedge_rate``` tokens and each
+          hedge withdraws 1 token (the bucket holds at most ```max_burst``` tokens)
+
+    ```num_hedges```, ```num_hedge_wins``` and ```num_hedges_rejected``` count
+    hedges sent, hedges which responded first and hedges not sent because of
+    ```max_hedge_rate```. Hedges sent and won are also counted per service in
+    ```metrics_registry```.
+    """
+
+    def __init__(self,
+                 percentile=95,
+                 max_hedge_rate=0.05,
+                 max_burst=10,
+                 min_num_samples=100,
+                 window_size=1000,
+                 min_delay=0.001):
+        object.__init__(self)
+
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.max_burst = max_burst
+        self.min_num_samples = min_num_samples
+        self.window_size = window_size
+        self.min_delay = min_delay
+
+        # service -> LatencyHistogram
+        self._latencies = {}
+        # service -> hedge delay in seconds
+        self._delays = {}
+
+        self._tokens = 0.0
+
+        self.num_hedges = 0
+        self.num_hedge_wins = 0
+        self.num_hedges_rejected = 0
+
+    def record_latency(self, service, latency):
+        """Record a ```latency``` (in seconds) observed for ```service```."""
+        histogram = self._latencies.get(service)
+        if histogram is None:
+            histogram = self._latencies[service] = LatencyHistogram()
+
+        histogram.record(latency * 1000)
+
+        # percentile() walks all buckets so only recompute every 10 samples
+        if self.min_num_samples <= histogram.count and histogram.count % 10 == 0:
+            self._delays[service] = max(self.min_delay, histogram.percentile(self.percentile) / 1000.0)
+
+        if self.window_size <= histogram.count:
+            histogram.reset()
+
+    def hedge_delay(self, service):
+        """Returns the number of seconds to wait before sending a hedge
+        request or None if not enough latencies have been observed.
+        """
+        return self._delays.get(service)
+
+    def deposit(self):
+        """Called once per request which might be hedged."""
+        self._tokens = min(self.max_burst, self._tokens + self.max_hedge_rate)
+
+    def allow_hedge(self, service):
+        """Called before sending a hedge request. Returns True if the
+        hedge should be sent otherwise returns False.
+        """
+        if self._tokens < 1:
+            self.num_hedges_rejected += 1
+            return False
+
+        self._tokens -= 1
+        self.num_hedges += 1
+        _hedges_total.inc((service,))
+        return True
+
+    def hedge_won(self, service):
+        self.num_hedge_wins += 1
+        _hedge_wins_total.inc((service,))
+
+
+"""```hedging_policy``` is the ```HedgingPolicy``` used by ```AsyncHTTPAction```."""
+hedging_policy = HedgingPolicy()
+
+
+_coalesced_requests_total = metrics_registry.counter(
+    'tor_async_util_http_client_coalesced_requests_total',
+    'Coalescable requests by service and whether the request was sent or shared an in flight request.',
+    ('service', 'outcome'))
+
+
+class HTTPRequestCoalescer(object):
+    """When a hot resource is requested many times in the same few
+    milliseconds ```HTTPRequestCoalescer``` is used by ```AsyncHTTPAction```
+    to make sure that only one request for the resource is in flight at a time:
+
+        * requests are identical if they have the same method, url and
+          values for ```key_headers``` - conditional request headers are
+          included by default so a 304 is only shared by requests which
+          asked for one
+        * concurrent identical requests share a single in flight request
+          and all are called back with the same ```tornado.httpclient.HTTPResponse```
+
+    ```num_requests``` and ```num_coalesced``` count requests which could be
+    coalesced and requests which shared an in flight request - see
+    ```coalescing_ratio```. Both are also counted per service in ```metrics_registry```.
+    """
+
+    def __init__(self,
+                 key_headers=(
+                     'Accept',
+                     'Accept-Encoding',
+                     'Authorization',
+                     'Cookie',
+                     'If-None-Match',
+                     'If-Modified-Since')):
+        object.__init__(self)
+
+        self.key_headers = tuple(key_headers)
+
+        # key -> async actions waiting for the in flight response
+        self._in_flight = {}
+
+        self.num_requests = 0
+        self.num_coalesced = 0
+
+    @property
+    def coalescing_ratio(self):
+        if not self.num_requests:
+            return 0.0
+        return float(self.num_coalesced) / self.num_requests
+
+    def key(self, request):
+        headers = request.headers
+        return (request.method, request.url, tuple(headers.get(name) for name in self.key_headers))
+
+    def start(self, key, async_action):
+        """Returns True if the caller should send the request for ```key```
+        or False if an identical request is already in flight in which case
+        ```async_action``` will be returned by ```finish()``` when the in
+        flight request completes.
+        """
+        self.num_requests += 1
+
+        async_actions = self._in_flight.get(key)
+        if async_actions is not None:
+            async_actions.append(async_action)
+            self.num_coalesced += 1
+            _coalesced_requests_total.inc((async_action.service, 'coalesced'))
+            return False
+
+        self._in_flight[key] = [async_action]
+        _coalesced_requests_total.inc((async_action.service, 'sent'))
+        return True
+
+    def finish(self, key):
+        """Returns the list of async actions waiting for the in flight
+        response for ```key``` - the async action which sent the request
+        is first in the list.
+        """
+        return self._in_flight.pop(key, [])
+
+
+"""```http_request_coalescer``` is the ```HTTPRequestCoalescer``` used by ```AsyncHTTPAction```."""
+http_request_coalescer = HTTPRequestCoalescer()
+
+
+_http_client_cache_requests_total = metrics_registry.counter(
+    'tor_async_util_http_client_cache_requests_total',
+    'Cacheable requests by service and cache outcome (hit, stale, miss or revalidated).',
+    ('service', 'outcome'))
+
+
+class _HTTPResponseCacheEntry(object):
+
+    def __init__(self, response, size, stored_at, max_age, stale_while_revalidate, etag):
+        object.__init__(self)
+
+        self.response = response
+        self.size = size
+        self.stored_at = stored_at
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self.etag = etag
+        self.is_revalidating = False
+
+
+class HTTPResponseCache(object):
+    """An in memory cache of responses to GET requests which is used
+    by ```AsyncHTTPAction``` and follows HTTP caching semantics:
+
+        * responses are cached for Cache-Control's s-maxage or max-age
+          seconds less the response's Age header
+        * responses with a Cache-Control of no-store or private or without
+          a max-age or ETag aren't cached - responses with Cache-Control
+          of no-cache are cached but always revalidated
+        * stale responses are used for Cache-Control's stale-while-revalidate
+          seconds while the response is revalidated in the background
+        * stale responses with an ETag are revalidated with If-None-Match
+          and reused if the service responds with 304 Not Modified
+        * the cache holds at most ```max_bytes``` of response bodies,
+          evicting least recently used responses, and responses larger
+          than ```max_entry_bytes``` aren't cached
+        * responses are only cached if all headers named by their Vary header
+          are in ```key_headers``` - responses with Vary of * aren't cached
+
+    Requests are identical if they have the same url and values for
+    ```key_headers```. ```num_hits```, ```num_stale_hits```, ```num_misses```
+    and ```num_revalidations``` count lookups which found a fresh response,
+    found a stale response which could be used while revalidating, found
+    nothing usable and responses revalidated with 304 Not Modified. All
+    are also counted per service in ```metrics_registry```.
+    """
+
+    FRESH = 'fresh'
+    STALE = 'stale'
+    REVALIDATE = 'revalidate'
+    MISS = 'miss'
+
+    _cache_control_directive_reg_ex = re.compile(
+        r"^\s*(?P<name>[^=\s]+)\s*(=\s*\"?(?P<value>[^\"]*)\"?)?\s*$")
+
+    def __init__(self,
+                 max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=1024 * 1024,
+                 key_headers=('Accept', 'Accept-Encoding', 'Authorization', 'Cookie'),
+                 clock=time.time):
+        object.__init__(self)
+
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.key_headers = tuple(key_headers)
+        self._clock = clock
+
+        # key -> _HTTPResponseCacheEntry in least to most recently used order
+        self._entries = collections.OrderedDict()
+        self.num_bytes = 0
+
+        self.num_hits = 0
+        self.num_stale_hits = 0
+        self.num_misses = 0
+        self.num_revalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, request):
+        headers = request.headers
+        return (request.url, tuple(headers.get(name) for name in self.key_headers))
+
+    def _parse_cache_control(self, headers):
+        directives = {}
+        for directive in headers.get('Cache-Control', '').split(','):
+            match = type(self)._cache_control_directive_reg_ex.match(directive)
+            if match:
+                directives[match.group('name').lower()] = match.group('value')
+        return directives
+
+    def _seconds(self, directives, name):
+        try:
+            return max(0, int(directives.get(name)))
+        except (TypeError, ValueError):
+            return None
+
+    def lookup(self, key, service):
+        """Returns a (state, entry) pair where state is one of:
+
+            * ```FRESH``` - use ```entry.response```
+            * ```STALE``` - use ```entry.response``` and revalidate in the background
+            * ```REVALIDATE``` - send a conditional request using ```entry.etag```
+            * ```MISS``` - send a request (entry is None)
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = self._clock() - entry.stored_at
+            if age < entry.max_age:
+                self._entries[key] = self._entries.pop(key)
+                self.num_hits += 1
+                _http_client_cache_requests_total.inc((service, 'hit'))
+                return (self.FRESH, entry)
+
+            if age < entry.max_age + entry.stale_while_revalidate and not entry.is_revalidating:
+                self._entries[key] = self._entries.pop(key)
+                entry.is_revalidating = True
+                self.num_stale_hits += 1
+                _http_client_cache_requests_total.inc((service, 'stale'))
+                return (self.STALE, entry)
+
+        self.num_misses += 1
+        _http_client_cache_requests_total.inc((service, 'miss'))
+
+        if entry is not None and entry.etag:
+            return (self.REVALIDATE, entry)
+
+        return (self.MISS, None)
+
+    def update(self, key, service, response, revalidated_entry=None):
+        """Update the cache with ```response``` to the request for ```key```
+        and return the response which should be used. If ```response``` is a
+        304 Not Modified the cached response is returned. ```revalidated_entry```
+        is the entry returned by ```lookup()``` which the request revalidated -
+        it's used (and stored again) if the entry was evicted or removed
+        while the request was in flight.
+        """
+        entry = self._entries.get(key) or revalidated_entry
+
+        if response.code == httplib.NOT_MODIFIED:
+            if entry is None:
+                return response
+
+            entry.is_revalidating = False
+            self.num_revalidations += 1
+            _http_client_cache_requests_total.inc((service, 'revalidated'))
+            if 'Cache-Control' in response.headers:
+                self._store(key, entry.response, response.headers)
+            elif entry is not self._entries.get(key):
+                self._store(key, entry.response, entry.response.headers)
+            else:
+                entry.stored_at = self._clock()
+            return entry.response
+
+        if response.code == httplib.OK:
+            self._store(key, response, response.headers)
+        else:
+            self.remove(key)
+
+        return response
+
+    def _store(self, key, response, headers):
+        self.remove(key)
+
+        size = len(response.body or '')
+        if self.max_entry_bytes < size:
+            return
+
+        directives = self._parse_cache_control(headers)
+        if 'no-store' in directives or 'private' in directives:
+            return
+
+        # responses which vary on request headers that aren't part of
+        # the key can't be shared by all requests with the same key
+        vary = headers.get('Vary', response.headers.get('Vary', ''))
+        key_header_names = set(name.lower() for name in self.key_headers)
+        for name in vary.split(','):
+            name = name.strip().lower()
+            if name and name not in key_header_names:
+                return
+
+        etag = headers.get('ETag', response.headers.get('ETag'))
+
+        if 'no-cache' in directives:
+            max_age = 0
+        else:
+            max_age = self._seconds(directives, 's-maxage')
+            if max_age is None:
+                max_age = self._seconds(directives, 'max-age')
+            if max_age is None:
+                if not etag:
+                    return
+                max_age = 0
+
+        try:
+            age = max(0, int(headers.get('Age', 0)))
+        except ValueError:
+            age = 0
+
+        entry = _HTTPResponseCacheEntry(
+            response,
+            size,
+            self._clock() - age,
+            max_age,
+            self._seconds(directives, 'stale-while-revalidate') or 0,
+            etag)
+
+        self._entries[key] = entry
+        self.num_bytes += size
+
+        while self.max_bytes < self.num_bytes:
+            (_, evicted_entry) = self._entries.popitem(last=False)
+            self.num_bytes -= evicted_entry.size
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.num_bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+
+"""```http_response_cache``` is the ```HTTPResponseCache``` used by ```AsyncHTTPAction```."""
+http_response_cache = HTTPResponseCache()
+
+
+"""```http_client_max_clients``` is the maximum number of concurrent requests
+made by the http client returned by ```get_http_client()```. Changes only
+take effect for IOLoops which haven't yet created a http client.
+"""
+http_client_max_clients = 100
+
+
+def _http_client_progress(download_total, downloaded, upload_total, uploaded):
+    return 0
+
+
+def _http_client_prepare_curl(curl):
+    curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+    # curl handles are pooled and tornado doesn't reset progress options
+    # so undo whatever a (hedged) request using this handle last set
+    curl.setopt(pycurl.NOPROGRESS, 1)
+    curl.setopt(pycurl.PROGRESSFUNCTION, _http_client_progress)
+
+
+"""Defaults for requests made by the http client returned by ```get_http_client()```."""
+_http_client_defaults = {
+    'connect_timeout': 5.0,
+    'request_timeout': 10.0,
+    'prepare_curl_callback': _http_client_prepare_curl,
+}
+
+
+def get_http_client():
+    """Returns the ```tornado.curl_httpclient.CurlAsyncHTTPClient``` shared
+    by all ```AsyncHTTPAction``` instances on the current IOLoop. The client
+    is created once per IOLoop with ```http_client_max_clients``` curl handles
+    and TCP keep-alive enabled. libcurl caches connections so connections
+    to downstream services are reused across requests.
+    """
+    return tornado.curl_httpclient.CurlAsyncHTTPClient(
+        max_clients=http_client_max_clients,
+        defaults=_http_client_defaults)
+
+
+class AsyncHTTPAction(AsyncAction):
+    """```AsyncHTTPAction``` makes a request to a downstream service using
+    the shared http client returned by ```get_http_client()```, records the
+    timing details of every attempt (see ```AsyncAction.record_http_client_response()```)
+    and retries failed attempts using an ```ExponentialBackoffRetryStrategy```
+    with full jitter.
+
+        * only idempotent requests (see ```idempotent_methods``` and
+          ```is_idempotent```) are retried after a response with a status
+          code in ```retryable_status_codes``` - other requests are only
+          retried if the connection to the service couldn't be established
+          (ie the request was never sent)
+        * each attempt is limited to ```attempt_timeout``` seconds and all
+          attempts, including waits between attempts, to ```overall_timeout```
+          seconds
+        * if ```use_circuit_breaker``` is True each attempt is made through
+          ```circuit_breakers.get(service)``` and the callback is called with
+          a None response when the circuit is open - an attempt is recorded
+          as a failure if its response is a 5xx (including 599 for connection
+          errors and timeouts) regardless of whether it can be retried
+        * if ```use_hedging``` is True idempotent GET and HEAD requests
+          are hedged as described by ```hedging_policy```
+        * if ```use_coalescing``` is True concurrent identical GET and HEAD
+          requests share a single in flight request as described by
+          ```http_request_coalescer```
+        * if ```use_cache``` is True responses to GET requests are cached
+          as described by ```http_response_cache```
+
+    ```request``` is either an url or a ```tornado.httpclient.HTTPRequest```
+    whose timeouts are updated before each attempt.
+
+        class AsyncWidgetRetriever(tor_async_util.AsyncAction):
+
+            def fetch(self, callback):
+                self._callback = callback
+
+                aha = tor_async_util.AsyncHTTPAction('widget service', 'http://widgets/v1.0/widgets/123')
+                aha.fetch(self._on_fetch_done)
+
+            def _on_fetch_done(self, response, aha):
+                ...
+    """
+
+    idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+    hedgeable_methods = frozenset(['GET', 'HEAD'])
+
+    coalescable_methods = frozenset(['GET', 'HEAD'])
+
+    retryable_status_codes = frozenset([
+        httplib.BAD_GATEWAY,
+        httplib.SERVICE_UNAVAILABLE,
+        httplib.GATEWAY_TIMEOUT,
+        599,
+    ])
+
+    """Upper bound on the wait between attempts."""
+    max_retry_delay_in_ms = 2000
+
+    """libcurl errors which mean the request was never sent."""
+    _not_sent_curl_errors = frozenset([
+        pycurl.E_COULDNT_RESOLVE_HOST,
+        pycurl.E_COULDNT_CONNECT,
+    ])
+
+    def __init__(self,
+                 service,
+                 request,
+                 is_idempotent=None,
+                 max_num_retries=3,
+                 attempt_timeout=10.0,
+                 overall_timeout=30.0,
+                 use_circuit_breaker=False,
+                 use_hedging=False,
+                 use_coalescing=False,
+                 use_cache=False,
+                 async_state=None,
+                 clock=time.time):
+        AsyncAction.__init__(self, async_state)
+
+        if isinstance(request, basestring):
+            request = tornado.httpclient.HTTPRequest(request)
+
+        if is_idempotent is None:
+            is_idempotent = request.method in type(self).idempotent_methods or 'Idempotency-Key' in request.headers
+
+        self.service = service
+        self.request = request
+        self.is_idempotent = is_idempotent
+        self.max_num_retries = max_num_retries
+        self.attempt_timeout = attempt_timeout
+        self.overall_timeout = overall_timeout
+        self.use_circuit_breaker = use_circuit_breaker
+        self.use_hedging = use_hedging and is_idempotent and request.method in type(self).hedgeable_methods
+        self.use_coalescing = use_coalescing and request.method in type(self).coalescable_methods
+        self.use_cache = use_cache and request.method == 'GET'
+        self._clock = clock
+
+        # request's own connect timeout otherwise the http client's default
+        self._connect_timeout = request.connect_timeout or _http_client_defaults['connect_timeout']
+
+        self.num_attempts = 0
+        self.num_hedges = 0
+
+        self._callback = None
+        self._deadline = None
+        self._retry_strategy = None
+        self._circuit_breaker = None
+        self._circuit_breaker_permit = None
+        self._in_flight = []
+        self._hedge_timeout = None
+        self._coalescing_key = None
+        self._cache_key = None
+        # cache entry being revalidated by a conditional request
+        self._revalidated_entry = None
+
+    def fetch(self, callback):
+        assert self._callback is None
+
+        self._callback = callback
+
+        if self.use_cache and self._cache_key is None:
+            self._cache_key = http_response_cache.key(self.request)
+            (state, entry) = http_response_cache.lookup(self._cache_key, self.service)
+
+            if state in [HTTPResponseCache.FRESH, HTTPResponseCache.STALE]:
+                if state == HTTPResponseCache.STALE:
+                    self._revalidate_in_background(entry)
+                self._call_callback_with_response(entry.response)
+                return
+
+            if state == HTTPResponseCache.REVALIDATE:
+                self._revalidated_entry = entry
+                self.request = self._conditional_request(entry.etag)
+
+        if self.use_coalescing:
+            self._coalescing_key = http_request_coalescer.key(self.request)
+            if not http_request_coalescer.start(self._coalescing_key, self):
+                return
+
+        self._deadline = self._clock() + self.overall_timeout
+        self._retry_strategy = ExponentialBackoffRetryStrategy(
+            # ExponentialBackoffRetryStrategy counts the first attempt as a retry
+            max_num_retries=self.max_num_retries + 1,
+            jitter=ExponentialBackoffRetryStrategy.FULL_JITTER,
+            max_delay_in_ms=type(self).max_retry_delay_in_ms,
+            max_elapsed_in_ms=self.overall_timeout * 1000,
+            use_retry_budget=True,
+            clock=self._clock)
+        if self.use_circuit_breaker:
+            self._circuit_breaker = circuit_breakers.get(self.service)
+        if self.use_hedging:
+            hedging_policy.deposit()
+
+        self._attempt()
+
+    def _attempt(self, previous_response=None):
+        timeout = min(self.attempt_timeout, self._deadline - self._clock())
+        if timeout <= 0:
+            self._call_callback(previous_response)
+            return
+
+        if self._circuit_breaker:
+            self._circuit_breaker_permit = self._circuit_breaker.allow_request()
+            if not self._circuit_breaker_permit:
+                self._call_callback(None)
+                return
+
+        self.request.request_timeout = timeout
+        self.request.connect_timeout = min(self._connect_timeout, timeout)
+
+        self.num_attempts += 1
+        self._send(is_hedge=False)
+
+        if self.use_hedging:
+            delay = hedging_policy.hedge_delay(self.service)
+            if delay is not None and delay < timeout:
+                self._hedge_timeout = IOLoop.current().call_later(delay, self._on_hedge_timeout)
+
+    def _on_hedge_timeout(self):
+        self._hedge_timeout = None
+        if hedging_policy.allow_hedge(self.service):
+            self.num_hedges += 1
+            self._send(is_hedge=True)
+
+    def _send(self, is_hedge):
+        attempt = _HTTPAttempt(is_hedge)
+
+        # each attempt needs its own request so it can be cancelled and so
+        # the progress options of a pooled curl handle are always reset
+        request = copy.copy(self.request)
+        request.prepare_curl_callback = functools.partial(
+            attempt.prepare_curl,
+            self.request.prepare_curl_callback or _http_client_prepare_curl)
+
+        self._in_flight.append(attempt)
+
+        future = get_http_client().fetch(request, raise_error=False)
+        future.add_done_callback(attempt.done)
+        IOLoop.current().add_future(future, functools.partial(self._on_attempt_done, attempt))
+
+    def _on_attempt_done(self, attempt, future):
+        if attempt.is_cancelled:
+            return
+
+        # first response wins - cancel the other attempt (if any)
+        for other_attempt in self._in_flight:
+            if other_attempt is not attempt:
+                other_attempt.is_cancelled = True
+        self._in_flight = []
+
+        if self._hedge_timeout is not None:
+            IOLoop.current().remove_timeout(self._hedge_timeout)
+            self._hedge_timeout = None
+
+        response = future.result()
+
+        if self.use_hedging:
+            hedging_policy.record_latency(self.service, response.request_time)
+            if attempt.is_hedge:
+                hedging_policy.hedge_won(self.service)
+
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info(self.create_log_msg_for_http_client_response(response, self.service))
+        else:
+            self.record_http_client_response(response, self.service)
+
+        is_retryable = self._is_retryable(response)
+
+        if self._circuit_breaker:
+            self._circuit_breaker.record(not self._is_failure(response), self._circuit_breaker_permit)
+
+        if not is_retryable:
+            if self.use_cache:
+                response = http_response_cache.update(
+                    self._cache_key,
+                    self.service,
+                    response,
+                    self._revalidated_entry)
+            self._call_callback(response)
+            return
+
+        self._retry_strategy.wait(self._on_retry_strategy_wait_done, response)
+
+    def _is_failure(self, response):
+        return httplib.INTERNAL_SERVER_ERROR <= response.code
+
+    def _is_retryable(self, response):
+        if response.code not in type(self).retryable_status_codes:
+            return False
+
+        if self.is_idempotent:
+            return True
+
+        return getattr(response.error, 'errno', None) in type(self)._not_sent_curl_errors
+
+    def _on_retry_strategy_wait_done(self, delay_in_ms, response):
+        if not delay_in_ms:
+            self._call_callback(response)
+            return
+
+        self._attempt(response)
+
+    def _conditional_request(self, etag):
+        request = copy.copy(self.request)
+        request.headers = tornado.httputil.HTTPHeaders(self.request.headers)
+        if etag:
+            request.headers['If-None-Match'] = etag
+        return request
+
+    def _revalidate_in_background(self, entry):
+        aha = type(self)(
+            self.service,
+            self._conditional_request(entry.etag),
+            is_idempotent=self.is_idempotent,
+            max_num_retries=self.max_num_retries,
+            attempt_timeout=self.attempt_timeout,
+            overall_timeout=self.overall_timeout,
+            use_circuit_breaker=self.use_circuit_breaker,
+            use_cache=True,
+            clock=self._clock)
+        aha._cache_key = self._cache_key
+        aha._revalidated_entry = entry
+        aha.fetch(self._on_revalidate_in_background_done)
+
+    def _on_revalidate_in_background_done(self, response, aha):
+        # a failed revalidation (think retries exhausted or an open circuit)
+        # doesn't update the cache so let the next stale hit try again
+        aha._revalidated_entry.is_revalidating = False
+
+    def _call_callback(self, response):
+        if self._coalescing_key is None:
+            self._call_callback_with_response(response)
+            return
+
+        for async_action in http_request_coalescer.finish(self._coalescing_key):
+            try:
+                async_action._call_callback_with_response(response)
+            except Exception as ex:
+                _logger.error("Error calling back coalesced request for '%s' - %s", self.request.url, ex)
+
+    def _call_callback_with_response(self, response):
+        callback = self._callback
+        self._callback = None
+        callback(response, self)
+
+
+class _HTTPAttempt(object):
+    """```AsyncHTTPAction``` creates an ```_HTTPAttempt``` for each request
+    it sends. When hedging, the attempt which doesn't respond first is
+    cancelled by having libcurl's progress function abort its transfer.
+
+    tornado pools curl handles so the progress function stays attached
+    to the handle after the transfer ends. Every request ```AsyncHTTPAction```
+    sends resets the progress options, ```_http_client_prepare_curl()``` does
+    the same for other requests and, in case a request is prepared by some
+    other callback, the progress function aborts at most one transfer and
+    never once the attempt's own transfer is done.
+    """
+
+    def __init__(self, is_hedge):
+        object.__init__(self)
+
+        self.is_hedge = is_hedge
+        self.is_cancelled = False
+        self.is_aborted = False
+        self.is_done = False
+
+    def done(self, future):
+        self.is_done = True
+
+    def prepare_curl(self, prepare_curl_callback, curl):
+        prepare_curl_callback(curl)
+        curl.setopt(pycurl.NOPROGRESS, 0)
+        curl.setopt(pycurl.PROGRESSFUNCTION, self.progress)
+
+    def progress(self, download_total, downloaded, upload_total, uploaded):
+        # a non-zero return value aborts the transfer
+        if not self.is_cancelled or self.is_aborted or self.is_done:
+            return 0
+        self.is_aborted = True
+        return 1
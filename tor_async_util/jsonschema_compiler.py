@@ -0,0 +1,378 @@
+"""This module compiles draft-04 jsonschemas into specialized Python
+functions. The schemas used by a typical service (including those in the
+```jsonschemas``` module) are small and never change so validating with
+straight-line Python is much faster than running the generic ```jsonschema```
+interpreter on every request.
+
+The following keywords are compiled:
+
+    type, enum, properties, required, patternProperties, additionalProperties,
+    minProperties, maxProperties, items (single schema), minItems, maxItems,
+    minLength, maxLength, pattern, minimum, maximum, exclusiveMinimum,
+    exclusiveMaximum, allOf, anyOf, oneOf, not and local (#...) $refs
+
+Annotation keywords (title, description, default, definitions, $schema,
+format, etc) are ignored just like ```jsonschema.validate()``` ignores them.
+Any (sub)schema containing some other keyword is handed off to a
+```jsonschema``` validator so the verdict is always the same as
+```jsonschema```'s verdict.
+
+Expected usage
+
+    from tor_async_util import jsonschema_compiler
+
+    validator = jsonschema_compiler.compile_schema(schema)
+
+    if validator.is_valid(body):
+        ...
+
+    validator.validate(body)  # raises jsonschema.ValidationError
+"""
+
+import numbers
+import re
+
+import jsonschema
+from jsonschema.compat import int_types
+from jsonschema.compat import iteritems
+from jsonschema.compat import str_types
+
+
+"""Keywords which have no impact on the validation verdict."""
+_ignored_keywords = frozenset([
+    '$schema',
+    'title',
+    'description',
+    'default',
+    'definitions',
+    'format',
+    'example',
+    'examples',
+])
+
+"""Keywords the compiler knows how to generate code for."""
+_supported_keywords = frozenset([
+    'type',
+    'enum',
+    'properties',
+    'required',
+    'patternProperties',
+    'additionalProperties',
+    'minProperties',
+    'maxProperties',
+    'items',
+    'minItems',
+    'maxItems',
+    'minLength',
+    'maxLength',
+    'pattern',
+    'minimum',
+    'maximum',
+    'exclusiveMinimum',
+    'exclusiveMaximum',
+    'allOf',
+    'anyOf',
+    'oneOf',
+    'not',
+])
+
+"""Maps a jsonschema type to a python expression which tests
+if ```i``` (the instance being validated) is of that type.
+"""
+_type_checks = {
+    'string': 'isinstance(i, _str_types)',
+    'object': 'isinstance(i, dict)',
+    'array': 'isinstance(i, list)',
+    'boolean': 'isinstance(i, bool)',
+    'null': 'i is None',
+    'integer': '(isinstance(i, _int_types) and not isinstance(i, bool))',
+    'number': '(isinstance(i, _Number) and not isinstance(i, bool))',
+}
+
+
+class CompiledValidator(object):
+    """A ```CompiledValidator``` is created by ```compile_schema()``` and
+    quacks like a ```jsonschema``` validator for the purposes of
+    ```is_valid()``` and ```validate()```.
+    """
+
+    def __init__(self, schema, is_valid, source):
+        object.__init__(self)
+
+        self.schema = schema
+        self.is_valid = is_valid
+        self.source = source
+
+        self._jsonschema_validator = None
+
+    def validate(self, instance):
+        """Raise a ```jsonschema.ValidationError``` if ```instance```
+        isn't valid. The compiled function only provides a verdict so on
+        failure ```jsonschema``` is used to generate a descriptive error.
+        """
+        if self.is_valid(instance):
+            return
+
+        if self._jsonschema_validator is None:
+            self._jsonschema_validator = jsonschema.Draft4Validator(
+                self.schema,
+                resolver=jsonschema.RefResolver.from_schema(self.schema))
+
+        self._jsonschema_validator.validate(instance)
+
+        # should never get here
+        raise jsonschema.ValidationError('%r is not valid' % (instance,))
+
+
+class _Compiler(object):
+    """```_Compiler``` is a private class used by ```compile_schema()```
+    to generate the source code for a schema's validation functions.
+    """
+
+    def __init__(self, schema):
+        object.__init__(self)
+
+        self.schema = schema
+        self.resolver = jsonschema.RefResolver.from_schema(schema)
+
+        self.namespace = {
+            '_str_types': str_types,
+            '_int_types': int_types,
+            '_Number': numbers.Number,
+            '_iteritems': iteritems,
+        }
+        self.functions = []
+
+        # id() of (sub)schema -> name of validation function
+        self._function_names = {}
+        # keep a reference to every (sub)schema so ids stay unique
+        self._subschemas = []
+
+    def constant(self, value):
+        name = '_c%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def function_name(self, subschema):
+        """Return the name of the function which validates an
+        instance against ```subschema``` generating the function
+        if it doesn't already exist.
+        """
+        name = self._function_names.get(id(subschema))
+        if name is None:
+            name = '_v%d' % len(self._function_names)
+            self._function_names[id(subschema)] = name
+            self._subschemas.append(subschema)
+            self.functions.append(self._generate_function(name, subschema))
+        return name
+
+    def _fallback(self, subschema):
+        validator = jsonschema.Draft4Validator(
+            subschema,
+            resolver=jsonschema.RefResolver.from_schema(self.schema))
+        return ['return %s(i)' % self.constant(validator.is_valid)]
+
+    def _is_compilable(self, subschema):
+        if not isinstance(subschema, dict):
+            return False
+
+        if 'id' in subschema and subschema is not self.schema:
+            return False
+
+        if '$ref' in subschema:
+            return subschema['$ref'].startswith('#')
+
+        for keyword in subschema:
+            if keyword in _ignored_keywords or keyword == 'id':
+                continue
+            if keyword not in _supported_keywords:
+                return False
+
+        types = subschema.get('type', [])
+        for type_name in types if isinstance(types, list) else [types]:
+            if type_name not in _type_checks:
+                return False
+
+        if isinstance(subschema.get('items', {}), list):
+            return False
+
+        if not isinstance(subschema.get('additionalProperties', True), (bool, dict)):
+            return False
+
+        return True
+
+    def _generate_function(self, name, subschema):
+        if self._is_compilable(subschema):
+            body = self._generate_body(subschema)
+        else:
+            body = self._fallback(subschema)
+
+        lines = ['def %s(i):' % name]
+        lines.extend('    %s' % line for line in body)
+        return '\n'.join(lines)
+
+    def _generate_body(self, subschema):
+        if '$ref' in subschema:
+            (_, resolved) = self.resolver.resolve(subschema['$ref'])
+            return ['return %s(i)' % self.function_name(resolved)]
+
+        body = []
+
+        if 'type' in subschema:
+            types = subschema['type']
+            types = types if isinstance(types, list) else [types]
+            checks = ' or '.join(_type_checks[type_name] for type_name in types) or 'False'
+            body.append('if not (%s):' % checks)
+            body.append('    return False')
+
+        if 'enum' in subschema:
+            body.append('if i not in %s:' % self.constant(subschema['enum']))
+            body.append('    return False')
+
+        body.extend(self._generate_string_checks(subschema))
+        body.extend(self._generate_number_checks(subschema))
+        body.extend(self._generate_object_checks(subschema))
+        body.extend(self._generate_array_checks(subschema))
+
+        for sub in subschema.get('allOf', []):
+            body.append('if not %s(i):' % self.function_name(sub))
+            body.append('    return False')
+
+        if 'anyOf' in subschema:
+            calls = ' or '.join('%s(i)' % self.function_name(sub) for sub in subschema['anyOf'])
+            body.append('if not (%s):' % calls)
+            body.append('    return False')
+
+        if 'oneOf' in subschema:
+            body.append('n = 0')
+            for sub in subschema['oneOf']:
+                body.append('if %s(i):' % self.function_name(sub))
+                body.append('    n += 1')
+            body.append('if n != 1:')
+            body.append('    return False')
+
+        if 'not' in subschema:
+            body.append('if %s(i):' % self.function_name(subschema['not']))
+            body.append('    return False')
+
+        body.append('return True')
+
+        return body
+
+    def _indented(self, guard, checks):
+        if not checks:
+            return []
+        return [guard] + ['    %s' % check for check in checks]
+
+    def _generate_string_checks(self, subschema):
+        checks = []
+
+        if 'minLength' in subschema:
+            checks.append('if len(i) < %s:' % self.constant(subschema['minLength']))
+            checks.append('    return False')
+
+        if 'maxLength' in subschema:
+            checks.append('if len(i) > %s:' % self.constant(subschema['maxLength']))
+            checks.append('    return False')
+
+        if 'pattern' in subschema:
+            search = re.compile(subschema['pattern']).search
+            checks.append('if not %s(i):' % self.constant(search))
+            checks.append('    return False')
+
+        return self._indented('if %s:' % _type_checks['string'], checks)
+
+    def _generate_number_checks(self, subschema):
+        checks = []
+
+        if 'minimum' in subschema:
+            op = '<=' if subschema.get('exclusiveMinimum', False) else '<'
+            checks.append('if i %s %s:' % (op, self.constant(subschema['minimum'])))
+            checks.append('    return False')
+
+        if 'maximum' in subschema:
+            op = '>=' if subschema.get('exclusiveMaximum', False) else '>'
+            checks.append('if i %s %s:' % (op, self.constant(subschema['maximum'])))
+            checks.append('    return False')
+
+        return self._indented('if %s:' % _type_checks['number'], checks)
+
+    def _generate_object_checks(self, subschema):
+        checks = []
+
+        for property_name in subschema.get('required', []):
+            checks.append('if %r not in i:' % property_name)
+            checks.append('    return False')
+
+        if 'minProperties' in subschema:
+            checks.append('if len(i) < %s:' % self.constant(subschema['minProperties']))
+            checks.append('    return False')
+
+        if 'maxProperties' in subschema:
+            checks.append('if len(i) > %s:' % self.constant(subschema['maxProperties']))
+            checks.append('    return False')
+
+        properties = subschema.get('properties', {})
+        for (property_name, sub) in iteritems(properties):
+            checks.append('if %r in i and not %s(i[%r]):' % (
+                property_name,
+                self.function_name(sub),
+                property_name))
+            checks.append('    return False')
+
+        pattern_searches = []
+        for (pattern, sub) in iteritems(subschema.get('patternProperties', {})):
+            search = self.constant(re.compile(pattern).search)
+            pattern_searches.append(search)
+            checks.append('for (k, v) in _iteritems(i):')
+            checks.append('    if %s(k) and not %s(v):' % (search, self.function_name(sub)))
+            checks.append('        return False')
+
+        additional_properties = subschema.get('additionalProperties', True)
+        if additional_properties is not True:
+            is_additional = ['k not in %s' % self.constant(frozenset(properties))]
+            is_additional.extend('not %s(k)' % search for search in pattern_searches)
+            checks.append('for k in i:')
+            checks.append('    if %s:' % ' and '.join(is_additional))
+            if additional_properties is False:
+                checks.append('        return False')
+            else:
+                checks.append('        if not %s(i[k]):' % self.function_name(additional_properties))
+                checks.append('            return False')
+
+        return self._indented('if %s:' % _type_checks['object'], checks)
+
+    def _generate_array_checks(self, subschema):
+        checks = []
+
+        if 'minItems' in subschema:
+            checks.append('if len(i) < %s:' % self.constant(subschema['minItems']))
+            checks.append('    return False')
+
+        if 'maxItems' in subschema:
+            checks.append('if len(i) > %s:' % self.constant(subschema['maxItems']))
+            checks.append('    return False')
+
+        if 'items' in subschema:
+            checks.append('for v in i:')
+            checks.append('    if not %s(v):' % self.function_name(subschema['items']))
+            checks.append('        return False')
+
+        return self._indented('if %s:' % _type_checks['array'], checks)
+
+
+def compile_schema(schema):
+    """Check ```schema``` and then generate & compile a specialized
+    validation function for it. Returns a ```CompiledValidator```.
+    ```jsonschema.SchemaError``` is raised if ```schema``` is invalid.
+    """
+    jsonschema.Draft4Validator.check_schema(schema)
+
+    compiler = _Compiler(schema)
+    name = compiler.function_name(schema)
+    source = '\n\n'.join(compiler.functions) + '\n'
+
+    namespace = compiler.namespace
+    exec(compile(source, '<compiled jsonschema>', 'exec'), namespace)
+
+    return CompiledValidator(schema, namespace[name], source)
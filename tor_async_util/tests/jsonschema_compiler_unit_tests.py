@@ -0,0 +1,237 @@
+"""This module contains unit tests for jsonschema_compiler.py."""
+
+import unittest
+
+import jsonschema
+
+from tor_async_util import jsonschema_compiler
+from tor_async_util import jsonschemas
+
+
+"""A grab bag of instances which exercise all the jsonschema types."""
+_instances = [
+    None,
+    True,
+    False,
+    0,
+    1,
+    -1,
+    1.0,
+    2.5,
+    '',
+    'dave',
+    u'dave',
+    'red',
+    'green',
+    'blue',
+    [],
+    [1, 2, 3],
+    ['red', 'green'],
+    [1, 1],
+    {},
+    {'status': 'green'},
+    {'status': 'blue'},
+    {'msg': 'dave was here'},
+    {'msg': 42},
+    {'msg': 'dave', 'extra': 1},
+    {'count': 5},
+    {'count': 10},
+    {'count': 0},
+]
+
+
+class CompileSchemaTestCase(unittest.TestCase):
+    """A collection of unit tests for compile_schema() which verify that
+    validators generated by compile_schema() give the same verdict as
+    jsonschema validators.
+    """
+
+    def assertSameVerdicts(self, schema, instances=None):
+        jsonschema_validator = jsonschema.Draft4Validator(
+            schema,
+            resolver=jsonschema.RefResolver.from_schema(schema))
+        compiled_validator = jsonschema_compiler.compile_schema(schema)
+
+        for instance in _instances + (instances or []):
+            self.assertEqual(
+                jsonschema_validator.is_valid(instance),
+                compiled_validator.is_valid(instance),
+                'verdicts differ for %r against %r' % (instance, schema))
+
+    def test_invalid_schema(self):
+        with self.assertRaises(jsonschema.SchemaError):
+            jsonschema_compiler.compile_schema({'type': 42})
+
+    def test_empty_schema(self):
+        self.assertSameVerdicts({})
+
+    def test_type(self):
+        for type_name in ['string', 'object', 'array', 'boolean', 'null', 'integer', 'number']:
+            self.assertSameVerdicts({'type': type_name})
+        self.assertSameVerdicts({'type': ['string', 'null']})
+        self.assertSameVerdicts({'type': ['integer', 'boolean']})
+
+    def test_enum(self):
+        self.assertSameVerdicts({'enum': ['red', 'green']})
+        self.assertSameVerdicts({'enum': [1, None, [1, 2, 3], {'status': 'green'}]})
+        self.assertSameVerdicts({'type': 'string', 'enum': ['red', 'green', 1]})
+
+    def test_string_keywords(self):
+        self.assertSameVerdicts({'minLength': 1})
+        self.assertSameVerdicts({'maxLength': 3})
+        self.assertSameVerdicts({'type': 'string', 'pattern': '^[a-z]+$'})
+        self.assertSameVerdicts({'pattern': 'e'})
+
+    def test_number_keywords(self):
+        self.assertSameVerdicts({'minimum': 1})
+        self.assertSameVerdicts({'minimum': 1, 'exclusiveMinimum': True})
+        self.assertSameVerdicts({'maximum': 1})
+        self.assertSameVerdicts({'maximum': 1, 'exclusiveMaximum': True})
+        self.assertSameVerdicts({'type': 'integer', 'minimum': 0, 'maximum': 2.5})
+
+    def test_object_keywords(self):
+        schema = {
+            'type': 'object',
+            'properties': {
+                'msg': {
+                    'type': 'string',
+                },
+                'count': {
+                    'type': 'integer',
+                    'maximum': 5,
+                },
+            },
+            'required': [
+                'msg',
+            ],
+            'additionalProperties': False,
+        }
+        self.assertSameVerdicts(schema)
+
+        schema['additionalProperties'] = {'type': 'integer'}
+        self.assertSameVerdicts(schema)
+
+        self.assertSameVerdicts({'required': ['status']})
+        self.assertSameVerdicts({'minProperties': 1, 'maxProperties': 1})
+
+    def test_pattern_properties(self):
+        schema = {
+            'type': 'object',
+            'patternProperties': {
+                '^[a-z]+$': {
+                    'type': 'string',
+                },
+                '^c': {
+                    'maxLength': 2,
+                },
+            },
+            'additionalProperties': False,
+        }
+        self.assertSameVerdicts(schema, [{'Status': 'green'}, {'c1': 'abc'}, {'cc': 'ab'}])
+
+    def test_array_keywords(self):
+        self.assertSameVerdicts({'items': {'type': 'integer'}})
+        self.assertSameVerdicts({'minItems': 1, 'maxItems': 2})
+
+    def test_combinators(self):
+        string_schema = {'type': 'string'}
+        enum_schema = {'enum': ['red', 1]}
+        self.assertSameVerdicts({'allOf': [string_schema, enum_schema]})
+        self.assertSameVerdicts({'anyOf': [string_schema, enum_schema]})
+        self.assertSameVerdicts({'oneOf': [string_schema, enum_schema]})
+        self.assertSameVerdicts({'not': string_schema})
+
+    def test_ref(self):
+        schema = {
+            'definitions': {
+                'color': {
+                    'enum': ['red', 'green'],
+                },
+            },
+            'properties': {
+                'status': {
+                    '$ref': '#/definitions/color',
+                },
+            },
+        }
+        self.assertSameVerdicts(schema)
+
+    def test_recursive_ref(self):
+        schema = {
+            'type': ['array', 'integer'],
+            'items': {
+                '$ref': '#',
+            },
+        }
+        self.assertSameVerdicts(schema, [[1, [2, [3]]], [1, [2, ['3']]]])
+
+    def test_unsupported_keywords_fall_back_to_jsonschema(self):
+        self.assertSameVerdicts({'uniqueItems': True})
+        self.assertSameVerdicts({'multipleOf': 2})
+        self.assertSameVerdicts({'items': [{'type': 'integer'}, {'type': 'integer'}]})
+        self.assertSameVerdicts({
+            'type': 'object',
+            'properties': {
+                'msg': {
+                    'type': 'string',
+                    'dependencies': {
+                        'a': ['b'],
+                    },
+                },
+            },
+        })
+
+    def test_builtin_schemas(self):
+        links = {
+            'self': {
+                'href': 'http://example.com/_health',
+            },
+        }
+        instances = [
+            {'links': links},
+            {'links': {}},
+            {'links': {'self': {}}},
+            {'links': links, 'version': '1.0.0'},
+            {'links': links, 'version': ''},
+            {'links': links, 'status': 'green'},
+            {'links': links, 'status': 'red', 'details': {'db': 'red'}},
+            {'links': links, 'status': 'red', 'details': {'db': 'blue'}},
+            {'links': links, 'status': 'red', 'details': {'db': {'status': 'red', 'details': {'a': 'green'}}}},
+            {'links': links, 'status': 'red', 'details': {'db': {'status': 'red', 'details': {'a': 'blue'}}}},
+            {'links': links, 'status': 'red', 'details': {'db': {'status': 'red'}}},
+            {'links': links, 'status': 'red', 'details': {'d-b': 'red'}},
+        ]
+        self.assertSameVerdicts(jsonschemas.get_noop_response, instances)
+        self.assertSameVerdicts(jsonschemas.get_version_response, instances)
+        self.assertSameVerdicts(jsonschemas.get_health_response, instances)
+
+
+class CompiledValidatorTestCase(unittest.TestCase):
+    """A collection of unit tests for the CompiledValidator class."""
+
+    schema = {
+        'type': 'object',
+        'properties': {
+            'msg': {
+                'type': 'string',
+            },
+        },
+        'required': [
+            'msg',
+        ],
+    }
+
+    def test_source(self):
+        validator = jsonschema_compiler.compile_schema(self.schema)
+        self.assertTrue(validator.schema is self.schema)
+        self.assertIn('def _v0(i):', validator.source)
+
+    def test_validate_valid(self):
+        validator = jsonschema_compiler.compile_schema(self.schema)
+        validator.validate({'msg': 'dave was here'})
+
+    def test_validate_invalid(self):
+        validator = jsonschema_compiler.compile_schema(self.schema)
+        with self.assertRaises(jsonschema.ValidationError) as context_manager:
+            validator.validate({'msg': 42})
+        self.assertEqual(context_manager.exception.validator, 'type')
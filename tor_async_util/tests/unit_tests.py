@@ -1,5 +1,6 @@
 """This module contains unit tests for __init__.py."""
 
+import base64
 import logging
 import json
 import httplib
@@ -10,11 +11,21 @@ import signal
 import tempfile
 import unittest
 import uuid
+import zlib
 
+import concurrent.futures
 import jsonschema
 from keyczar import keyczar
 from keyczar import keyczart
 import mock
+import pycurl
+import tornado.concurrent
+import tornado.curl_httpclient
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.ioloop
+import tornado.netutil
 import tornado.testing
 import tornado.web
 
@@ -152,6 +163,104 @@ class InstallSigIntHandlerTestCase(unittest.TestCase):
             [mock.call(0)])
 
 
+class ServeTestCase(unittest.TestCase):
+    """Unit tests for serve()."""
+
+    def setUp(self):
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+
+    def tearDown(self):
+        self.io_loop.clear_current()
+        self.io_loop.close(all_fds=True)
+
+    def _unused_port(self):
+        (sock, port) = tornado.testing.bind_unused_port()
+        sock.close()
+        return port
+
+    def test_single_process(self):
+        port = self._unused_port()
+        app = tornado.web.Application(handlers=[(SomethingHandler.url_spec, SomethingHandler)])
+        schema = {'type': 'object'}
+        warmup = mock.Mock()
+        responses = []
+
+        def on_fetch_done(future):
+            responses.append(future.result())
+            self.io_loop.stop()
+
+        def on_start(task_id, http_server):
+            self.assertEqual(task_id, 0)
+            self.assertEqual(warmup.call_count, 1)
+            url = 'http://127.0.0.1:%d%s' % (port, SomethingHandler.url_spec)
+            future = tornado.httpclient.AsyncHTTPClient().fetch(url, raise_error=False)
+            self.io_loop.add_future(future, on_fetch_done)
+
+        with mock.patch('tornado.process.fork_processes') as fork_processes_patch:
+            with mock.patch.object(tor_async_util.jsonschema_validators, 'get') as get_patch:
+                task_id = tor_async_util.serve(
+                    app,
+                    port,
+                    address='127.0.0.1',
+                    num_processes=1,
+                    schemas=[schema],
+                    warmup=warmup,
+                    on_start=on_start)
+
+        self.assertEqual(task_id, 0)
+        self.assertEqual(fork_processes_patch.call_count, 0)
+        self.assertEqual(get_patch.call_args_list, [mock.call(schema)])
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].code, httplib.OK)
+
+    def test_worker_binds_with_reuse_port(self):
+        port = self._unused_port()
+        app = tornado.web.Application()
+        on_start = mock.Mock(side_effect=lambda task_id, http_server: self.io_loop.add_callback(self.io_loop.stop))
+        calls = []
+        original_bind_sockets = tornado.netutil.bind_sockets
+
+        def fork_processes(num_processes, max_restarts):
+            calls.append('fork')
+            return 3
+
+        def bind_sockets(*args, **kwargs):
+            calls.append('bind')
+            self.assertTrue(kwargs['reuse_port'])
+            self.assertEqual(kwargs['backlog'], 1024)
+            return original_bind_sockets(*args, **kwargs)
+
+        with mock.patch('tornado.process.fork_processes', side_effect=fork_processes):
+            with mock.patch('tornado.netutil.bind_sockets', side_effect=bind_sockets):
+                with mock.patch('tor_async_util._keyczar_executor', mock.Mock()):
+                    task_id = tor_async_util.serve(
+                        app,
+                        port,
+                        address='127.0.0.1',
+                        num_processes=4,
+                        reuse_port=True,
+                        backlog=1024,
+                        on_start=on_start)
+                    self.assertIsNone(tor_async_util._keyczar_executor)
+
+        self.assertEqual(task_id, 3)
+        self.assertEqual(calls, ['fork', 'bind'])
+        self.assertEqual(on_start.call_count, 1)
+
+    def test_parent_exits(self):
+        port = self._unused_port()
+        app = tornado.web.Application()
+        on_start = mock.Mock()
+
+        with mock.patch('tornado.process.fork_processes', side_effect=SystemExit(0)) as fork_processes_patch:
+            with self.assertRaises(SystemExit):
+                tor_async_util.serve(app, port, address='127.0.0.1', num_processes=0, on_start=on_start)
+
+        self.assertEqual(fork_processes_patch.call_args_list, [mock.call(0, 100)])
+        self.assertEqual(on_start.call_count, 0)
+
+
 class SomethingHandler(tornado.web.RequestHandler):
     """Used by DefaultHandlerTestCase."""
 
@@ -230,6 +339,26 @@ class DefaultHandlerTestCase(tornado.testing.AsyncHTTPTestCase):
         self._test("HEAD")
 
 
+class CannedResponseTestCase(unittest.TestCase):
+    """A collection of unit tests for _canned_response()."""
+
+    def test_canned_responses_prebuilt(self):
+        for status_code in [httplib.BAD_REQUEST, httplib.NOT_FOUND, httplib.INTERNAL_SERVER_ERROR]:
+            self.assertIn(status_code, tor_async_util._canned_responses)
+
+    def test_canned_response_cached(self):
+        canned_response = tor_async_util._canned_response(422)
+        self.assertEqual(canned_response.status_code, 422)
+        self.assertEqual(canned_response.reason, 'Unprocessable Entity')
+        self.assertEqual(json.loads(canned_response.body), {})
+        self.assertTrue(canned_response is tor_async_util._canned_response(422))
+
+    def test_unknown_status_code(self):
+        with self.assertRaises(ValueError):
+            tor_async_util._canned_response(599)
+        self.assertNotIn(599, tor_async_util._canned_responses)
+
+
 class WriteAndVerifyPatcher(Patcher):
     """This context manager provides an easy way to install a
     patch allowing the caller to determine the return value of
@@ -766,6 +895,261 @@ class RequestHandlerTestEdgeCases(unittest.TestCase):
             self.assertEqual(body, the_body)
 
 
+class LRUCacheTestCase(unittest.TestCase):
+    """A collection of unit tests for the _LRUCache class."""
+
+    def test_get_and_put(self):
+        cache = tor_async_util._LRUCache()
+        self.assertIsNone(cache.get('dave'))
+        self.assertEqual(cache.get('dave', 42), 42)
+        cache.put('dave', 'was here')
+        self.assertEqual(cache.get('dave'), 'was here')
+        self.assertEqual(1, len(cache))
+
+    def test_lru_eviction(self):
+        cache = tor_async_util._LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_ttl(self):
+        now = [1000.0]
+        cache = tor_async_util._LRUCache(ttl=10, clock=lambda: now[0])
+        cache.put('dave', 'was here')
+        now[0] += 9
+        self.assertEqual(cache.get('dave'), 'was here')
+        now[0] += 1
+        self.assertIsNone(cache.get('dave'))
+        self.assertEqual(0, len(cache))
+
+    def test_remove_and_clear(self):
+        cache = tor_async_util._LRUCache()
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.remove('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+
+
+class BasicAuthenticatorTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for the BasicAuthenticator class."""
+
+    def _authenticate(self, authenticator, auth_hdr_val):
+        headers = {}
+        if auth_hdr_val is not None:
+            headers['Authorization'] = auth_hdr_val
+        request = mock.Mock(headers=headers)
+        with TornadoRequestHandlerCtrPatcher(request):
+            request_handler = tor_async_util.RequestHandler()
+
+        callback = mock.Mock()
+        authenticator.authenticate(request_handler, callback)
+        self.assertEqual(1, callback.call_count)
+        (principal, error_code, callback_request_handler) = callback.call_args[0]
+        self.assertTrue(callback_request_handler is request_handler)
+        return (principal, error_code)
+
+    def _auth_hdr_val(self, username, password):
+        return 'Basic %s' % base64.b64encode('%s:%s' % (username, password))
+
+    def test_happy_path_with_caching(self):
+        verifier = mock.Mock(return_value='dave')
+        authenticator = tor_async_util.BasicAuthenticator(verifier)
+        auth_hdr_val = self._auth_hdr_val('dave', 'simons')
+
+        for i in range(3):
+            (principal, error_code) = self._authenticate(authenticator, auth_hdr_val)
+            self.assertEqual(principal, 'dave')
+            self.assertEqual(error_code, tor_async_util.RequestHandler.GBAC_OK)
+
+        self.assertEqual(verifier.call_args_list, [mock.call('dave', 'simons')])
+
+    def test_cache_ttl(self):
+        now = [1000.0]
+        verifier = mock.Mock(return_value='dave')
+        authenticator = tor_async_util.BasicAuthenticator(verifier, cache_ttl=60, clock=lambda: now[0])
+        auth_hdr_val = self._auth_hdr_val('dave', 'simons')
+
+        self._authenticate(authenticator, auth_hdr_val)
+        now[0] += 60
+        self._authenticate(authenticator, auth_hdr_val)
+        self.assertEqual(2, verifier.call_count)
+
+    def test_no_authorization_header(self):
+        verifier = mock.Mock()
+        authenticator = tor_async_util.BasicAuthenticator(verifier)
+        (principal, error_code) = self._authenticate(authenticator, None)
+        self.assertIsNone(principal)
+        self.assertEqual(error_code, tor_async_util.RequestHandler.GBAC_NO_AUTHORIZATION_HEADER)
+        self.assertEqual(0, verifier.call_count)
+
+    def test_invalid_authorization_header(self):
+        verifier = mock.Mock()
+        authenticator = tor_async_util.BasicAuthenticator(verifier)
+        for i in range(2):
+            (principal, error_code) = self._authenticate(authenticator, 'Bearer dave')
+            self.assertIsNone(principal)
+            self.assertEqual(error_code, tor_async_util.RequestHandler.GBAC_INVALID_AUTHORIZATION_HEADER_VALUE)
+        self.assertEqual(0, verifier.call_count)
+
+    def test_verification_failed_uses_negative_cache(self):
+        verifier = mock.Mock(return_value=None)
+        authenticator = tor_async_util.BasicAuthenticator(verifier)
+        auth_hdr_val = self._auth_hdr_val('dave', 'bad')
+
+        for i in range(3):
+            (principal, error_code) = self._authenticate(authenticator, auth_hdr_val)
+            self.assertIsNone(principal)
+            self.assertEqual(error_code, tor_async_util.BasicAuthenticator.VERIFICATION_FAILED)
+
+        self.assertEqual(1, verifier.call_count)
+
+        authenticator.clear()
+        self._authenticate(authenticator, auth_hdr_val)
+        self.assertEqual(2, verifier.call_count)
+
+    def test_verifier_error_not_cached(self):
+        verifier = mock.Mock(side_effect=Exception('dave was here'))
+        authenticator = tor_async_util.BasicAuthenticator(verifier)
+        auth_hdr_val = self._auth_hdr_val('dave', 'simons')
+
+        for i in range(2):
+            (principal, error_code) = self._authenticate(authenticator, auth_hdr_val)
+            self.assertIsNone(principal)
+            self.assertEqual(error_code, tor_async_util.BasicAuthenticator.VERIFIER_ERROR)
+
+        self.assertEqual(2, verifier.call_count)
+
+    def test_slow_verifier(self):
+        verifier = mock.Mock(return_value='dave')
+        authenticator = tor_async_util.BasicAuthenticator(verifier, is_verifier_slow=True)
+        auth_hdr_val = self._auth_hdr_val('dave', 'simons')
+
+        request = mock.Mock(headers={'Authorization': auth_hdr_val})
+        with TornadoRequestHandlerCtrPatcher(request):
+            request_handler = tor_async_util.RequestHandler()
+
+        results = []
+
+        def callback(principal, error_code, request_handler):
+            results.append((principal, error_code))
+            if len(results) == 2:
+                self.stop()
+
+        # both calls are made before the verifier completes so
+        # they should share a single call to the verifier
+        authenticator.authenticate(request_handler, callback)
+        authenticator.authenticate(request_handler, callback)
+        self.wait()
+
+        self.assertEqual(results, [('dave', tor_async_util.RequestHandler.GBAC_OK)] * 2)
+        self.assertEqual(1, verifier.call_count)
+
+
+class JSONSchemaValidatorRegistryTestCase(unittest.TestCase):
+    """A collection of unit tests for the JSONSchemaValidatorRegistry class."""
+
+    schema = {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "definitions": {
+            "msg": {
+                "type": "string",
+            },
+        },
+        "type": "object",
+        "properties": {
+            "msg": {
+                "$ref": "#/definitions/msg",
+            },
+        },
+        "required": [
+            "msg",
+        ],
+        "additionalProperties": False,
+    }
+
+    def test_builtin_schemas_preloaded(self):
+        registry = tor_async_util.jsonschema_validators
+        self.assertTrue(3 <= len(registry))
+
+        with mock.patch('jsonschema.validators.validator_for') as validator_for_patch:
+            registry.get(tor_async_util.jsonschemas.get_version_response)
+            registry.get(tor_async_util.jsonschemas.get_noop_response)
+            registry.get(tor_async_util.jsonschemas.get_health_response)
+            self.assertEqual(0, validator_for_patch.call_count)
+
+    def test_validator_reused(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry()
+        validator = registry.get(self.schema)
+        self.assertTrue(validator is registry.get(self.schema))
+        self.assertEqual(1, len(registry))
+
+    def test_keyed_by_identity(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry()
+        schema = dict(self.schema)
+        self.assertEqual(schema, self.schema)
+        self.assertFalse(registry.get(schema) is registry.get(self.schema))
+        self.assertEqual(2, len(registry))
+
+    def test_validate(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry()
+        registry.validate({"msg": "dave was here"}, self.schema)
+        with self.assertRaises(jsonschema.ValidationError):
+            registry.validate({"msg": 42}, self.schema)
+        with self.assertRaises(jsonschema.ValidationError):
+            registry.validate({}, self.schema)
+
+    def test_invalid_schema(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry()
+        schema = {"type": 42}
+        with self.assertRaises(jsonschema.SchemaError):
+            registry.get(schema)
+        self.assertEqual(0, len(registry))
+
+    def test_max_size(self):
+        preloaded_schema = {"type": "object"}
+        registry = tor_async_util.JSONSchemaValidatorRegistry([preloaded_schema], max_size=3)
+        schemas = [{"type": "string"} for i in range(3)]
+        for schema in schemas:
+            registry.get(schema)
+        self.assertEqual(2, len(registry))
+        self.assertTrue(registry.get(preloaded_schema) is registry.get(preloaded_schema))
+
+    def test_compile_schemas(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry(compile_schemas=True)
+        self.assertTrue(registry.compile_schemas)
+        validator = registry.get(self.schema)
+        self.assertTrue(isinstance(validator, tor_async_util.jsonschema_compiler.CompiledValidator))
+        registry.validate({"msg": "dave was here"}, self.schema)
+        with self.assertRaises(jsonschema.ValidationError):
+            registry.validate({"msg": 42}, self.schema)
+
+    def test_compile_schemas_only_compiles_draft4_schemas(self):
+        registry = tor_async_util.JSONSchemaValidatorRegistry(compile_schemas=True)
+        schema = {
+            "$schema": "http://json-schema.org/draft-03/schema#",
+            "type": "object",
+        }
+        self.assertTrue(isinstance(registry.get(schema), jsonschema.Draft3Validator))
+
+    def test_changing_compile_schemas_discards_validators(self):
+        preloaded_schema = {"type": "object"}
+        registry = tor_async_util.JSONSchemaValidatorRegistry([preloaded_schema])
+        registry.get(self.schema)
+        self.assertEqual(2, len(registry))
+
+        registry.compile_schemas = True
+        self.assertEqual(1, len(registry))
+        self.assertTrue(isinstance(
+            registry.get(preloaded_schema),
+            tor_async_util.jsonschema_compiler.CompiledValidator))
+
+
 class TestWriteAndVerifyRequestHandler(tor_async_util.RequestHandler):
     """This class is only used by ```WriteAndVerifyTestCase```."""
 
@@ -801,6 +1185,76 @@ class TestWriteAndVerifyRequestHandler(tor_async_util.RequestHandler):
         self.finish()
 
 
+class ResponseValidationPolicyTestCase(unittest.TestCase):
+    """A collection of unit tests for the ResponseValidationPolicy class."""
+
+    def test_ctr(self):
+        policy = tor_async_util.ResponseValidationPolicy()
+        self.assertEqual(policy.mode, tor_async_util.ResponseValidationPolicy.ALWAYS)
+        self.assertEqual(policy.sample_rate, 1)
+        self.assertEqual(policy.num_validated, 0)
+        self.assertEqual(policy.num_skipped, 0)
+        self.assertEqual(policy.num_failures, 0)
+
+    def test_always(self):
+        policy = tor_async_util.ResponseValidationPolicy(tor_async_util.ResponseValidationPolicy.ALWAYS)
+        schema = {}
+        for i in range(10):
+            self.assertTrue(policy.should_validate(schema))
+        self.assertEqual(policy.num_validated, 10)
+        self.assertEqual(policy.num_skipped, 0)
+
+    def test_off(self):
+        policy = tor_async_util.ResponseValidationPolicy(tor_async_util.ResponseValidationPolicy.OFF)
+        schema = {}
+        for i in range(10):
+            self.assertFalse(policy.should_validate(schema))
+        self.assertEqual(policy.num_validated, 0)
+        self.assertEqual(policy.num_skipped, 10)
+
+    def test_sample(self):
+        policy = tor_async_util.ResponseValidationPolicy(
+            tor_async_util.ResponseValidationPolicy.SAMPLE,
+            sample_rate=5)
+        schema = {}
+        verdicts = [policy.should_validate(schema) for i in range(10)]
+        self.assertEqual(verdicts, [True, False, False, False, False] * 2)
+        self.assertEqual(policy.num_validated, 2)
+        self.assertEqual(policy.num_skipped, 8)
+
+    def test_sample_with_schema_sample_rates(self):
+        schema1 = {'title': 'schema 1'}
+        schema2 = {'title': 'schema 2'}
+        schema3 = {'title': 'schema 3'}
+        policy = tor_async_util.ResponseValidationPolicy(
+            tor_async_util.ResponseValidationPolicy.SAMPLE,
+            sample_rate=5,
+            schema_sample_rates={
+                'schema 1': 1,
+            })
+        policy.set_schema_sample_rate(schema2, 0)
+
+        self.assertEqual([policy.should_validate(schema1) for i in range(5)], [True] * 5)
+        self.assertEqual([policy.should_validate(schema2) for i in range(5)], [False] * 5)
+        self.assertEqual(
+            [policy.should_validate(schema3) for i in range(5)],
+            [True, False, False, False, False])
+
+
+class ResponseValidationPolicyPatcher(Patcher):
+    """This context manager provides an easy way to install a
+    patch allowing the caller to determine the value of
+    tor_async_util.response_validation_policy.
+    """
+
+    def __init__(self, policy):
+        patcher = mock.patch(
+            'tor_async_util.response_validation_policy',
+            policy)
+
+        Patcher.__init__(self, patcher)
+
+
 class WriteAndVerifyTestCase(tornado.testing.AsyncHTTPTestCase):
     """A collection of unit tests for
     RequestHandler.write_and_verify."""
@@ -826,6 +1280,29 @@ class WriteAndVerifyTestCase(tornado.testing.AsyncHTTPTestCase):
             method="GET")
         self.assertEqual(response.code, httplib.BAD_REQUEST)
 
+    def test_bad_with_validation_off(self):
+        policy = tor_async_util.ResponseValidationPolicy(tor_async_util.ResponseValidationPolicy.OFF)
+        with ResponseValidationPolicyPatcher(policy):
+            response = self.fetch(
+                "/dave?good_response=no",
+                method="GET")
+            self.assertEqual(response.code, httplib.OK)
+            self.assertEqual(policy.num_skipped, 1)
+
+    def test_bad_with_validation_sampled(self):
+        policy = tor_async_util.ResponseValidationPolicy(
+            tor_async_util.ResponseValidationPolicy.SAMPLE,
+            sample_rate=1)
+        with ResponseValidationPolicyPatcher(policy):
+            with mock.patch(__name__ + '.tor_async_util._logger') as logger_patch:
+                response = self.fetch(
+                    "/dave?good_response=no",
+                    method="GET")
+                self.assertEqual(response.code, httplib.BAD_REQUEST)
+                self.assertEqual(policy.num_validated, 1)
+                self.assertEqual(policy.num_failures, 1)
+                self.assertEqual(logger_patch.error.call_count, 1)
+
 
 class TestWriteBadRequestResponseRequestHandler(tor_async_util.RequestHandler):
     """This class is only used by ```WriteBadRequestResponseTestCase```."""
@@ -967,10 +1444,10 @@ class WriteErrorTestCase(tornado.testing.AsyncHTTPTestCase):
 
 class TempConfigFile(object):
 
-    def __init__(self, option=None, value=None, values=None):
+    def __init__(self, option=None, value=None, values=None, section=None):
         object.__init__(self)
 
-        self.section = uuid.uuid4().hex
+        self.section = section or uuid.uuid4().hex
 
         ntf = tempfile.NamedTemporaryFile(delete=False)
         self.filename = ntf.name
@@ -1188,6 +1665,51 @@ class ConfigTestCase(unittest.TestCase):
             read_value = config.get_logging_level(tcf.section, option, value_if_not_found)
             self.assertEqual(read_value, value_if_not_found)
 
+    def test_get_response_validation_policy(self):
+        values = [
+            ('always', tor_async_util.ResponseValidationPolicy.ALWAYS, 1, {}),
+            ('OFF', tor_async_util.ResponseValidationPolicy.OFF, 1, {}),
+            ('sample 10', tor_async_util.ResponseValidationPolicy.SAMPLE, 10, {}),
+            (
+                'sample 10, get health response: 1, get version response:0',
+                tor_async_util.ResponseValidationPolicy.SAMPLE,
+                10,
+                {'get health response': 1, 'get version response': 0},
+            ),
+        ]
+        for (value, expected_mode, expected_sample_rate, expected_schema_sample_rates) in values:
+            option = uuid.uuid4().hex
+            with TempConfigFile(option, value) as tcf:
+                config = tor_async_util.Config(tcf.filename)
+                policy = config.get_response_validation_policy(tcf.section, option)
+                self.assertEqual(policy.mode, expected_mode)
+                self.assertEqual(policy.sample_rate, expected_sample_rate)
+                for (title, expected_rate) in expected_schema_sample_rates.items():
+                    self.assertEqual(policy._sample_rate({'title': title}), expected_rate)
+
+    def test_get_response_validation_policy_not_found(self):
+        with TempConfigFile() as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            value_if_not_found = uuid.uuid4().hex
+            read_value = config.get_response_validation_policy(tcf.section, uuid.uuid4().hex, value_if_not_found)
+            self.assertEqual(read_value, value_if_not_found)
+
+    def test_get_response_validation_policy_not_a_policy(self):
+        values = [
+            uuid.uuid4().hex,
+            'sample',
+            'always 10',
+            'off, get health response: 1',
+            'sample 10, get health response',
+        ]
+        for value in values:
+            option = uuid.uuid4().hex
+            with TempConfigFile(option, value) as tcf:
+                config = tor_async_util.Config(tcf.filename)
+                value_if_not_found = uuid.uuid4().hex
+                read_value = config.get_response_validation_policy(tcf.section, option, value_if_not_found)
+                self.assertEqual(read_value, value_if_not_found)
+
     def test_get_keyczar_crypter_happy_path(self):
         with TempDirectory() as dir_name:
             keyczart.Create(dir_name, "some purpose", keyczart.keyinfo.DECRYPT_AND_ENCRYPT)
@@ -1245,6 +1767,388 @@ class ConfigTestCase(unittest.TestCase):
                 self.assertEqual(signer, value_if_not_found)
 
 
+class KeyczarKeyStoreCacheTestCase(unittest.TestCase):
+    """A collection of unit tests for the KeyczarKeyStoreCache class."""
+
+    def test_cache_and_rotation(self):
+        clock = mock.Mock(return_value=100.0)
+        cache = tor_async_util.KeyczarKeyStoreCache(check_interval=1.0, clock=clock)
+
+        with TempDirectory() as dir_name:
+            keyczart.Create(dir_name, "some purpose", keyczart.keyinfo.DECRYPT_AND_ENCRYPT)
+            keyczart.AddKey(dir_name, keyczart.keyinfo.PRIMARY)
+
+            with mock.patch('keyczar.keyczar.Crypter.Read', wraps=keyczar.Crypter.Read) as read_patch:
+                crypter = cache.get(keyczar.Crypter, dir_name)
+                self.assertEqual(type(crypter), keyczar.Crypter)
+                self.assertTrue(cache.get(keyczar.Crypter, dir_name) is crypter)
+                self.assertEqual(read_patch.call_count, 1)
+                self.assertEqual(len(cache), 1)
+
+                # key store unchanged
+                clock.return_value = 101.0
+                with mock.patch('os.stat', wraps=os.stat) as stat_patch:
+                    self.assertTrue(cache.get(keyczar.Crypter, dir_name) is crypter)
+                    self.assertEqual(stat_patch.call_count, 2)
+                    self.assertTrue(cache.get(keyczar.Crypter, dir_name) is crypter)
+                    self.assertEqual(stat_patch.call_count, 2)
+                self.assertEqual(read_patch.call_count, 1)
+
+                # key rotation
+                keyczart.AddKey(dir_name, keyczart.keyinfo.PRIMARY)
+                meta_filename = os.path.join(dir_name, 'meta')
+                os.utime(meta_filename, (0, os.stat(meta_filename).st_mtime + 10))
+                self.assertTrue(cache.get(keyczar.Crypter, dir_name) is crypter)
+                clock.return_value = 102.0
+                rotated_crypter = cache.get(keyczar.Crypter, dir_name)
+                self.assertFalse(rotated_crypter is crypter)
+                self.assertEqual(read_patch.call_count, 2)
+                self.assertEqual(rotated_crypter.Decrypt(crypter.Encrypt('dave')), 'dave')
+
+            cache.clear()
+            self.assertEqual(len(cache), 0)
+
+    def test_read_errors_not_cached(self):
+        cache = tor_async_util.KeyczarKeyStoreCache()
+        with TempDirectory() as dir_name:
+            with self.assertRaises(Exception):
+                cache.get(keyczar.Signer, dir_name)
+        self.assertEqual(len(cache), 0)
+
+    def test_config_uses_cache(self):
+        with TempDirectory() as dir_name:
+            keyczart.Create(dir_name, "some purpose", keyczart.keyinfo.SIGN_AND_VERIFY)
+
+            option = uuid.uuid4().hex
+            with TempConfigFile(option, dir_name) as tcf:
+                config = tor_async_util.Config(tcf.filename)
+                signer = config.get_keyczar_signer(tcf.section, option)
+                self.assertTrue(config.get_keyczar_signer(tcf.section, option) is signer)
+
+
+class AsyncKeyczarTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for the AsyncKeyczar class."""
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+        tor_async_util.metrics_registry.clear()
+
+    def tearDown(self):
+        tor_async_util.metrics_registry.clear()
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def _create_async_keyczar(self, dir_name, purpose, reader_class):
+        keyczart.Create(dir_name, "some purpose", purpose)
+        keyczart.AddKey(dir_name, keyczart.keyinfo.PRIMARY)
+        return tor_async_util.AsyncKeyczar(reader_class.Read(dir_name))
+
+    @tornado.testing.gen_test
+    def test_encrypt_and_decrypt(self):
+        with TempDirectory() as dir_name:
+            crypter = self._create_async_keyczar(dir_name, keyczart.keyinfo.DECRYPT_AND_ENCRYPT, keyczar.Crypter)
+
+            ciphertext = yield crypter.encrypt('dave')
+            plaintext = yield crypter.decrypt(ciphertext)
+            self.assertEqual(plaintext, 'dave')
+
+            with self.assertRaises(Exception):
+                yield crypter.decrypt('not a ciphertext')
+
+        self.assertEqual(tor_async_util._keyczar_duration_seconds.count(('encrypt',)), 1)
+        self.assertEqual(tor_async_util._keyczar_duration_seconds.count(('decrypt',)), 2)
+        self.assertEqual(tor_async_util._keyczar_queue_seconds.count(('decrypt',)), 2)
+        self.assertEqual(tor_async_util._keyczar_queue_depth.value(('decrypt',)), 0)
+
+    @tornado.testing.gen_test
+    def test_sign_and_verify_batch(self):
+        with TempDirectory() as dir_name:
+            signer = self._create_async_keyczar(dir_name, keyczart.keyinfo.SIGN_AND_VERIFY, keyczar.Signer)
+
+            datas = ['dave', 'was', 'here']
+            signatures = yield signer.sign_batch(datas)
+            self.assertEqual(len(signatures), len(datas))
+
+            datas_and_signatures = zip(datas, signatures) + [('dave', signatures[1]), ('dave', 'bad')]
+            verdicts = yield signer.verify_batch(datas_and_signatures)
+            self.assertEqual(verdicts, [True, True, True, False, None])
+
+        self.assertEqual(tor_async_util._keyczar_duration_seconds.count(('sign_batch',)), 1)
+        self.assertEqual(tor_async_util._keyczar_duration_seconds.count(('verify_batch',)), 1)
+
+    def test_callback(self):
+        with TempDirectory() as dir_name:
+            crypter = self._create_async_keyczar(dir_name, keyczart.keyinfo.DECRYPT_AND_ENCRYPT, keyczar.Crypter)
+
+            def on_done(result, async_keyczar):
+                self.assertTrue(async_keyczar is crypter)
+                self.stop(result)
+
+            crypter.encrypt_batch(['dave', 'was'], on_done)
+            ciphertexts = self.wait()
+            self.assertEqual(len(ciphertexts), 2)
+
+            future = crypter.decrypt('not a ciphertext', on_done)
+            self.assertIsNone(self.wait())
+            self.assertIsNone(future.result())
+
+    def test_executor(self):
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        reader = mock.Mock()
+        reader.Encrypt.return_value = 'ciphertext'
+        async_keyczar = tor_async_util.AsyncKeyczar(reader, executor=executor)
+
+        with mock.patch('tor_async_util.get_keyczar_executor') as get_keyczar_executor_patch:
+            self.io_loop.add_future(async_keyczar.encrypt('dave'), self.stop)
+            self.assertEqual(self.wait().result(), 'ciphertext')
+            self.assertEqual(get_keyczar_executor_patch.call_count, 0)
+
+        reader.Encrypt.assert_called_once_with('dave')
+        executor.shutdown()
+
+    def test_get_keyczar_executor(self):
+        with mock.patch('tor_async_util._keyczar_executor', None):
+            with mock.patch('tor_async_util.keyczar_max_workers', 2):
+                executor = tor_async_util.get_keyczar_executor()
+                self.assertTrue(tor_async_util.get_keyczar_executor() is executor)
+                self.assertEqual(executor._max_workers, 2)
+                executor.shutdown()
+
+
+class ConfigSnapshotTestCase(unittest.TestCase):
+    """A collection of unit tests for Config.snapshot() and ConfigOption."""
+
+    def test_config_option_ctr(self):
+        option = tor_async_util.ConfigOption('service', 'port', tor_async_util.ConfigOption.INT, default=8000)
+        self.assertEqual(option.name, 'port')
+        self.assertFalse(option.is_required)
+        self.assertTrue(tor_async_util.ConfigOption('service', 'port').is_required)
+        self.assertEqual(tor_async_util.ConfigOption('service', 'port').type, 'string')
+
+        with self.assertRaises(tor_async_util.ConfigError):
+            tor_async_util.ConfigOption('service', 'port', 'dave')
+
+        with self.assertRaises(tor_async_util.ConfigError) as context_manager:
+            tor_async_util.ConfigOption('service', 'max-port')
+        self.assertIn("use name", str(context_manager.exception))
+
+        option = tor_async_util.ConfigOption('service', 'max-port', name='max_port')
+        self.assertEqual(option.option, 'max-port')
+        self.assertEqual(option.name, 'max_port')
+        self.assertEqual(option.section_name, 'service')
+
+        with self.assertRaises(tor_async_util.ConfigError) as context_manager:
+            tor_async_util.ConfigOption('my-service', 'port')
+        self.assertIn("use section_name", str(context_manager.exception))
+
+        option = tor_async_util.ConfigOption('my-service', 'port', section_name='my_service')
+        self.assertEqual(option.section, 'my-service')
+        self.assertEqual(option.section_name, 'my_service')
+
+    def test_section_name(self):
+        options = [
+            tor_async_util.ConfigOption(
+                'my-service',
+                'port',
+                tor_async_util.ConfigOption.INT,
+                section_name='my_service'),
+        ]
+        with TempConfigFile('port', '8445', section='my-service') as tcf:
+            snapshot = tor_async_util.Config(tcf.filename).snapshot(options)
+        self.assertEqual(snapshot.my_service.port, 8445)
+
+    def test_happy_path(self):
+        values = [
+            ('address', '~/dave'),
+            ('port', '8445'),
+            ('debug', 'yes'),
+            ('logging-level', 'warning'),
+            ('response_validation', 'sample 10'),
+        ]
+        options = [
+            tor_async_util.ConfigOption('service', 'address'),
+            tor_async_util.ConfigOption('service', 'port', tor_async_util.ConfigOption.INT),
+            tor_async_util.ConfigOption('service', 'debug', tor_async_util.ConfigOption.BOOLEAN),
+            tor_async_util.ConfigOption(
+                'service',
+                'logging-level',
+                tor_async_util.ConfigOption.LOGGING_LEVEL,
+                name='logging_level'),
+            tor_async_util.ConfigOption(
+                'service',
+                'response_validation',
+                tor_async_util.ConfigOption.RESPONSE_VALIDATION_POLICY),
+            tor_async_util.ConfigOption('service', 'max_clients', tor_async_util.ConfigOption.INT, default=100),
+            tor_async_util.ConfigOption('other', 'dave', default=None),
+        ]
+        with TempConfigFile(values=values, section='service') as tcf:
+            snapshot = tor_async_util.Config(tcf.filename).snapshot(options)
+
+        self.assertEqual(snapshot.service.address, os.path.expanduser('~/dave'))
+        self.assertEqual(snapshot.service.port, 8445)
+        self.assertTrue(snapshot.service.debug)
+        self.assertEqual(snapshot.service.logging_level, logging.WARNING)
+        self.assertEqual(snapshot.service.response_validation.sample_rate, 10)
+        self.assertEqual(snapshot.service.max_clients, 100)
+        self.assertIsNone(snapshot.other.dave)
+        self.assertIn('port=8445', repr(snapshot.service))
+
+    def test_immutable(self):
+        options = [
+            tor_async_util.ConfigOption('service', 'port', tor_async_util.ConfigOption.INT),
+        ]
+        with TempConfigFile('port', '80', section='service') as tcf:
+            snapshot = tor_async_util.Config(tcf.filename).snapshot(options)
+
+        with self.assertRaises(AttributeError):
+            snapshot.service.port = 81
+        with self.assertRaises(AttributeError):
+            snapshot.service.dave = 81
+        with self.assertRaises(AttributeError):
+            del snapshot.service.port
+        with self.assertRaises(AttributeError):
+            snapshot.service = None
+        self.assertEqual(snapshot.service.port, 80)
+        self.assertFalse(hasattr(snapshot.service, '__dict__'))
+
+    def test_errors(self):
+        values = [
+            ('port', 'dave'),
+            ('debug', 'maybe'),
+            ('logging_level', 'LOUD'),
+        ]
+        options = [
+            tor_async_util.ConfigOption('service', 'port', tor_async_util.ConfigOption.INT),
+            tor_async_util.ConfigOption('service', 'debug', tor_async_util.ConfigOption.BOOLEAN, default=False),
+            tor_async_util.ConfigOption('service', 'logging_level', tor_async_util.ConfigOption.LOGGING_LEVEL),
+            tor_async_util.ConfigOption('service', 'address'),
+            tor_async_util.ConfigOption('service', 'port'),
+        ]
+        with TempConfigFile(values=values, section='service') as tcf:
+            with self.assertRaises(tor_async_util.ConfigError) as context_manager:
+                tor_async_util.Config(tcf.filename).snapshot(options)
+
+        msg = str(context_manager.exception)
+        self.assertIn("option 'port' in section 'service' isn't a valid int", msg)
+        self.assertIn("option 'debug' in section 'service' isn't a valid boolean", msg)
+        self.assertIn("option 'logging_level' in section 'service' isn't a valid logging level", msg)
+        self.assertIn("option 'address' not found in section 'service'", msg)
+        self.assertIn("option 'port' in section 'service' declared more than once", msg)
+
+
+class ConfigReloaderTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for the ConfigReloader class."""
+
+    options = [
+        tor_async_util.ConfigOption('service', 'timeout', tor_async_util.ConfigOption.INT),
+    ]
+
+    def _rewrite(self, tcf, value):
+        with open(tcf.filename, 'w') as f:
+            f.write('[service]\ntimeout=%s\n' % value)
+
+    def test_check(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            reloader = tor_async_util.ConfigReloader(config, options=type(self).options)
+            self.assertEqual(reloader.snapshot.service.timeout, 5)
+
+            listener = mock.Mock()
+            reloader.add_listener(listener)
+
+            reloader.check()
+            self.assertTrue(reloader.config is config)
+            self.assertEqual(listener.call_count, 0)
+
+            self._rewrite(tcf, '100')
+            reloader.check()
+            self.assertFalse(reloader.config is config)
+            self.assertEqual(reloader.snapshot.service.timeout, 100)
+            listener.assert_called_once_with(reloader.config, config)
+
+            reloader.remove_listener(listener)
+            self._rewrite(tcf, '1000')
+            reloader.check()
+            self.assertEqual(reloader.snapshot.service.timeout, 1000)
+            self.assertEqual(listener.call_count, 1)
+
+    def test_invalid_config_keeps_current_config(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            reloader = tor_async_util.ConfigReloader(config, options=type(self).options)
+            listener = mock.Mock()
+            reloader.add_listener(listener)
+
+            self._rewrite(tcf, 'dave')
+            self.assertFalse(reloader.reload())
+            self.assertTrue(reloader.config is config)
+            self.assertEqual(reloader.snapshot.service.timeout, 5)
+            self.assertEqual(listener.call_count, 0)
+
+    def test_empty_config_keeps_current_config(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            reloader = tor_async_util.ConfigReloader(config)
+            listener = mock.Mock()
+            reloader.add_listener(listener)
+
+            with open(tcf.filename, 'w'):
+                pass
+            self.assertFalse(reloader.reload())
+            self.assertTrue(reloader.config is config)
+
+            os.remove(tcf.filename)
+            self.assertFalse(reloader.reload())
+            self.assertTrue(reloader.config is config)
+            self.assertEqual(listener.call_count, 0)
+
+            self._rewrite(tcf, '100')
+
+    def test_swaps_config_instance_and_survives_listener_errors(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            with mock.patch.object(tor_async_util.Config, 'instance', config):
+                reloader = tor_async_util.ConfigReloader(config)
+                self.assertIsNone(reloader.snapshot)
+                listeners = [mock.Mock(side_effect=Exception('dave was here')), mock.Mock()]
+                for listener in listeners:
+                    reloader.add_listener(listener)
+
+                self.assertTrue(reloader.reload())
+                self.assertTrue(tor_async_util.Config.instance is reloader.config)
+                self.assertEqual(tor_async_util.Config.instance.get_int('service', 'timeout'), 5)
+                self.assertEqual(listeners[1].call_count, 1)
+
+    def test_missing_config_file(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            config = tor_async_util.Config(tcf.filename)
+            reloader = tor_async_util.ConfigReloader(config)
+        reloader.check()
+        self.assertTrue(reloader.config is config)
+
+    def test_start_and_stop(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            reloader = tor_async_util.ConfigReloader(tor_async_util.Config(tcf.filename), interval=0.01)
+            reloader.add_listener(lambda new_config, old_config: self.stop())
+            reloader.start()
+            self._rewrite(tcf, '100')
+            self.wait()
+            reloader.stop()
+            reloader.stop()
+            self.assertEqual(reloader.config.get_int('service', 'timeout'), 100)
+
+    def test_sighup(self):
+        with TempConfigFile('timeout', '5', section='service') as tcf:
+            reloader = tor_async_util.ConfigReloader(tor_async_util.Config(tcf.filename))
+            reloader.add_listener(lambda new_config, old_config: self.stop())
+            previous_handler = signal.getsignal(signal.SIGHUP)
+            try:
+                reloader.install_sighup_handler()
+                os.kill(os.getpid(), signal.SIGHUP)
+                self.wait()
+            finally:
+                signal.signal(signal.SIGHUP, previous_handler)
+
+
 class LoggerIsEnabledForPatcher(Patcher):
     """This context manager provides an easy way to install a
     patch allowing the caller to determine the return value of
@@ -1272,7 +2176,9 @@ class TestAddDebugDetailsRequestHandler(tor_async_util.RequestHandler):
 
     @tornado.web.asynchronous
     def get(self):
-        value = int(self.get_argument('value', 0))
+        value = self.get_argument('raw_value', None)
+        if value is None:
+            value = int(self.get_argument('value', 0))
         self.add_debug_details(value)
         self.write({})
         self.set_status(httplib.OK)
@@ -1310,6 +2216,326 @@ class AddDebugDetailsTestCase(RequestHandlerTestCase):
     def test_no_debug_details_enabled(self):
         self._test_debug_details(False)
 
+    def test_non_integer_debug_details_counted(self):
+        tor_async_util.metrics_registry.clear()
+        with LoggerIsEnabledForPatcher(False):
+            # second value is non-ascii
+            for raw_value in ['abc', '%C3%A9']:
+                response = self.fetch(
+                    '%s?raw_value=%s' % (TestAddDebugDetailsRequestHandler.url_spec, raw_value),
+                    method='GET')
+                self.assertEqual(response.code, httplib.OK)
+                self.assertNoDebugDetail(response)
+        label_values = (TestAddDebugDetailsRequestHandler.__name__, 'other')
+        self.assertEqual(tor_async_util._debug_details_total.value(label_values), 2)
+
+
+class RequestResponseLoggingPolicyTestCase(unittest.TestCase):
+    """A collection of unit tests for the RequestResponseLoggingPolicy class."""
+
+    def test_should_log(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy()
+        request_handler = mock.Mock()
+        self.assertEqual([policy.should_log(request_handler) for i in range(3)], [True] * 3)
+
+    def test_should_log_sampled(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy(sample_rate=3)
+        request_handler = mock.Mock()
+        self.assertEqual(
+            [policy.should_log(request_handler) for i in range(6)],
+            [True, False, False] * 2)
+
+    def test_should_log_route_sample_rates(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy(
+            sample_rate=3,
+            route_sample_rates={
+                'Mock': 0,
+                mock.MagicMock: 1,
+            })
+        self.assertEqual([policy.should_log(mock.Mock()) for i in range(3)], [False] * 3)
+        self.assertEqual([policy.should_log(mock.MagicMock()) for i in range(3)], [True] * 3)
+
+    def test_format_headers_redacts(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy()
+        headers = {
+            'authorization': 'Basic ZGF2ZTpzaW1vbnM=',
+            'Content-Type': 'application/json',
+        }
+        self.assertEqual(
+            sorted(policy.format_headers(headers)),
+            ['Content-Type: application/json', 'authorization: <redacted>'])
+
+    def test_format_body(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy(max_body_bytes=None)
+        self.assertEqual(policy.format_body(['abc', 'def']), 'abcdef')
+
+        policy = tor_async_util.RequestResponseLoggingPolicy(max_body_bytes=4)
+        self.assertEqual(policy.format_body(['abc']), 'abc')
+        self.assertEqual(policy.format_body(['abc', 'def', 'ghi']), 'abcd... (5 bytes truncated)')
+
+
+class TestLoggingRequestHandler(tor_async_util.RequestHandler):
+    """This class is only used by ```RequestResponseLoggingTestCase```."""
+
+    url_spec = r"/dave"
+
+    @tornado.web.asynchronous
+    def get(self):
+        self.write({'msg': 'dave was here'})
+        self.set_status(httplib.OK)
+        self.finish()
+
+
+class RequestResponseLoggingTestCase(RequestHandlerTestCase):
+    """A collection of unit tests for request and response
+    logging in RequestHandler.prepare() and RequestHandler.flush()."""
+
+    def get_app(self):
+        handlers = [
+            (
+                TestLoggingRequestHandler.url_spec,
+                TestLoggingRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def test_debug_disabled(self):
+        with LoggerIsEnabledForPatcher(False):
+            with mock.patch(__name__ + '.tor_async_util._logger.debug') as debug_patch:
+                should_log_patch_target = __name__ + '.tor_async_util.RequestResponseLoggingPolicy.should_log'
+                with mock.patch(should_log_patch_target) as should_log_patch:
+                    response = self.fetch(TestLoggingRequestHandler.url_spec, method='GET')
+                    self.assertEqual(response.code, httplib.OK)
+                    self.assertEqual(0, should_log_patch.call_count)
+                    self.assertEqual(0, debug_patch.call_count)
+
+    def test_debug_enabled(self):
+        with LoggerIsEnabledForPatcher(True):
+            with mock.patch(__name__ + '.tor_async_util._logger.debug') as debug_patch:
+                headers = {
+                    'Authorization': 'Basic ZGF2ZTpzaW1vbnM=',
+                }
+                response = self.fetch(TestLoggingRequestHandler.url_spec, method='GET', headers=headers)
+                self.assertEqual(response.code, httplib.OK)
+                self.assertEqual(2, debug_patch.call_count)
+
+                (fmt, request) = debug_patch.call_args_list[0][0]
+                self.assertTrue(fmt.startswith('Received Request'))
+                self.assertIn('Authorization: <redacted>', request)
+                self.assertNotIn('ZGF2ZTpzaW1vbnM=', request)
+
+                (fmt, response) = debug_patch.call_args_list[1][0]
+                self.assertTrue(fmt.startswith('Sending Response'))
+                self.assertIn('dave was here', response)
+
+    def test_debug_enabled_not_sampled(self):
+        policy = tor_async_util.RequestResponseLoggingPolicy(sample_rate=0)
+        with mock.patch('tor_async_util.request_response_logging_policy', policy):
+            with LoggerIsEnabledForPatcher(True):
+                with mock.patch(__name__ + '.tor_async_util._logger.debug') as debug_patch:
+                    response = self.fetch(TestLoggingRequestHandler.url_spec, method='GET')
+                    self.assertEqual(response.code, httplib.OK)
+                    self.assertEqual(0, debug_patch.call_count)
+
+
+class TestETagRequestHandler(tor_async_util.RequestHandler):
+    """This class is only used by ```ETagTestCase```."""
+
+    url_spec = r"/dave"
+
+    generate_etags = True
+
+    @tornado.web.asynchronous
+    def get(self):
+        version = self.get_argument('version', None)
+        if version is not None:
+            self.set_etag_version(version)
+        self.write({'msg': self.get_argument('msg', 'dave was here')})
+        self.set_status(httplib.OK)
+        self.finish()
+
+
+class TestNoETagRequestHandler(TestETagRequestHandler):
+    """This class is only used by ```ETagTestCase```."""
+
+    url_spec = r"/bob"
+
+    generate_etags = False
+
+
+class ETagTestCase(RequestHandlerTestCase):
+    """A collection of unit tests for RequestHandler.compute_etag()."""
+
+    def get_app(self):
+        handlers = [
+            (
+                TestETagRequestHandler.url_spec,
+                TestETagRequestHandler
+            ),
+            (
+                TestNoETagRequestHandler.url_spec,
+                TestNoETagRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def test_etags_disabled_by_default(self):
+        response = self.fetch(TestNoETagRequestHandler.url_spec)
+        self.assertEqual(response.code, httplib.OK)
+        self.assertNotIn('Etag', response.headers)
+
+    def test_body_hash(self):
+        response = self.fetch(TestETagRequestHandler.url_spec)
+        self.assertEqual(response.code, httplib.OK)
+        etag = response.headers['Etag']
+        self.assertTrue(re.match(r'^"[0-9a-f]+-[0-9a-f]{8}"$', etag))
+
+        response = self.fetch(TestETagRequestHandler.url_spec, headers={'If-None-Match': etag})
+        self.assertEqual(response.code, httplib.NOT_MODIFIED)
+        self.assertEqual(response.body, '')
+
+        response = self.fetch(TestETagRequestHandler.url_spec + '?msg=bob', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, httplib.OK)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    def test_version(self):
+        response = self.fetch(TestETagRequestHandler.url_spec + '?version=42')
+        self.assertEqual(response.code, httplib.OK)
+        self.assertEqual(response.headers['Etag'], '"42"')
+
+        response = self.fetch(
+            TestETagRequestHandler.url_spec + '?version=42&msg=bob',
+            headers={'If-None-Match': '"42"'})
+        self.assertEqual(response.code, httplib.NOT_MODIFIED)
+        self.assertEqual(response.body, '')
+
+        response = self.fetch(TestETagRequestHandler.url_spec + '?version=43', headers={'If-None-Match': '"42"'})
+        self.assertEqual(response.code, httplib.OK)
+
+
+class TestCompressionRequestHandler(tor_async_util.RequestHandler):
+    """This class is only used by ```CompressionTestCase```."""
+
+    url_spec = r"/dave"
+
+    compress_responses = True
+
+    compression_min_size = 100
+
+    @tornado.web.asynchronous
+    def get(self):
+        if self.get_argument('static', None):
+            self.set_static_response()
+        self.write({'msg': 'dave was here' * int(self.get_argument('repeat', 1))})
+        self.set_status(httplib.OK)
+        self.finish()
+
+
+class TestCompressedVersionRequestHandler(tor_async_util.RequestHandler):
+    """This class is only used by ```CompressionTestCase```."""
+
+    url_spec = r"/_version"
+
+    compress_responses = True
+
+    @tornado.web.asynchronous
+    def get(self):
+        tor_async_util.generate_version_response(self, self.get_argument('version', '1.0.0'))
+
+
+class CompressionTestCase(RequestHandlerTestCase):
+    """A collection of unit tests for RequestHandler's response compression."""
+
+    def get_app(self):
+        handlers = [
+            (
+                TestCompressionRequestHandler.url_spec,
+                TestCompressionRequestHandler
+            ),
+            (
+                TestCompressedVersionRequestHandler.url_spec,
+                TestCompressedVersionRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def setUp(self):
+        RequestHandlerTestCase.setUp(self)
+        tor_async_util._compressed_bodies.clear()
+
+    def _fetch(self, url, accept_encoding='gzip'):
+        headers = {}
+        if accept_encoding is not None:
+            headers['Accept-Encoding'] = accept_encoding
+        return self.fetch(url, headers=headers, decompress_response=False)
+
+    def _decompress(self, response):
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        return json.loads(zlib.decompress(response.body, 16 + zlib.MAX_WBITS))
+
+    def test_small_body_not_compressed(self):
+        response = self._fetch(TestCompressionRequestHandler.url_spec)
+        self.assertEqual(response.code, httplib.OK)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertNotIn('Vary', response.headers)
+        self.assertEqual(json.loads(response.body), {'msg': 'dave was here'})
+
+    def test_large_body_compressed(self):
+        url = TestCompressionRequestHandler.url_spec + '?repeat=100'
+        response = self._fetch(url)
+        self.assertEqual(response.code, httplib.OK)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(self._decompress(response), {'msg': 'dave was here' * 100})
+        self.assertEqual(int(response.headers['Content-Length']), len(response.body))
+        self.assertEqual(len(tor_async_util._compressed_bodies), 0)
+
+    def test_accept_encoding_negotiation(self):
+        url = TestCompressionRequestHandler.url_spec + '?repeat=100'
+        for accept_encoding in [None, 'identity', 'gzip;q=0', 'deflate, gzip; q=0.0', 'gzip;q=dave']:
+            response = self._fetch(url, accept_encoding)
+            self.assertNotIn('Content-Encoding', response.headers, accept_encoding)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+
+        for accept_encoding in ['deflate, GZIP', 'gzip;q=0.5', '*']:
+            response = self._fetch(url, accept_encoding)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip', accept_encoding)
+
+    def test_static_body_compressed_once(self):
+        url = TestCompressionRequestHandler.url_spec + '?repeat=100&static=1'
+        with mock.patch('zlib.compressobj', wraps=zlib.compressobj) as compressobj_patch:
+            for _ in range(3):
+                response = self._fetch(url)
+                self.assertEqual(self._decompress(response), {'msg': 'dave was here' * 100})
+            self.assertEqual(compressobj_patch.call_count, 1)
+        self.assertEqual(len(tor_async_util._compressed_bodies), 1)
+
+    def test_static_body_below_compression_min_size_compressed(self):
+        # with default compression settings static responses are compressed
+        # regardless of compression_min_size
+        version = 'davewashere' * 20
+        url = '%s?version=%s' % (TestCompressedVersionRequestHandler.url_spec, version)
+        with mock.patch('zlib.compressobj', wraps=zlib.compressobj) as compressobj_patch:
+            for _ in range(3):
+                response = self._fetch(url)
+                self.assertEqual(response.code, httplib.OK)
+                self.assertLess(len(response.body), TestCompressedVersionRequestHandler.compression_min_size)
+                self.assertEqual(self._decompress(response)['version'], version)
+            self.assertEqual(compressobj_patch.call_count, 1)
+        self.assertEqual(len(tor_async_util._compressed_bodies), 1)
+
+    def test_version_response(self):
+        # with default compression settings a typical version response is
+        # compressed once but is too small for gzip to make it any smaller
+        with mock.patch('zlib.compressobj', wraps=zlib.compressobj) as compressobj_patch:
+            for _ in range(3):
+                response = self._fetch(TestCompressedVersionRequestHandler.url_spec)
+                self.assertEqual(response.code, httplib.OK)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(json.loads(response.body)['version'], '1.0.0')
+            self.assertEqual(compressobj_patch.call_count, 1)
+        self.assertEqual(len(tor_async_util._compressed_bodies), 1)
+
 
 class TestVersionRequestHandler(tor_async_util.RequestHandler):
 
@@ -1380,12 +2606,278 @@ class NoOpTestCase(RequestHandlerTestCase):
         self.assertNoDebugDetail(response)
 
 
+class MetricsRegistryTestCase(unittest.TestCase):
+    """A collection of unit tests for the MetricsRegistry class."""
+
+    def test_duplicate_registration(self):
+        registry = tor_async_util.MetricsRegistry()
+        registry.counter('dave_total', 'Dave.')
+        with self.assertRaises(ValueError):
+            registry.gauge('dave_total', 'Dave.')
+
+    def test_counter(self):
+        registry = tor_async_util.MetricsRegistry()
+        counter = registry.counter('dave_total', 'Dave counter.', ('color', 'size'))
+        counter.inc(('red', 'small'))
+        counter.inc(('red', 'small'), 2)
+        counter.inc(('blue', 'sma"ll'))
+        self.assertEqual(counter.value(('red', 'small')), 3)
+        self.assertEqual(counter.value(('green', 'small')), 0)
+
+        expected = (
+            '# HELP dave_total Dave counter.\n'
+            '# TYPE dave_total counter\n'
+            'dave_total{color="red",size="small"} 3\n'
+            'dave_total{color="blue",size="sma\\"ll"} 1\n'
+        )
+        self.assertEqual(registry.render(), expected)
+
+    def test_gauge(self):
+        registry = tor_async_util.MetricsRegistry()
+        gauge = registry.gauge('dave', 'Dave gauge.')
+        gauge.set(2.5)
+        gauge.inc()
+        gauge.dec(amount=2)
+
+        expected = (
+            '# HELP dave Dave gauge.\n'
+            '# TYPE dave gauge\n'
+            'dave 1.5\n'
+        )
+        self.assertEqual(registry.render(), expected)
+
+    def test_histogram(self):
+        registry = tor_async_util.MetricsRegistry()
+        histogram = registry.histogram('dave_seconds', 'Dave histogram.', ('color',), buckets=[1, 0.5])
+        histogram.observe(0.25, ('red',))
+        histogram.observe(0.5, ('red',))
+        histogram.observe(0.75, ('red',))
+        histogram.observe(2, ('red',))
+        self.assertEqual(histogram.count(('red',)), 4)
+        self.assertEqual(histogram.count(('blue',)), 0)
+
+        expected = (
+            '# HELP dave_seconds Dave histogram.\n'
+            '# TYPE dave_seconds histogram\n'
+            'dave_seconds_bucket{color="red",le="0.5"} 2\n'
+            'dave_seconds_bucket{color="red",le="1.0"} 3\n'
+            'dave_seconds_bucket{color="red",le="+Inf"} 4\n'
+            'dave_seconds_sum{color="red"} 3.5\n'
+            'dave_seconds_count{color="red"} 4\n'
+        )
+        self.assertEqual(registry.render(), expected)
+
+    def test_clear(self):
+        registry = tor_async_util.MetricsRegistry()
+        counter = registry.counter('dave_total', 'Dave counter.')
+        counter.inc()
+        registry.clear()
+        self.assertEqual(counter.value(), 0)
+        self.assertEqual(registry.render(), '# HELP dave_total Dave counter.\n# TYPE dave_total counter\n')
+
+
+class TestMetricsRequestHandler(tor_async_util.RequestHandler):
+
+    url_spec = r'/_metrics'
+
+    @tornado.web.asynchronous
+    def get(self):
+        tor_async_util.generate_metrics_response(self)
+
+
+class MetricsTestCase(RequestHandlerTestCase):
+    """Unit tests for generate_metrics_response() and the metrics
+    recorded by RequestHandler."""
+
+    def get_app(self):
+        handlers = [
+            (
+                TestMetricsRequestHandler.url_spec,
+                TestMetricsRequestHandler
+            ),
+            (
+                TestAddDebugDetailsRequestHandler.url_spec,
+                TestAddDebugDetailsRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def setUp(self):
+        RequestHandlerTestCase.setUp(self)
+        tor_async_util.metrics_registry.clear()
+
+    def tearDown(self):
+        tor_async_util.metrics_registry.clear()
+        RequestHandlerTestCase.tearDown(self)
+
+    def test_happy_path(self):
+        response = self.fetch('%s?value=%d' % (TestAddDebugDetailsRequestHandler.url_spec, 0x0042))
+        self.assertEqual(response.code, httplib.OK)
+
+        response = self.fetch(TestMetricsRequestHandler.url_spec, method='GET')
+        self.assertEqual(response.code, httplib.OK)
+        self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+
+        lines = response.body.split('\n')
+        labels = 'handler="TestAddDebugDetailsRequestHandler"'
+        self.assertIn('tor_async_util_requests_total{%s,method="GET",code="200"} 1' % labels, lines)
+        self.assertIn('tor_async_util_request_duration_seconds_count{%s} 1' % labels, lines)
+        self.assertIn('tor_async_util_debug_details_total{%s,debug_details="0x0042"} 1' % labels, lines)
+
+        labels = 'handler="TestMetricsRequestHandler",method="GET",code="200"'
+        self.assertNotIn('tor_async_util_requests_total{%s} 1' % labels, lines)
+
+        response = self.fetch(TestMetricsRequestHandler.url_spec, method='GET')
+        lines = response.body.split('\n')
+        self.assertIn('tor_async_util_requests_total{%s} 1' % labels, lines)
+
+    def test_custom_registry(self):
+        registry = tor_async_util.MetricsRegistry()
+        registry.counter('dave_total', 'Dave counter.').inc()
+
+        request_handler = mock.Mock()
+        tor_async_util.generate_metrics_response(request_handler, registry)
+        request_handler.write.assert_called_once_with(registry.render())
+        request_handler.set_status.assert_called_once_with(httplib.OK)
+        request_handler.finish.assert_called_once_with()
+
+    def test_http_client_request_duration(self):
+        response = mock.Mock(
+            code=httplib.SERVICE_UNAVAILABLE,
+            time_info={},
+            request_time=0.042,
+            effective_url="http://172.17.42.1:4001/v2/keys/key-value",
+            request=mock.Mock(method="GET"))
+        tor_async_util.AsyncAction().create_log_msg_for_http_client_response(response, 'dave')
+
+        histogram = tor_async_util._http_client_request_duration_seconds
+        self.assertEqual(histogram.count(('dave', '5xx')), 1)
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+    """A collection of unit tests for the LatencyHistogram class."""
+
+    def test_empty(self):
+        histogram = tor_async_util.LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(histogram.snapshot(), {'count': 0})
+
+    def test_bucket_index_round_trip(self):
+        histogram = tor_async_util.LatencyHistogram()
+        for value in [0, 1, 15, 16, 31, 32, 33, 63, 64, 1000, 123456, 2 ** 36]:
+            index = histogram._bucket_index(value)
+            self.assertTrue(abs(histogram._bucket_value(index) - value) <= value / 16.0)
+
+    def test_percentiles_within_relative_error(self):
+        histogram = tor_async_util.LatencyHistogram()
+        for value in range(1, 10001):
+            histogram.record(value / 10.0)
+
+        self.assertEqual(histogram.count, 10000)
+        for (percentile, expected) in [(50, 500.0), (90, 900.0), (99, 990.0), (100, 1000.0)]:
+            actual = histogram.percentile(percentile)
+            self.assertTrue(abs(actual - expected) <= expected / 16.0, (percentile, actual))
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 10000)
+        self.assertEqual(snapshot['min'], 0.1)
+        self.assertEqual(snapshot['max'], 1000.0)
+        self.assertAlmostEqual(snapshot['mean'], 500.05, places=4)
+
+    def test_max_value(self):
+        histogram = tor_async_util.LatencyHistogram(max_bits=10)
+        histogram.record(10 ** 9)
+        self.assertEqual(histogram.max, 2 ** 10)
+
+    def test_reset(self):
+        histogram = tor_async_util.LatencyHistogram()
+        histogram.record(42)
+        histogram.reset()
+        self.assertEqual(histogram.snapshot(), {'count': 0})
+        self.assertIsNone(histogram.percentile(99))
+
+
+class HTTPClientLatencyHistogramsTestCase(unittest.TestCase):
+    """A collection of unit tests for the HTTPClientLatencyHistograms class."""
+
+    def _response(self, code, request_time, time_info):
+        return mock.Mock(code=code, request_time=request_time, time_info=time_info)
+
+    def test_record_and_snapshot(self):
+        histograms = tor_async_util.HTTPClientLatencyHistograms()
+        histograms.record(self._response(200, 0.010, {'queue': 0.001, 'total': 0.009}), 'dave')
+        histograms.record(self._response(201, 0.020, {}), 'dave')
+        histograms.record(self._response(503, 0.030, {}), 'dave')
+
+        snapshot = histograms.snapshot()
+        self.assertEqual(sorted(snapshot.keys()), [('dave', '2xx'), ('dave', '5xx')])
+        self.assertEqual(snapshot[('dave', '2xx')]['request_time']['count'], 2)
+        self.assertEqual(snapshot[('dave', '2xx')]['queue']['count'], 1)
+        self.assertEqual(snapshot[('dave', '2xx')]['queue']['max'], 1.0)
+        self.assertEqual(snapshot[('dave', '2xx')]['connect']['count'], 0)
+        self.assertEqual(snapshot[('dave', '5xx')]['request_time']['max'], 30.0)
+
+    def test_snapshot_with_reset(self):
+        histograms = tor_async_util.HTTPClientLatencyHistograms()
+        histograms.record(self._response(200, 0.010, {}), 'dave')
+        snapshot = histograms.snapshot(reset=True)
+        self.assertEqual(snapshot[('dave', '2xx')]['request_time']['count'], 1)
+        snapshot = histograms.snapshot()
+        self.assertEqual(snapshot[('dave', '2xx')]['request_time']['count'], 0)
+
+    def test_create_log_msg_for_http_client_response_records_timings(self):
+        histograms = tor_async_util.HTTPClientLatencyHistograms()
+        with mock.patch('tor_async_util.http_client_latency_histograms', histograms):
+            response = mock.Mock(
+                code=httplib.NOT_FOUND,
+                time_info={'total': 0.005},
+                request_time=0.042,
+                effective_url="http://172.17.42.1:4001/v2/keys/key-value",
+                request=mock.Mock(method="GET"))
+            tor_async_util.AsyncAction().create_log_msg_for_http_client_response(response, 'dave')
+
+        snapshot = histograms.snapshot()
+        self.assertEqual(snapshot[('dave', '4xx')]['request_time']['count'], 1)
+        self.assertEqual(snapshot[('dave', '4xx')]['total']['max'], 5.0)
+
+
+class AsyncActionIdGeneratorTestCase(unittest.TestCase):
+    """A collection of unit tests for the AsyncActionIdGenerator class."""
+
+    def test_ids_look_like_uuid4_hex(self):
+        generator = tor_async_util.AsyncActionIdGenerator()
+        self.assertTrue(re.match(r'^[0-9a-f]{32}$', generator()))
+
+    def test_ids_are_unique(self):
+        generator = tor_async_util.AsyncActionIdGenerator()
+        ids = set(generator() for i in range(1000))
+        self.assertEqual(1000, len(ids))
+
+    def test_ids_are_unique_across_processes(self):
+        generator = tor_async_util.AsyncActionIdGenerator()
+        with mock.patch('os.getpid', return_value=1):
+            id1 = generator()
+        with mock.patch('os.getpid', return_value=2):
+            id2 = generator()
+        self.assertNotEqual(id1[:16], id2[:16])
+        self.assertEqual(id1[16:], id2[16:])
+
+    def test_uuid4_async_action_id_generator(self):
+        self.assertTrue(re.match(r'^[0-9a-f]{32}$', tor_async_util.uuid4_async_action_id_generator()))
+
+
 class AsyncActionTestCase(unittest.TestCase):
 
     def test_ctr_generates_id(self):
         aa = tor_async_util.AsyncAction()
         self.assertIsNotNone(aa.id)
 
+    def test_ctr_uses_async_action_id_generator(self):
+        the_id = uuid.uuid4().hex
+        with mock.patch('tor_async_util.async_action_id_generator', return_value=the_id):
+            aa = tor_async_util.AsyncAction()
+            self.assertEqual(aa.id, the_id)
+
     def test_ctr_without_async_state(self):
         aa = tor_async_util.AsyncAction()
         self.assertIsNone(aa.async_state)
@@ -1746,6 +3238,420 @@ class HealthCheckTestCase(RequestHandlerTestCase):
             self.assertDebugDetail(response, tor_async_util.HEALTH_CHECK_GDD_INVALID_RESPONSE_BODY)
 
 
+class HealthCheckCacheTestCase(unittest.TestCase):
+    """A collection of unit tests for the HealthCheckCache class."""
+
+    def test_no_caching_by_default(self):
+        cache = tor_async_util.HealthCheckCache()
+        key = (tor_async_util.AsyncHealthCheck, True)
+        self.assertTrue(cache.start(key, 'rh1'))
+        self.assertEqual(cache.finish(key, []), ['rh1'])
+        self.assertIsNone(cache.get(key))
+
+    def test_coalescing(self):
+        cache = tor_async_util.HealthCheckCache()
+        quick_key = (tor_async_util.AsyncHealthCheck, True)
+        deep_key = (tor_async_util.AsyncHealthCheck, False)
+        self.assertTrue(cache.start(quick_key, 'rh1'))
+        self.assertFalse(cache.start(quick_key, 'rh2'))
+        self.assertTrue(cache.start(deep_key, 'rh3'))
+        self.assertEqual(cache.finish(quick_key, []), ['rh1', 'rh2'])
+        self.assertEqual(cache.finish(deep_key, []), ['rh3'])
+        self.assertTrue(cache.start(quick_key, 'rh4'))
+
+    def test_abandon(self):
+        cache = tor_async_util.HealthCheckCache(deep_ttl=10)
+        key = (tor_async_util.AsyncHealthCheck, False)
+        self.assertTrue(cache.start(key, 'rh1'))
+        self.assertFalse(cache.start(key, 'rh2'))
+        self.assertEqual(cache.abandon(key), ['rh1', 'rh2'])
+        self.assertIsNone(cache.get(key))
+        self.assertTrue(cache.start(key, 'rh3'))
+
+    def test_ttl_per_tier(self):
+        now = [1000.0]
+        cache = tor_async_util.HealthCheckCache(quick_ttl=1, deep_ttl=10, clock=lambda: now[0])
+        quick_key = (tor_async_util.AsyncHealthCheck, True)
+        deep_key = (tor_async_util.AsyncHealthCheck, False)
+        details = [tor_async_util.ComponentHealth('dave', is_ok=True)]
+
+        cache.start(quick_key, 'rh1')
+        cache.finish(quick_key, None)
+        cache.start(deep_key, 'rh2')
+        cache.finish(deep_key, details)
+
+        now[0] += 0.5
+        self.assertEqual(cache.get(quick_key), (None, 0.5))
+        self.assertEqual(cache.get(deep_key), (details, 0.5))
+
+        now[0] += 0.5
+        self.assertIsNone(cache.get(quick_key))
+        self.assertEqual(cache.get(deep_key), (details, 1.0))
+
+        cache.clear()
+        self.assertIsNone(cache.get(deep_key))
+
+
+class HealthCheckCachingTestCase(RequestHandlerTestCase):
+    """Unit tests for generate_health_check_response()'s use of
+    HealthCheckCache."""
+
+    def get_app(self):
+        handlers = [
+            (
+                HealthCheckRequestHandler.url_spec,
+                HealthCheckRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def test_cached_response_includes_age(self):
+        now = [1000.0]
+        cache = tor_async_util.HealthCheckCache(deep_ttl=10, clock=lambda: now[0])
+        check_patch = mock.Mock(side_effect=lambda callback: callback(None, None))
+
+        with mock.patch('tor_async_util.health_check_cache', cache):
+            with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+                url = '%s?quick=false' % HealthCheckRequestHandler.url_spec
+                response = self.fetch(url, method='GET')
+                self.assertEqual(response.code, httplib.OK)
+                self.assertNotIn('Age', response.headers)
+
+                now[0] += 3
+                response = self.fetch(url, method='GET')
+                self.assertEqual(response.code, httplib.OK)
+                self.assertEqual(response.headers['Age'], '3')
+                self.assertEqual(json.loads(response.body)['status'], 'green')
+
+                # quick checks aren't cached
+                response = self.fetch(HealthCheckRequestHandler.url_spec, method='GET')
+                self.assertEqual(response.code, httplib.OK)
+                self.assertNotIn('Age', response.headers)
+
+                self.assertEqual(2, check_patch.call_count)
+
+    def test_concurrent_requests_coalesced(self):
+        ahcs = []
+
+        def check_patch(ahc, callback):
+            ahcs.append(ahc)
+            tornado.ioloop.IOLoop.current().call_later(0.05, callback, None, ahc)
+
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            url = self.get_url(HealthCheckRequestHandler.url_spec)
+            futures = [self.http_client.fetch(url, raise_error=False) for i in range(3)]
+            responses = self.io_loop.run_sync(lambda: tornado.gen.multi(futures))
+            self.assertEqual([response.code for response in responses], [httplib.OK] * 3)
+            self.assertEqual(1, len(ahcs))
+
+    def test_check_raises_releases_waiters(self):
+        ahcs = []
+
+        def check_patch(ahc, callback):
+            ahcs.append(ahc)
+            if len(ahcs) == 1:
+                raise Exception('dave')
+            callback(None, ahc)
+
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            url = '%s?quick=false' % HealthCheckRequestHandler.url_spec
+            response = self.fetch(url, method='GET')
+            self.assertEqual(response.code, httplib.INTERNAL_SERVER_ERROR)
+            self.assertDebugDetail(response, tor_async_util.HEALTH_CHECK_GDD_CHECK_FAILED)
+
+            response = self.fetch(url, method='GET')
+            self.assertEqual(response.code, httplib.OK)
+            self.assertEqual(2, len(ahcs))
+
+    def test_lost_callback_times_out(self):
+        cache = tor_async_util.HealthCheckCache(in_flight_timeout=0.05)
+        ahcs = []
+
+        def check_patch(ahc, callback):
+            ahcs.append(ahc)
+            if len(ahcs) == 1:
+                # never calls back
+                return
+            callback(None, ahc)
+
+        with mock.patch('tor_async_util.health_check_cache', cache):
+            with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+                url = self.get_url(HealthCheckRequestHandler.url_spec)
+                futures = [self.http_client.fetch(url, raise_error=False) for i in range(2)]
+                responses = self.io_loop.run_sync(lambda: tornado.gen.multi(futures))
+                self.assertEqual([response.code for response in responses], [httplib.SERVICE_UNAVAILABLE] * 2)
+                for response in responses:
+                    self.assertDebugDetail(response, tor_async_util.HEALTH_CHECK_GDD_CHECK_TIMED_OUT)
+                self.assertEqual(1, len(ahcs))
+
+                response = self.fetch(HealthCheckRequestHandler.url_spec, method='GET')
+                self.assertEqual(response.code, httplib.OK)
+                self.assertEqual(2, len(ahcs))
+
+
+class PolledHealthCheckRequestHandler(tor_async_util.RequestHandler):
+
+    url_spec = r'/_health'
+
+    poller = None
+
+    @tornado.web.asynchronous
+    def get(self):
+        tor_async_util.generate_polled_health_check_response(self, type(self).poller)
+
+
+class HealthCheckPollerTestCase(RequestHandlerTestCase):
+    """Unit tests for HealthCheckPoller and generate_polled_health_check_response()."""
+
+    def setUp(self):
+        self.now = [1000.0]
+        self.poller = tor_async_util.HealthCheckPoller(
+            tor_async_util.AsyncHealthCheck,
+            clock=lambda: self.now[0])
+        PolledHealthCheckRequestHandler.poller = self.poller
+        super(HealthCheckPollerTestCase, self).setUp()
+
+    def tearDown(self):
+        self.poller.stop()
+        PolledHealthCheckRequestHandler.poller = None
+        super(HealthCheckPollerTestCase, self).tearDown()
+
+    def get_app(self):
+        handlers = [
+            (
+                PolledHealthCheckRequestHandler.url_spec,
+                PolledHealthCheckRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def test_no_snapshot_yet(self):
+        response = self.fetch(PolledHealthCheckRequestHandler.url_spec, method='GET')
+        self.assertEqual(response.code, httplib.OK)
+        self.assertNotIn('Age', response.headers)
+
+    def test_is_quick_equals_invalid_value(self):
+        response = self.fetch('%s?quick=davewashere' % PolledHealthCheckRequestHandler.url_spec, method='GET')
+        self.assertEqual(response.code, httplib.BAD_REQUEST)
+        self.assertDebugDetail(response, tor_async_util.HEALTH_CHECK_GDD_INVALID_QUICK_ARGUMENT)
+
+    def test_snapshot(self):
+        def check_patch(ahc, callback):
+            if ahc.is_quick:
+                details = None
+            else:
+                details = [
+                    tor_async_util.ComponentHealth('dave', is_ok=True),
+                    tor_async_util.ComponentHealth('here', is_ok=False),
+                ]
+            callback(details, ahc)
+
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            self.poller.start()
+
+        check_patch = mock.Mock()
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            self.now[0] += 2
+
+            response = self.fetch(PolledHealthCheckRequestHandler.url_spec, method='GET')
+            self.assertEqual(response.code, httplib.OK)
+            self.assertJsonContentTypeInResponse(response)
+            self.assertEqual(response.headers['Age'], '2')
+            expected_response_body = {
+                'status': 'green',
+                'links': {
+                    'self': {
+                        'href': response.effective_url,
+                    }
+                }
+            }
+            self.assertEqual(json.loads(response.body), expected_response_body)
+
+            response = self.fetch('%s?quick=no' % PolledHealthCheckRequestHandler.url_spec, method='GET')
+            self.assertEqual(response.code, httplib.SERVICE_UNAVAILABLE)
+            expected_response_body = {
+                'status': 'red',
+                'details': {
+                    'dave': 'green',
+                    'here': 'red',
+                },
+                'links': {
+                    'self': {
+                        'href': response.effective_url.split('?')[0],
+                    }
+                }
+            }
+            self.assertEqual(json.loads(response.body), expected_response_body)
+            jsonschema.validate(json.loads(response.body), tor_async_util.jsonschemas.get_health_response)
+
+            self.assertEqual(0, check_patch.call_count)
+
+    def test_invalid_snapshot(self):
+        with mock.patch(__name__ + '.tor_async_util.jsonschema_validators.validate', side_effect=Exception()):
+            self.poller.poll()
+
+        response = self.fetch(PolledHealthCheckRequestHandler.url_spec, method='GET')
+        self.assertEqual(response.code, httplib.INTERNAL_SERVER_ERROR)
+        self.assertDebugDetail(response, tor_async_util.HEALTH_CHECK_GDD_INVALID_RESPONSE_BODY)
+
+    def test_poll_skips_in_flight_checks(self):
+        callbacks = []
+
+        def check_patch(ahc, callback):
+            self.assertTrue(ahc.async_state is self.poller)
+            callbacks.append((callback, ahc))
+
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            self.poller.poll()
+            self.poller.poll()
+            self.assertEqual(2, len(callbacks))
+
+            for (callback, ahc) in callbacks:
+                callback(None, ahc)
+
+            self.poller.poll()
+            self.assertEqual(4, len(callbacks))
+
+    def test_poll_timeout(self):
+        self.poller.timeout = 0.01
+        callbacks = []
+
+        def check_patch(ahc, callback):
+            if ahc.is_quick:
+                callback(None, ahc)
+            else:
+                callbacks.append((callback, ahc))
+
+        with mock.patch(__name__ + '.tor_async_util.AsyncHealthCheck.check', check_patch):
+            self.poller.poll()
+            self.assertEqual(self.poller.snapshot(True).status_code, httplib.OK)
+            self.assertIsNone(self.poller.snapshot(False))
+
+            self.io_loop.call_later(0.05, self.stop)
+            self.wait()
+
+            response = self.fetch('%s?quick=no' % PolledHealthCheckRequestHandler.url_spec, method='GET')
+            self.assertEqual(response.code, httplib.SERVICE_UNAVAILABLE)
+            body = json.loads(response.body)
+            self.assertEqual(body['status'], 'red')
+            self.assertEqual(body['details'], {'health_check': 'red'})
+
+            # late callback from the timed out check is ignored
+            (callback, ahc) = callbacks[0]
+            callback(None, ahc)
+            self.assertEqual(self.poller.snapshot(False).status_code, httplib.SERVICE_UNAVAILABLE)
+
+            # next poll starts a new deep check
+            self.poller.poll()
+            self.assertEqual(2, len(callbacks))
+            (callback, ahc) = callbacks[1]
+            callback(None, ahc)
+            self.assertEqual(self.poller.snapshot(False).status_code, httplib.OK)
+
+
+class ComponentsAsyncHealthCheck(tor_async_util.AsyncHealthCheck):
+    """Only used by ```ComponentHealthCheckTestCase```."""
+    pass
+
+
+def _check_ok_component(callback):
+    callback(tor_async_util.ComponentHealth('ok', is_ok=True))
+
+
+def _check_slow_ok_component(callback):
+    def on_timeout():
+        callback(tor_async_util.ComponentHealth('slow_ok', is_ok=True))
+    tornado.ioloop.IOLoop.current().call_later(0.01, on_timeout)
+
+
+def _check_hung_component(callback):
+    pass
+
+
+def _check_error_component(callback):
+    raise Exception('dave was here')
+
+
+ComponentsAsyncHealthCheck.register_component_health_check('ok', _check_ok_component)
+ComponentsAsyncHealthCheck.register_component_health_check('slow_ok', _check_slow_ok_component)
+ComponentsAsyncHealthCheck.register_component_health_check('hung', _check_hung_component, timeout=0.05)
+ComponentsAsyncHealthCheck.register_component_health_check('error', _check_error_component)
+
+
+class ComponentsHealthCheckRequestHandler(tor_async_util.RequestHandler):
+
+    url_spec = r'/_health'
+
+    @tornado.web.asynchronous
+    def get(self):
+        tor_async_util.generate_health_check_response(self, ComponentsAsyncHealthCheck)
+
+
+class ComponentHealthCheckTestCase(RequestHandlerTestCase):
+    """Unit tests for AsyncHealthCheck's component health checks."""
+
+    def get_app(self):
+        handlers = [
+            (
+                ComponentsHealthCheckRequestHandler.url_spec,
+                ComponentsHealthCheckRequestHandler
+            ),
+        ]
+        return tornado.web.Application(handlers=handlers)
+
+    def test_register_component_health_check_does_not_change_base_class(self):
+        self.assertEqual(tor_async_util.AsyncHealthCheck.component_health_checks, [])
+        self.assertEqual(
+            [chc.name for chc in ComponentsAsyncHealthCheck.component_health_checks],
+            ['ok', 'slow_ok', 'hung', 'error'])
+
+    def test_quick(self):
+        response = self.fetch('%s?quick=true' % ComponentsHealthCheckRequestHandler.url_spec, method='GET')
+        self.assertEqual(response.code, httplib.OK)
+        self.assertNotIn('details', json.loads(response.body))
+
+    def test_deep(self):
+        with mock.patch(__name__ + '.tor_async_util._logger') as logger_patch:
+            response = self.fetch('%s?quick=false' % ComponentsHealthCheckRequestHandler.url_spec, method='GET')
+            self.assertEqual(response.code, httplib.SERVICE_UNAVAILABLE)
+            self.assertNoDebugDetail(response)
+            expected_response_body = {
+                'status': 'red',
+                'details': {
+                    'ok': 'green',
+                    'slow_ok': 'green',
+                    'hung': 'red',
+                    'error': 'red',
+                },
+                'links': {
+                    'self': {
+                        'href': response.effective_url.split('?')[0],
+                    }
+                }
+            }
+            self.assertEqual(json.loads(response.body), expected_response_body)
+            self.assertEqual(2, logger_patch.error.call_count)
+
+    def test_late_callback_ignored(self):
+        callbacks = []
+
+        class LateAsyncHealthCheck(tor_async_util.AsyncHealthCheck):
+            pass
+
+        LateAsyncHealthCheck.register_component_health_check('late', callbacks.append, timeout=0)
+
+        done = mock.Mock(side_effect=lambda details, ahc: self.stop())
+        ahc = LateAsyncHealthCheck(is_quick=False)
+        ahc.check(done)
+        self.wait()
+        callbacks[0](tor_async_util.ComponentHealth('late', is_ok=True))
+
+        self.assertEqual(1, done.call_count)
+        (details, callback_ahc) = done.call_args[0]
+        self.assertTrue(callback_ahc is ahc)
+        self.assertEqual([component.health_color for component in details], ['red'])
+
+
 class ExponentialBackoffRetryStrategyTestCase(unittest.TestCase):
     """A collection of unit tests for the ExponentialBackoffRetryStrategy class."""
 
@@ -1787,3 +3693,1036 @@ class ExponentialBackoffRetryStrategyTestCase(unittest.TestCase):
                     return
 
         self.assertTure(False)
+
+    def test_ctr_unknown_jitter(self):
+        with self.assertRaises(ValueError):
+            tor_async_util.ExponentialBackoffRetryStrategy(jitter='dave')
+
+    def _delays(self, rs):
+        delays = []
+        with mock.patch('tornado.ioloop.IOLoop.add_timeout'):
+            while True:
+                delay_in_ms = rs.wait(mock.Mock())
+                if not delay_in_ms:
+                    return delays
+                delays.append(delay_in_ms)
+
+    def test_max_delay(self):
+        for jitter in ['plus_minus', 'full', 'decorrelated']:
+            rs = tor_async_util.ExponentialBackoffRetryStrategy(
+                jitter=jitter,
+                max_delay_in_ms=1000,
+                use_retry_budget=False)
+            delays = self._delays(rs)
+            self.assertEqual(len(delays), rs.max_num_retries - 1)
+            self.assertTrue(all(0 <= delay <= 1000 for delay in delays))
+
+    def test_full_jitter(self):
+        rs = tor_async_util.ExponentialBackoffRetryStrategy(
+            jitter=tor_async_util.ExponentialBackoffRetryStrategy.FULL_JITTER,
+            use_retry_budget=False)
+        for (retry, delay) in enumerate(self._delays(rs), 1):
+            self.assertTrue(0 <= delay <= (2 ** retry) * 25)
+
+    def test_decorrelated_jitter(self):
+        rs = tor_async_util.ExponentialBackoffRetryStrategy(
+            jitter=tor_async_util.ExponentialBackoffRetryStrategy.DECORRELATED_JITTER,
+            base_delay_in_ms=10,
+            use_retry_budget=False)
+        previous_delay = 10
+        for delay in self._delays(rs):
+            self.assertTrue(10 <= delay <= previous_delay * 3)
+            previous_delay = delay
+
+    def test_max_elapsed(self):
+        clock = mock.Mock(return_value=100.0)
+        rs = tor_async_util.ExponentialBackoffRetryStrategy(
+            max_elapsed_in_ms=1000,
+            use_retry_budget=False,
+            clock=clock)
+        delays = self._delays(rs)
+        self.assertEqual(len(delays), 5)
+        self.assertEqual(rs.num_retries, 6)
+
+        rs = tor_async_util.ExponentialBackoffRetryStrategy(
+            max_elapsed_in_ms=1000,
+            use_retry_budget=False,
+            clock=clock)
+        with mock.patch('tornado.ioloop.IOLoop.add_timeout'):
+            self.assertTrue(rs.wait(mock.Mock()))
+            clock.return_value = 100.95
+            wait_callback = mock.Mock()
+            self.assertIsNone(rs.wait(wait_callback))
+            wait_callback.assert_called_once_with(0)
+
+    def test_retry_budget(self):
+        budget = tor_async_util.RetryBudget(retry_ratio=0.5, min_retries_per_second=0, max_tokens=2)
+        with mock.patch('tor_async_util.retry_budget', budget):
+            rs = tor_async_util.ExponentialBackoffRetryStrategy(use_retry_budget=True)
+            self.assertEqual(len(self._delays(rs)), 2)
+            self.assertEqual(budget.num_retries_allowed, 2)
+            self.assertEqual(budget.num_retries_rejected, 1)
+
+            rs = tor_async_util.ExponentialBackoffRetryStrategy(use_retry_budget=True)
+            self.assertEqual(len(self._delays(rs)), 0)
+
+            tor_async_util.ExponentialBackoffRetryStrategy(use_retry_budget=True)
+            rs = tor_async_util.ExponentialBackoffRetryStrategy(use_retry_budget=True)
+            self.assertEqual(len(self._delays(rs)), 1)
+
+            # retry budget isn't used by default
+            rs = tor_async_util.ExponentialBackoffRetryStrategy()
+            self.assertEqual(len(self._delays(rs)), rs.max_num_retries - 1)
+            self.assertEqual(budget.num_retries_allowed, 3)
+
+        with mock.patch('tor_async_util.retry_budget', None):
+            rs = tor_async_util.ExponentialBackoffRetryStrategy(use_retry_budget=True)
+            self.assertEqual(len(self._delays(rs)), rs.max_num_retries - 1)
+
+
+class RetryBudgetTestCase(unittest.TestCase):
+    """A collection of unit tests for the RetryBudget class."""
+
+    def test_deposit_and_withdraw(self):
+        budget = tor_async_util.RetryBudget(retry_ratio=0.25, min_retries_per_second=0, max_tokens=1)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        for _ in range(3):
+            budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for _ in range(100):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 1)
+        self.assertEqual(budget.num_retries_allowed, 2)
+        self.assertEqual(budget.num_retries_rejected, 2)
+
+    def test_min_retries_per_second(self):
+        clock = mock.Mock(return_value=100.0)
+        budget = tor_async_util.RetryBudget(retry_ratio=0, min_retries_per_second=2, max_tokens=1, clock=clock)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        clock.return_value = 100.25
+        self.assertFalse(budget.withdraw())
+        clock.return_value = 100.5
+        self.assertTrue(budget.withdraw())
+        clock.return_value = 1000.0
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """A collection of unit tests for the CircuitBreaker class."""
+
+    def _circuit_breaker(self, clock):
+        return tor_async_util.CircuitBreaker(
+            'dave',
+            failure_rate_threshold=0.5,
+            window_size=4,
+            min_num_calls=4,
+            open_duration=10.0,
+            num_half_open_calls=2,
+            clock=clock)
+
+    def test_closed_to_open(self):
+        cb = self._circuit_breaker(mock.Mock(return_value=100.0))
+        self.assertEqual(cb.state, cb.CLOSED)
+
+        # not enough calls to open the circuit
+        for is_ok in [False, True, True]:
+            self.assertTrue(cb.allow_request())
+            cb.record(is_ok)
+        self.assertEqual(cb.state, cb.CLOSED)
+
+        # sliding window drops the oldest failure
+        for is_ok in [True, True, True]:
+            self.assertTrue(cb.allow_request())
+            cb.record(is_ok)
+        self.assertEqual(cb.state, cb.CLOSED)
+        self.assertEqual(cb.failure_rate, 0.0)
+
+        cb.record_failure()
+        self.assertEqual(cb.state, cb.CLOSED)
+        self.assertEqual(cb.failure_rate, 0.25)
+        cb.record_failure()
+        self.assertEqual(cb.state, cb.OPEN)
+        self.assertFalse(cb.allow_request())
+        self.assertEqual(cb.num_fast_failures, 1)
+
+    def _open(self, cb):
+        for _ in range(4):
+            self.assertTrue(cb.allow_request())
+            cb.record_failure()
+        self.assertEqual(cb.state, cb.OPEN)
+
+    def test_half_open_to_closed(self):
+        clock = mock.Mock(return_value=100.0)
+        cb = self._circuit_breaker(clock)
+        self._open(cb)
+
+        clock.return_value = 109.9
+        self.assertEqual(cb.state, cb.OPEN)
+
+        clock.return_value = 110.0
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+        self.assertTrue(cb.allow_request())
+        self.assertTrue(cb.allow_request())
+        self.assertFalse(cb.allow_request())
+
+        cb.record_success()
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+        cb.record_success()
+        self.assertEqual(cb.state, cb.CLOSED)
+        self.assertEqual(cb.failure_rate, 0.0)
+
+    def test_half_open_to_open(self):
+        clock = mock.Mock(return_value=100.0)
+        cb = self._circuit_breaker(clock)
+        self._open(cb)
+
+        clock.return_value = 110.0
+        self.assertTrue(cb.allow_request())
+        cb.record_failure()
+        self.assertEqual(cb.state, cb.OPEN)
+
+        clock.return_value = 119.0
+        self.assertFalse(cb.allow_request())
+
+    def test_outcomes_from_older_generation_ignored(self):
+        clock = mock.Mock(return_value=100.0)
+        cb = self._circuit_breaker(clock)
+
+        # call allowed while the circuit is closed but which completes late
+        stale_permit = cb.allow_request()
+        self._open(cb)
+
+        clock.return_value = 110.0
+        trial_permit = cb.allow_request()
+        self.assertTrue(trial_permit)
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+
+        cb.record(True, stale_permit)
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+
+        cb.record(False, trial_permit)
+        self.assertEqual(cb.state, cb.OPEN)
+
+    def test_trial_calls_in_flight_decremented(self):
+        clock = mock.Mock(return_value=100.0)
+        cb = self._circuit_breaker(clock)
+        self._open(cb)
+
+        clock.return_value = 110.0
+        permits = [cb.allow_request(), cb.allow_request()]
+        self.assertFalse(cb.allow_request())
+
+        cb.record(True, permits[0])
+        self.assertEqual(cb.state, cb.HALF_OPEN)
+        permits.append(cb.allow_request())
+        self.assertTrue(permits[-1])
+        self.assertFalse(cb.allow_request())
+
+        cb.record(True, permits[1])
+        self.assertEqual(cb.state, cb.CLOSED)
+
+        # trial call which completes after the circuit closed is ignored
+        cb.record(False, permits[2])
+        self.assertEqual(cb.failure_rate, 0.0)
+
+    def test_call(self):
+        clock = mock.Mock(return_value=100.0)
+        cb = self._circuit_breaker(clock)
+
+        def start(callback):
+            callback(None, 'async action')
+
+        for _ in range(4):
+            callback = mock.Mock()
+            fast_fail_callback = mock.Mock()
+            cb.call(start, callback, fast_fail_callback, lambda result, async_action: result is not None)
+            callback.assert_called_once_with(None, 'async action')
+            self.assertEqual(fast_fail_callback.call_count, 0)
+
+        self.assertEqual(cb.state, cb.OPEN)
+
+        callback = mock.Mock()
+        fast_fail_callback = mock.Mock()
+        cb.call(start, callback, fast_fail_callback, lambda result, async_action: result is not None)
+        self.assertEqual(callback.call_count, 0)
+        fast_fail_callback.assert_called_once_with()
+
+    def test_call_start_raises(self):
+        cb = self._circuit_breaker(mock.Mock(return_value=100.0))
+        start = mock.Mock(side_effect=Exception('dave was here'))
+        with self.assertRaises(Exception):
+            cb.call(start, mock.Mock(), mock.Mock(), mock.Mock())
+        self.assertEqual(cb.failure_rate, 1.0)
+
+    def test_aspect_health(self):
+        cb = tor_async_util.CircuitBreaker('my service', min_num_calls=1)
+        self.assertEqual(cb.aspect_health.name, 'my_service')
+        self.assertTrue(cb.aspect_health.is_ok)
+        cb.record_failure()
+        self.assertFalse(cb.aspect_health.is_ok)
+
+
+class CircuitBreakerRegistryTestCase(unittest.TestCase):
+    """A collection of unit tests for the CircuitBreakerRegistry class."""
+
+    def test_get(self):
+        registry = tor_async_util.CircuitBreakerRegistry(min_num_calls=1)
+        self.assertEqual(len(registry), 0)
+        cb = registry.get('dave')
+        self.assertTrue(cb is registry.get('dave'))
+        self.assertEqual(cb.min_num_calls, 1)
+        self.assertEqual(list(registry), [cb])
+        registry.clear()
+        self.assertEqual(len(registry), 0)
+
+    def test_component_health_check(self):
+        registry = tor_async_util.CircuitBreakerRegistry(min_num_calls=1)
+
+        callback = mock.Mock()
+        registry.component_health_check(callback)
+        self.assertEqual(callback.call_args[0][0].health_color, 'green')
+
+        registry.get('dave')
+        registry.get('bob').record_failure()
+        callback = mock.Mock()
+        registry.component_health_check(callback)
+        component_health = callback.call_args[0][0]
+        self.assertEqual(component_health.name, 'circuit_breakers')
+        self.assertEqual(component_health.health_color, 'red')
+        self.assertEqual([aspect.health_color for aspect in component_health.aspects], ['green', 'red'])
+
+
+class GetHttpClientTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for get_http_client()."""
+
+    def test_shared_client(self):
+        http_client = tor_async_util.get_http_client()
+        self.assertTrue(isinstance(http_client, tornado.curl_httpclient.CurlAsyncHTTPClient))
+        self.assertTrue(http_client is tor_async_util.get_http_client())
+        self.assertEqual(http_client.defaults['connect_timeout'], 5.0)
+
+
+class AsyncHTTPActionTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for the AsyncHTTPAction class."""
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+
+        self._retry_budget_patcher = mock.patch('tor_async_util.retry_budget', None)
+        self._retry_budget_patcher.start()
+
+        self.http_client = mock.Mock()
+        self._get_http_client_patcher = mock.patch(
+            'tor_async_util.get_http_client',
+            return_value=self.http_client)
+        self._get_http_client_patcher.start()
+
+    def tearDown(self):
+        self._get_http_client_patcher.stop()
+        self._retry_budget_patcher.stop()
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def _responses(self, *responses):
+        futures = []
+        for (code, errno) in responses:
+            future = tornado.concurrent.Future()
+            future.set_result(mock.Mock(
+                code=code,
+                error=mock.Mock(errno=errno) if errno else None,
+                request_time=0.01,
+                time_info={},
+                effective_url='http://example.com/dave',
+                request=mock.Mock(method='GET')))
+            futures.append(future)
+        self.http_client.fetch.side_effect = futures
+
+    def _fetch(self, aha):
+        callback = mock.Mock(side_effect=lambda *args: self.stop())
+        aha.fetch(callback)
+        self.wait()
+        self.assertEqual(callback.call_count, 1)
+        (response, async_action) = callback.call_args[0]
+        self.assertTrue(async_action is aha)
+        return response
+
+    def test_ctr(self):
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave')
+        self.assertEqual(aha.request.url, 'http://example.com/dave')
+        self.assertTrue(aha.is_idempotent)
+
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='POST', body='')
+        self.assertFalse(tor_async_util.AsyncHTTPAction('dave', request).is_idempotent)
+        self.assertTrue(tor_async_util.AsyncHTTPAction('dave', request, is_idempotent=True).is_idempotent)
+
+        request.headers['Idempotency-Key'] = '123'
+        self.assertTrue(tor_async_util.AsyncHTTPAction('dave', request).is_idempotent)
+
+    def test_happy_path(self):
+        self._responses((httplib.OK, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', attempt_timeout=2.0)
+        response = self._fetch(aha)
+        self.assertEqual(response.code, httplib.OK)
+        self.assertEqual(aha.num_attempts, 1)
+        self.assertEqual(aha.request.request_timeout, 2.0)
+        self.assertEqual(aha.request.connect_timeout, 2.0)
+        self.assertEqual(self.http_client.fetch.call_count, 1)
+        (request,) = self.http_client.fetch.call_args[0]
+        self.assertEqual(request.url, aha.request.url)
+        self.assertEqual(request.request_timeout, 2.0)
+
+        # progress options are reset even though the request isn't hedged
+        curl = mock.Mock()
+        request.prepare_curl_callback(curl)
+        curl.setopt.assert_any_call(pycurl.TCP_KEEPALIVE, 1)
+        curl.setopt.assert_any_call(pycurl.NOPROGRESS, 0)
+
+    def test_connect_timeout_defaults_to_http_client_default(self):
+        self._responses((httplib.OK, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', attempt_timeout=20.0)
+        self._fetch(aha)
+        self.assertEqual(aha.request.request_timeout, 20.0)
+        self.assertEqual(aha.request.connect_timeout, 5.0)
+
+        self._responses((httplib.OK, None))
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', connect_timeout=1.0)
+        aha = tor_async_util.AsyncHTTPAction('dave', request, attempt_timeout=20.0)
+        self._fetch(aha)
+        self.assertEqual(aha.request.connect_timeout, 1.0)
+
+    def test_no_retry_for_non_retryable_status_code(self):
+        self._responses((httplib.INTERNAL_SERVER_ERROR, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave')
+        self.assertEqual(self._fetch(aha).code, httplib.INTERNAL_SERVER_ERROR)
+        self.assertEqual(aha.num_attempts, 1)
+
+    def test_retry_idempotent(self):
+        self._responses((httplib.SERVICE_UNAVAILABLE, None), (599, None), (httplib.OK, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave')
+        self.assertEqual(self._fetch(aha).code, httplib.OK)
+        self.assertEqual(aha.num_attempts, 3)
+
+    def test_max_num_retries(self):
+        self._responses(*[(httplib.SERVICE_UNAVAILABLE, None)] * 3)
+        aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', max_num_retries=2)
+        self.assertEqual(self._fetch(aha).code, httplib.SERVICE_UNAVAILABLE)
+        self.assertEqual(aha.num_attempts, 3)
+
+    def test_retry_non_idempotent(self):
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='POST', body='')
+
+        self._responses((httplib.SERVICE_UNAVAILABLE, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', request)
+        self.assertEqual(self._fetch(aha).code, httplib.SERVICE_UNAVAILABLE)
+        self.assertEqual(aha.num_attempts, 1)
+
+        self._responses((599, pycurl.E_OPERATION_TIMEDOUT))
+        aha = tor_async_util.AsyncHTTPAction('dave', request)
+        self.assertEqual(self._fetch(aha).code, 599)
+        self.assertEqual(aha.num_attempts, 1)
+
+        self._responses((599, pycurl.E_COULDNT_CONNECT), (httplib.CREATED, None))
+        aha = tor_async_util.AsyncHTTPAction('dave', request)
+        self.assertEqual(self._fetch(aha).code, httplib.CREATED)
+        self.assertEqual(aha.num_attempts, 2)
+
+    def test_overall_timeout(self):
+        clock = mock.Mock(return_value=100.0)
+        self._responses((599, None), (599, None))
+        futures = list(self.http_client.fetch.side_effect)
+
+        def fetch(request, raise_error):
+            clock.return_value += 1.0
+            return futures.pop(0)
+
+        self.http_client.fetch.side_effect = fetch
+
+        aha = tor_async_util.AsyncHTTPAction(
+            'dave',
+            'http://example.com/dave',
+            attempt_timeout=1.0,
+            overall_timeout=1.5,
+            clock=clock)
+        self.assertEqual(self._fetch(aha).code, 599)
+        self.assertEqual(aha.num_attempts, 2)
+        self.assertEqual(aha.request.request_timeout, 0.5)
+
+        clock.return_value = 100.0
+        self._responses((599, None), (599, None))
+        futures = list(self.http_client.fetch.side_effect)
+        self.http_client.fetch.side_effect = fetch
+
+        aha = tor_async_util.AsyncHTTPAction(
+            'dave',
+            'http://example.com/dave',
+            attempt_timeout=1.0,
+            overall_timeout=1.0,
+            clock=clock)
+        self.assertEqual(self._fetch(aha).code, 599)
+        self.assertEqual(aha.num_attempts, 1)
+
+    def test_circuit_breaker(self):
+        with mock.patch('tor_async_util.circuit_breakers', tor_async_util.CircuitBreakerRegistry(min_num_calls=1)):
+            self._responses((httplib.SERVICE_UNAVAILABLE, None))
+            aha = tor_async_util.AsyncHTTPAction(
+                'dave',
+                'http://example.com/dave',
+                max_num_retries=1,
+                use_circuit_breaker=True)
+            self.assertIsNone(self._fetch(aha))
+            self.assertEqual(aha.num_attempts, 1)
+            self.assertEqual(tor_async_util.circuit_breakers.get('dave').state, 'open')
+
+    def test_circuit_breaker_records_non_retryable_500_as_failure(self):
+        with mock.patch('tor_async_util.circuit_breakers', tor_async_util.CircuitBreakerRegistry(min_num_calls=1)):
+            self._responses((httplib.INTERNAL_SERVER_ERROR, None))
+            aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_circuit_breaker=True)
+            self.assertEqual(self._fetch(aha).code, httplib.INTERNAL_SERVER_ERROR)
+            self.assertEqual(aha.num_attempts, 1)
+            self.assertEqual(tor_async_util.circuit_breakers.get('dave').state, 'open')
+
+    def test_circuit_breaker_records_post_503_as_failure(self):
+        with mock.patch('tor_async_util.circuit_breakers', tor_async_util.CircuitBreakerRegistry(min_num_calls=1)):
+            self._responses((httplib.SERVICE_UNAVAILABLE, None))
+            request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='POST', body='dave')
+            aha = tor_async_util.AsyncHTTPAction('dave', request, use_circuit_breaker=True)
+            self.assertEqual(self._fetch(aha).code, httplib.SERVICE_UNAVAILABLE)
+            self.assertEqual(aha.num_attempts, 1)
+            self.assertEqual(tor_async_util.circuit_breakers.get('dave').state, 'open')
+
+    def test_circuit_breaker_records_2xx_and_4xx_as_success(self):
+        with mock.patch('tor_async_util.circuit_breakers', tor_async_util.CircuitBreakerRegistry(min_num_calls=1)):
+            self._responses((httplib.OK, None), (httplib.NOT_FOUND, None))
+            for code in [httplib.OK, httplib.NOT_FOUND]:
+                aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_circuit_breaker=True)
+                self.assertEqual(self._fetch(aha).code, code)
+            circuit_breaker = tor_async_util.circuit_breakers.get('dave')
+            self.assertEqual(circuit_breaker.state, 'closed')
+            self.assertEqual(circuit_breaker.failure_rate, 0.0)
+
+    def _response(self, code):
+        return mock.Mock(
+            code=code,
+            error=None,
+            request_time=0.01,
+            time_info={},
+            effective_url='http://example.com/dave',
+            request=mock.Mock(method='GET'))
+
+    def _trained_hedging_policy(self):
+        hedging_policy = tor_async_util.HedgingPolicy(max_hedge_rate=1, min_num_samples=10)
+        for _ in range(10):
+            hedging_policy.record_latency('dave', 0.002)
+        return hedging_policy
+
+    def test_no_hedge_when_rate_capped(self):
+        hedging_policy = self._trained_hedging_policy()
+        hedging_policy.max_hedge_rate = 0
+
+        def fetch(request, raise_error):
+            future = tornado.concurrent.Future()
+            self.io_loop.call_later(0.02, future.set_result, self._response(httplib.OK))
+            return future
+
+        self.http_client.fetch.side_effect = fetch
+
+        with mock.patch('tor_async_util.hedging_policy', hedging_policy):
+            aha = tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_hedging=True)
+            self.assertEqual(self._fetch(aha).code, httplib.OK)
+
+        self.assertEqual(aha.num_hedges, 0)
+        self.assertEqual(hedging_policy.num_hedges_rejected, 1)
+        self.assertEqual(self.http_client.fetch.call_count, 1)
+
+    def test_hedging_only_for_gets(self):
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='PUT', body='')
+        self.assertFalse(tor_async_util.AsyncHTTPAction('dave', request, use_hedging=True).use_hedging)
+        self.assertTrue(tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_hedging=True).use_hedging)
+
+
+class HedgingPolicyTestCase(unittest.TestCase):
+    """A collection of unit tests for the HedgingPolicy class."""
+
+    def test_hedge_delay(self):
+        hedging_policy = tor_async_util.HedgingPolicy(percentile=90, min_num_samples=20, window_size=40)
+        for _ in range(19):
+            hedging_policy.record_latency('dave', 0.1)
+        self.assertIsNone(hedging_policy.hedge_delay('dave'))
+        hedging_policy.record_latency('dave', 0.1)
+        self.assertAlmostEqual(hedging_policy.hedge_delay('dave'), 0.1, places=2)
+
+        # window is reset after window_size samples but last delay is kept
+        for _ in range(20):
+            hedging_policy.record_latency('dave', 0.2)
+        self.assertAlmostEqual(hedging_policy.hedge_delay('dave'), 0.2, places=2)
+        for _ in range(10):
+            hedging_policy.record_latency('dave', 1.0)
+        self.assertAlmostEqual(hedging_policy.hedge_delay('dave'), 0.2, places=2)
+
+        self.assertIsNone(hedging_policy.hedge_delay('bob'))
+
+    def test_min_delay(self):
+        hedging_policy = tor_async_util.HedgingPolicy(min_num_samples=10, min_delay=0.05)
+        for _ in range(10):
+            hedging_policy.record_latency('dave', 0.001)
+        self.assertEqual(hedging_policy.hedge_delay('dave'), 0.05)
+
+    def test_max_hedge_rate(self):
+        hedging_policy = tor_async_util.HedgingPolicy(max_hedge_rate=0.5, max_burst=1)
+        self.assertFalse(hedging_policy.allow_hedge('dave'))
+        hedging_policy.deposit()
+        self.assertFalse(hedging_policy.allow_hedge('dave'))
+        hedging_policy.deposit()
+        self.assertTrue(hedging_policy.allow_hedge('dave'))
+        for _ in range(10):
+            hedging_policy.deposit()
+        self.assertTrue(hedging_policy.allow_hedge('dave'))
+        self.assertFalse(hedging_policy.allow_hedge('dave'))
+        hedging_policy.hedge_won('dave')
+        self.assertEqual(hedging_policy.num_hedges, 2)
+        self.assertEqual(hedging_policy.num_hedges_rejected, 3)
+        self.assertEqual(hedging_policy.num_hedge_wins, 1)
+
+
+class HedgedRequestHandler(tornado.web.RequestHandler):
+    """Used by AsyncHTTPActionHedgingTestCase. The first request is
+    slow so a hedged request is sent and wins.
+    """
+
+    url_spec = r"/hedged"
+
+    num_requests = 0
+
+    @tornado.gen.coroutine
+    def get(self):
+        type(self).num_requests += 1
+        if type(self).num_requests == 1:
+            yield tornado.gen.sleep(5)
+        self.write('dave')
+
+
+class AsyncHTTPActionHedgingTestCase(tornado.testing.AsyncHTTPTestCase):
+    """A collection of unit tests for AsyncHTTPAction hedging which
+    drive a real server through the shared http client.
+    """
+
+    def setUp(self):
+        self._http_client_max_clients_patcher = mock.patch('tor_async_util.http_client_max_clients', 2)
+        self._http_client_max_clients_patcher.start()
+        HedgedRequestHandler.num_requests = 0
+        tornado.testing.AsyncHTTPTestCase.setUp(self)
+
+    def tearDown(self):
+        tor_async_util.get_http_client().close()
+        tornado.testing.AsyncHTTPTestCase.tearDown(self)
+        self._http_client_max_clients_patcher.stop()
+
+    def get_app(self):
+        return tornado.web.Application(handlers=[(HedgedRequestHandler.url_spec, HedgedRequestHandler)])
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_hedge_wins_and_cancelled_attempt_does_not_poison_curl_handles(self):
+        hedging_policy = tor_async_util.HedgingPolicy(max_hedge_rate=1, min_num_samples=10)
+        for _ in range(10):
+            hedging_policy.record_latency('dave', 0.002)
+
+        with mock.patch('tor_async_util.hedging_policy', hedging_policy):
+            aha = tor_async_util.AsyncHTTPAction('dave', self.get_url(HedgedRequestHandler.url_spec), use_hedging=True)
+            future = tornado.concurrent.Future()
+            aha.fetch(lambda response, async_action: future.set_result(response))
+            response = yield future
+
+        self.assertEqual(response.code, httplib.OK)
+        self.assertEqual(aha.num_hedges, 1)
+        self.assertEqual(hedging_policy.num_hedge_wins, 1)
+
+        # wait for the cancelled attempt to be aborted and its curl handle freed
+        http_client = tor_async_util.get_http_client()
+        while len(http_client._free_list) < len(http_client._curls):
+            yield tornado.gen.sleep(0.01)
+
+        # requests reusing both curl handles (including the handle used by the
+        # cancelled attempt) must not be aborted
+        responses = yield [
+            http_client.fetch(self.get_url(HedgedRequestHandler.url_spec), raise_error=False),
+            http_client.fetch(self.get_url(HedgedRequestHandler.url_spec), raise_error=False),
+        ]
+        self.assertEqual([r.code for r in responses], [httplib.OK, httplib.OK])
+
+    def test_cancelled_attempt_aborts_at_most_one_transfer(self):
+        attempt = tor_async_util._HTTPAttempt(is_hedge=False)
+        curl = mock.Mock()
+        attempt.prepare_curl(tor_async_util._http_client_prepare_curl, curl)
+        curl.setopt.assert_any_call(pycurl.TCP_KEEPALIVE, 1)
+        self.assertEqual(curl.setopt.call_args_list[-2:], [
+            mock.call(pycurl.NOPROGRESS, 0),
+            mock.call(pycurl.PROGRESSFUNCTION, attempt.progress),
+        ])
+
+        self.assertEqual(attempt.progress(0, 0, 0, 0), 0)
+        attempt.is_cancelled = True
+        self.assertEqual(attempt.progress(0, 0, 0, 0), 1)
+        self.assertEqual(attempt.progress(0, 0, 0, 0), 0)
+
+        # an attempt cancelled after its transfer is done aborts nothing
+        attempt = tor_async_util._HTTPAttempt(is_hedge=True)
+        attempt.done(tornado.concurrent.Future())
+        attempt.is_cancelled = True
+        self.assertEqual(attempt.progress(0, 0, 0, 0), 0)
+
+        curl = mock.Mock()
+        tor_async_util._http_client_prepare_curl(curl)
+        curl.setopt.assert_any_call(pycurl.NOPROGRESS, 1)
+        curl.setopt.assert_any_call(pycurl.PROGRESSFUNCTION, tor_async_util._http_client_progress)
+
+
+class HTTPRequestCoalescerTestCase(unittest.TestCase):
+    """A collection of unit tests for the HTTPRequestCoalescer class."""
+
+    def test_key(self):
+        coalescer = tor_async_util.HTTPRequestCoalescer(key_headers=['Accept'])
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', headers={'Accept': 'text/plain'})
+        self.assertEqual(coalescer.key(request), ('GET', 'http://example.com/dave', ('text/plain',)))
+
+    def test_conditional_requests_not_coalesced_with_unconditional_requests(self):
+        coalescer = tor_async_util.HTTPRequestCoalescer()
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave')
+        conditional_request = tornado.httpclient.HTTPRequest(
+            'http://example.com/dave',
+            headers={'If-None-Match': '"1"'})
+        self.assertNotEqual(coalescer.key(request), coalescer.key(conditional_request))
+
+    def test_start_and_finish(self):
+        coalescer = tor_async_util.HTTPRequestCoalescer()
+        self.assertEqual(coalescer.coalescing_ratio, 0.0)
+
+        leader = mock.Mock(service='dave')
+        follower = mock.Mock(service='dave')
+        self.assertTrue(coalescer.start('key', leader))
+        self.assertFalse(coalescer.start('key', follower))
+        self.assertEqual(coalescer.finish('key'), [leader, follower])
+        self.assertEqual(coalescer.finish('key'), [])
+
+        self.assertTrue(coalescer.start('key', leader))
+        self.assertEqual(coalescer.num_requests, 3)
+        self.assertEqual(coalescer.num_coalesced, 1)
+        self.assertAlmostEqual(coalescer.coalescing_ratio, 1 / 3.0)
+
+
+class AsyncHTTPActionCoalescingTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for AsyncHTTPAction's request coalescing."""
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+
+        self.http_client = mock.Mock()
+        self._patchers = [
+            mock.patch('tor_async_util.get_http_client', return_value=self.http_client),
+            mock.patch('tor_async_util.http_request_coalescer', tor_async_util.HTTPRequestCoalescer()),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self._patchers:
+            patcher.stop()
+
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def test_identical_requests_share_response(self):
+        response = mock.Mock(
+            code=httplib.OK,
+            error=None,
+            request_time=0.01,
+            time_info={},
+            effective_url='http://example.com/dave',
+            request=mock.Mock(method='GET'))
+
+        def fetch(request, raise_error):
+            future = tornado.concurrent.Future()
+            self.io_loop.add_callback(future.set_result, response)
+            return future
+
+        self.http_client.fetch.side_effect = fetch
+
+        callbacks = []
+
+        def callback(response, async_action):
+            callbacks.append((response, async_action))
+            if len(callbacks) == 4:
+                self.stop()
+
+        ahas = [
+            tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_coalescing=True),
+            tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_coalescing=True),
+            tor_async_util.AsyncHTTPAction('dave', 'http://example.com/dave', use_coalescing=True),
+            tor_async_util.AsyncHTTPAction('dave', 'http://example.com/bob', use_coalescing=True),
+        ]
+        for aha in ahas:
+            aha.fetch(callback)
+        self.wait()
+
+        self.assertEqual(self.http_client.fetch.call_count, 2)
+        self.assertEqual([aha.num_attempts for aha in ahas], [1, 0, 0, 1])
+        self.assertEqual(sorted(id(async_action) for (_, async_action) in callbacks), sorted(id(aha) for aha in ahas))
+        self.assertTrue(all(r is response for (r, _) in callbacks))
+        self.assertEqual(tor_async_util.http_request_coalescer.num_coalesced, 2)
+
+    def test_coalescing_only_for_gets(self):
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='POST', body='')
+        self.assertFalse(tor_async_util.AsyncHTTPAction('dave', request, use_coalescing=True).use_coalescing)
+
+
+def _cacheable_response(code=httplib.OK, body='dave', **headers):
+    return mock.Mock(
+        code=code,
+        body=body,
+        error=None,
+        headers=tornado.httputil.HTTPHeaders(headers),
+        request_time=0.01,
+        time_info={},
+        effective_url='http://example.com/dave',
+        request=mock.Mock(method='GET'))
+
+
+class HTTPResponseCacheTestCase(unittest.TestCase):
+    """A collection of unit tests for the HTTPResponseCache class."""
+
+    def setUp(self):
+        self.clock = mock.Mock(return_value=100.0)
+        self.cache = tor_async_util.HTTPResponseCache(max_bytes=10, max_entry_bytes=8, clock=self.clock)
+
+    def _update(self, response, key='key'):
+        return self.cache.update(key, 'dave', response)
+
+    def _lookup(self, key='key'):
+        return self.cache.lookup(key, 'dave')[0]
+
+    def test_key(self):
+        cache = tor_async_util.HTTPResponseCache(key_headers=['Accept'])
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', headers={'Accept': 'text/plain'})
+        self.assertEqual(cache.key(request), ('http://example.com/dave', ('text/plain',)))
+
+    def test_max_age(self):
+        self.assertEqual(self._lookup(), 'miss')
+        response = _cacheable_response(**{'Cache-Control': 'public, max-age=10'})
+        self.assertTrue(self._update(response) is response)
+
+        self.clock.return_value = 109.9
+        (state, entry) = self.cache.lookup('key', 'dave')
+        self.assertEqual(state, 'fresh')
+        self.assertTrue(entry.response is response)
+
+        self.clock.return_value = 110.0
+        self.assertEqual(self._lookup(), 'miss')
+
+        self.assertEqual(self.cache.num_hits, 1)
+        self.assertEqual(self.cache.num_misses, 2)
+
+    def test_s_maxage_and_age(self):
+        self._update(_cacheable_response(**{'Cache-Control': 'max-age=100, s-maxage=10', 'Age': '5'}))
+        self.clock.return_value = 104.9
+        self.assertEqual(self._lookup(), 'fresh')
+        self.clock.return_value = 105.0
+        self.assertEqual(self._lookup(), 'miss')
+
+    def test_not_cacheable(self):
+        for headers in [{}, {'Cache-Control': 'no-store, max-age=10'}, {'Cache-Control': 'private, max-age=10'}]:
+            self._update(_cacheable_response(**headers))
+            self.assertEqual(len(self.cache), 0)
+
+        self._update(_cacheable_response(body='123456789', **{'Cache-Control': 'max-age=10'}))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_vary_star_not_cached(self):
+        self._update(_cacheable_response(**{'Cache-Control': 'max-age=10', 'Vary': '*'}))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_vary_on_header_not_in_key_not_cached(self):
+        for vary in ['X-Tenant', 'Accept-Language', 'Accept-Encoding, X-Tenant']:
+            self._update(_cacheable_response(**{'Cache-Control': 'max-age=10', 'Vary': vary}))
+            self.assertEqual(len(self.cache), 0, vary)
+
+    def test_vary_on_key_headers_cached(self):
+        self._update(_cacheable_response(**{'Cache-Control': 'max-age=10', 'Vary': 'accept-encoding, Accept'}))
+        self.assertEqual(len(self.cache), 1)
+
+        self._update(_cacheable_response(**{'Cache-Control': 'max-age=10'}))
+        self.assertEqual(len(self.cache), 1)
+        self._update(_cacheable_response(code=httplib.NOT_FOUND))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_lru_eviction(self):
+        for key in ['a', 'b']:
+            self._update(_cacheable_response(body='1234', **{'Cache-Control': 'max-age=10'}), key)
+        self.assertEqual(self._lookup('a'), 'fresh')
+        self._update(_cacheable_response(body='1234', **{'Cache-Control': 'max-age=10'}), 'c')
+        self.assertEqual(self.cache.num_bytes, 8)
+        self.assertEqual(self._lookup('a'), 'fresh')
+        self.assertEqual(self._lookup('b'), 'miss')
+        self.assertEqual(self._lookup('c'), 'fresh')
+
+    def test_stale_while_revalidate(self):
+        self._update(_cacheable_response(**{'Cache-Control': 'max-age=10, stale-while-revalidate=5', 'ETag': '"1"'}))
+        self.clock.return_value = 114.0
+        (state, entry) = self.cache.lookup('key', 'dave')
+        self.assertEqual(state, 'stale')
+        self.assertEqual(entry.etag, '"1"')
+
+        # only one revalidation at a time
+        self.assertEqual(self._lookup(), 'revalidate')
+
+        self.clock.return_value = 115.0
+        self.assertEqual(self._lookup(), 'revalidate')
+        self.assertEqual(self.cache.num_stale_hits, 1)
+
+    def test_revalidate(self):
+        response = _cacheable_response(**{'Cache-Control': 'no-cache', 'ETag': '"1"'})
+        self._update(response)
+        (state, entry) = self.cache.lookup('key', 'dave')
+        self.assertEqual(state, 'revalidate')
+        self.assertEqual(entry.etag, '"1"')
+
+        self.assertTrue(self._update(_cacheable_response(code=httplib.NOT_MODIFIED, body='')) is response)
+        self.assertEqual(self._lookup(), 'revalidate')
+
+        not_modified = _cacheable_response(code=httplib.NOT_MODIFIED, body='', **{'Cache-Control': 'max-age=10'})
+        self.assertTrue(self._update(not_modified) is response)
+        self.assertEqual(self._lookup(), 'fresh')
+        self.assertEqual(self.cache.num_revalidations, 2)
+
+        self.cache.clear()
+        self.assertTrue(self._update(not_modified) is not_modified)
+        self.assertEqual(self.cache.num_bytes, 0)
+
+
+class AsyncHTTPActionCacheTestCase(tornado.testing.AsyncTestCase):
+    """A collection of unit tests for AsyncHTTPAction's response caching."""
+
+    def setUp(self):
+        tornado.testing.AsyncTestCase.setUp(self)
+
+        self.clock = mock.Mock(return_value=100.0)
+        self.http_client = mock.Mock()
+        self._patchers = [
+            mock.patch('tor_async_util.get_http_client', return_value=self.http_client),
+            mock.patch('tor_async_util.http_response_cache', tor_async_util.HTTPResponseCache(clock=self.clock)),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self._patchers:
+            patcher.stop()
+
+        tornado.testing.AsyncTestCase.tearDown(self)
+
+    def _responses(self, *responses):
+        self.requests = []
+        responses = list(responses)
+
+        def fetch(request, raise_error):
+            self.requests.append(request)
+            future = tornado.concurrent.Future()
+            future.set_result(responses.pop(0))
+            return future
+
+        self.http_client.fetch.side_effect = fetch
+
+    def _fetch(self, **kwargs):
+        aha = tor_async_util.AsyncHTTPAction(
+            'dave',
+            'http://example.com/dave',
+            use_cache=True,
+            clock=self.clock,
+            **kwargs)
+        callback = mock.Mock(side_effect=lambda *args: self.stop())
+        aha.fetch(callback)
+        self.wait()
+        return callback.call_args[0][0]
+
+    def test_hit_and_revalidate(self):
+        response = _cacheable_response(**{'Cache-Control': 'max-age=10', 'ETag': '"1"'})
+        not_modified = _cacheable_response(code=httplib.NOT_MODIFIED, body='')
+        self._responses(response, not_modified)
+
+        self.assertTrue(self._fetch() is response)
+        self.assertTrue(self._fetch() is response)
+        self.assertEqual(self.http_client.fetch.call_count, 1)
+
+        self.clock.return_value = 110.0
+        self.assertTrue(self._fetch() is response)
+        self.assertEqual(self.http_client.fetch.call_count, 2)
+        self.assertEqual(self.requests[1].headers['If-None-Match'], '"1"')
+        self.assertNotIn('If-None-Match', self.requests[0].headers)
+
+    def test_revalidated_entry_evicted_while_in_flight(self):
+        response = _cacheable_response(**{'Cache-Control': 'max-age=10', 'ETag': '"1"'})
+        not_modified = _cacheable_response(code=httplib.NOT_MODIFIED, body='')
+        self._responses(response, not_modified)
+
+        self.assertTrue(self._fetch() is response)
+
+        def fetch(request, raise_error):
+            self.requests.append(request)
+            # entry is evicted while the conditional request is in flight
+            tor_async_util.http_response_cache.clear()
+            future = tornado.concurrent.Future()
+            future.set_result(not_modified)
+            return future
+
+        self.http_client.fetch.side_effect = fetch
+
+        self.clock.return_value = 110.0
+        self.assertTrue(self._fetch() is response)
+        self.assertEqual(self.requests[1].headers['If-None-Match'], '"1"')
+
+        # revalidated entry is stored again
+        self.assertEqual(len(tor_async_util.http_response_cache), 1)
+
+    def test_stale_while_revalidate(self):
+        response = _cacheable_response(**{'Cache-Control': 'max-age=10, stale-while-revalidate=10'})
+        new_response = _cacheable_response(body='bob', **{'Cache-Control': 'max-age=10'})
+        self._responses(response, new_response)
+
+        self.assertTrue(self._fetch() is response)
+
+        self.clock.return_value = 115.0
+        self.assertTrue(self._fetch() is response)
+        self.assertEqual(self.http_client.fetch.call_count, 2)
+
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertTrue(self._fetch() is new_response)
+        self.assertEqual(self.http_client.fetch.call_count, 2)
+
+    def test_failed_stale_while_revalidate_revalidates_again(self):
+        response = _cacheable_response(**{'Cache-Control': 'max-age=10, stale-while-revalidate=10'})
+        service_unavailable = _cacheable_response(code=httplib.SERVICE_UNAVAILABLE, body='')
+        new_response = _cacheable_response(body='bob', **{'Cache-Control': 'max-age=10'})
+        self._responses(response, service_unavailable, new_response)
+
+        self.assertTrue(self._fetch(max_num_retries=0) is response)
+
+        # background revalidation fails without updating the cache
+        self.clock.return_value = 115.0
+        self.assertTrue(self._fetch(max_num_retries=0) is response)
+        self.assertEqual(self.http_client.fetch.call_count, 2)
+
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertTrue(self._fetch(max_num_retries=0) is response)
+        self.assertEqual(self.http_client.fetch.call_count, 3)
+
+        self.io_loop.add_callback(self.stop)
+        self.wait()
+        self.assertTrue(self._fetch(max_num_retries=0) is new_response)
+        self.assertEqual(self.http_client.fetch.call_count, 3)
+
+    def test_cache_only_for_gets(self):
+        request = tornado.httpclient.HTTPRequest('http://example.com/dave', method='PUT', body='')
+        self.assertFalse(tor_async_util.AsyncHTTPAction('dave', request, use_cache=True).use_cache)